@@ -0,0 +1,59 @@
+"""
+Aggregate decode throughput with 1/4/16 concurrent chat completions.
+
+Every stream asks for the same number of completion tokens, so the aggregate
+tokens per second directly shows how much continuous batching buys.
+
+    python examples/batching_benchmark.py --model mlx-community/Llama-3.2-1B-Instruct-4bit
+"""
+
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from mlxengine.chat.mlx.models import load_model
+from mlxengine.chat.schema import ChatCompletionRequest, ChatMessage, Role
+
+PROMPTS = [
+    "Write a short story about a lighthouse keeper.",
+    "Explain how a transformer language model works.",
+    "List some tips for learning a new programming language.",
+    "Describe the water cycle to a ten year old.",
+]
+
+
+def run(model, concurrency: int, max_tokens: int) -> tuple[int, float]:
+    def one(i: int) -> int:
+        request = ChatCompletionRequest(
+            model="benchmark",
+            messages=[ChatMessage(role=Role.USER, content=PROMPTS[i % len(PROMPTS)])],
+            max_tokens=max_tokens,
+            temperature=0.0,
+        )
+        response = model.generate(request)
+        return response.usage.completion_tokens
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        tokens = sum(pool.map(one, range(concurrency)))
+    return tokens, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--model", default="mlx-community/Llama-3.2-1B-Instruct-4bit")
+    parser.add_argument("--max-tokens", type=int, default=256)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16])
+    args = parser.parse_args()
+
+    model = load_model(args.model)
+    run(model, 1, 8)  # warm up
+
+    print(f"{'streams':>8} {'tokens':>8} {'seconds':>8} {'tok/s':>8}")
+    for concurrency in args.concurrency:
+        tokens, elapsed = run(model, concurrency, args.max_tokens)
+        print(f"{concurrency:>8} {tokens:>8} {elapsed:>8.2f} {tokens / elapsed:>8.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""
+Per-token host time of full-decode detokenization versus the incremental detokenizer.
+
+The old streaming path decoded the whole completion on every token and sliced off
+the new text, which is quadratic in the output length. The incremental detokenizer
+only decodes a short window around the newest tokens.
+
+    python examples/detokenizer_benchmark.py --model mlx-community/Llama-3.2-1B-Instruct-4bit
+"""
+
+import argparse
+import time
+
+from mlx_lm.tokenizer_utils import TokenizerWrapper
+from transformers import AutoTokenizer
+
+from mlxengine.chat.mlx.detokenizer import IncrementalDetokenizer
+
+TEXT = (
+    "The lighthouse keeper climbed the spiral stairs every evening. "
+    "Café, naïve, 東京, Здравствуйте, 😀🎉 — multi-byte text exercises "
+    "partial UTF-8 sequences at token boundaries.\n"
+)
+
+
+def full_decode(tokenizer, tokens) -> float:
+    start = time.perf_counter()
+    current_tokens = []
+    last_text = ""
+    for token in tokens:
+        current_tokens.append(token)
+        text = tokenizer.decode(current_tokens)
+        delta_text = text[len(last_text) :]
+        if delta_text:
+            last_text = text
+    return time.perf_counter() - start
+
+
+def incremental_decode(tokenizer, tokens) -> float:
+    start = time.perf_counter()
+    detokenizer = IncrementalDetokenizer(tokenizer)
+    for token in tokens:
+        detokenizer.add_token(token)
+    detokenizer.flush()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--model", default="mlx-community/Llama-3.2-1B-Instruct-4bit")
+    parser.add_argument("--lengths", type=int, nargs="+", default=[512, 2048, 8192])
+    args = parser.parse_args()
+
+    tokenizer = TokenizerWrapper(AutoTokenizer.from_pretrained(args.model))
+    text_tokens = tokenizer.encode(TEXT, add_special_tokens=False)
+
+    print(f"{'tokens':>8} {'full us/tok':>12} {'incr us/tok':>12} {'speedup':>8}")
+    for length in args.lengths:
+        tokens = (text_tokens * (length // len(text_tokens) + 1))[:length]
+        before = full_decode(tokenizer, tokens) / length * 1e6
+        after = incremental_decode(tokenizer, tokens) / length * 1e6
+        print(f"{length:>8} {before:>12.1f} {after:>12.1f} {before / after:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
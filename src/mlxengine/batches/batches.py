@@ -0,0 +1,77 @@
+from typing import Optional
+
+from fastapi import APIRouter, HTTPException, Query
+
+from ..utils.async_bridge import run_in_thread
+from .batches_service import BatchesService, start_batch
+from .schema import Batch, BatchCreateRequest, BatchList
+
+router = APIRouter(tags=["batches"])
+
+
+@router.post("/batches")
+@router.post("/v1/batches")
+async def create_batch(request: BatchCreateRequest) -> Batch:
+    """
+    Creates and runs a batch from an uploaded file of chat completion requests.
+    """
+    service = BatchesService()
+    try:
+        batch = await run_in_thread(service.create, request)
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    start_batch(batch.id, service)
+    return batch
+
+
+@router.get("/batches")
+@router.get("/v1/batches")
+async def list_batches(
+    after: Optional[str] = None, limit: int = Query(default=20, ge=1, le=100)
+) -> BatchList:
+    """
+    Lists the batches, the latest first.
+    """
+    batches = await run_in_thread(BatchesService().list)
+    if after is not None:
+        ids = [batch.id for batch in batches]
+        batches = batches[ids.index(after) + 1 :] if after in ids else []
+    page = batches[:limit]
+    return BatchList(
+        data=page,
+        first_id=page[0].id if page else None,
+        last_id=page[-1].id if page else None,
+        has_more=len(batches) > limit,
+    )
+
+
+@router.get("/batches/{batch_id}")
+@router.get("/v1/batches/{batch_id}")
+async def retrieve_batch(batch_id: str) -> Batch:
+    """
+    Retrieves a batch, with its status and request counts.
+    """
+    try:
+        return BatchesService().get(batch_id)
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+
+@router.post("/batches/{batch_id}/cancel")
+@router.post("/v1/batches/{batch_id}/cancel")
+async def cancel_batch(batch_id: str) -> Batch:
+    """
+    Cancels a batch, the responses written so far stay in its output file.
+    """
+    service = BatchesService()
+    try:
+        batch = service.cancel(batch_id)
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    # Finalized here unless another process is running it
+    start_batch(batch_id, service)
+    return batch
@@ -0,0 +1,713 @@
+"""
+Batch Service Module
+
+This module runs the batches of the Batch API, JSONL files of chat completion
+requests processed in the background, with their responses written to an
+output file. A batch's requests are not served one call at a time:
+
+- They are ordered by model, adapter, tools and messages, so requests sharing
+  a prompt prefix run next to each other and reuse its cached KV.
+- Many of them run at once at ``batch`` priority, decoded together in the
+  continuous batch of their model, in the slots interactive traffic leaves
+  over.
+
+Each batch keeps its state under the ``batches_dir`` of the server config, its
+description and the responses so far, one line each, written off the event
+loop every second:
+
+    {
+        "batches_dir": "~/.cache/mlxengine/batches",
+        "batch_concurrency": 16
+    }
+
+The responses are the batch's checkpoint. A batch interrupted by a restart is
+resumed when the server starts, skipping the requests already answered. A lock
+file keeps a batch from running in more than one worker process, and a marker
+file asks the one running it to cancel it.
+"""
+
+import asyncio
+import fcntl
+import json
+import os
+import re
+import secrets
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from satya import ModelValidationError
+
+from ..chat.router import (
+    MAX_ACTIVE_REQUESTS,
+    _create_text_model,
+    parse_chat_request_data,
+)
+from ..chat.schema import ChatCompletionRequest
+from ..config import load_config
+from ..files.files_service import FilesService, new_file_id
+from ..files.schema import FilePurpose
+from ..utils.admission import (
+    BATCH,
+    AdmissionRejected,
+    AdmissionSlot,
+    get_admission_controller,
+)
+from ..utils.async_bridge import run_in_thread
+from ..utils.logger import logger
+from ..utils.serialization import recursive_to_dict
+from .schema import (
+    CHAT_COMPLETIONS_ENDPOINT,
+    FINAL_STATUSES,
+    Batch,
+    BatchCreateRequest,
+    BatchError,
+    BatchErrors,
+    BatchStatus,
+)
+
+DEFAULT_BATCHES_DIR = "~/.cache/mlxengine/batches"
+# Requests of a batch running at once, as many as a decode batch holds
+DEFAULT_BATCH_CONCURRENCY = MAX_ACTIVE_REQUESTS
+
+COMPLETION_WINDOWS = {"24h": 24 * 60 * 60}
+
+# Seconds between checkpoints, which also check for cancellation and expiry
+CHECKPOINT_INTERVAL = 1.0
+# Seconds between checks for an abort by requests waiting for a slot
+ABORT_POLL_INTERVAL = 0.1
+# Validation errors reported for a rejected input file
+MAX_VALIDATION_ERRORS = 100
+
+_ID_PATTERN = re.compile(r"^batch_[A-Za-z0-9]{1,64}$")
+
+# Completes the body of one request, aborted once the event is set
+Completer = Callable[[Dict[str, Any], threading.Event], Awaitable[Dict[str, Any]]]
+
+
+def batches_dir() -> Path:
+    """Directory holding the batches, from the ``batches_dir`` server config"""
+    return Path(load_config().get("batches_dir", DEFAULT_BATCHES_DIR)).expanduser()
+
+
+class BatchRequestError(Exception):
+    """A request of a batch failed, answered with ``status_code``"""
+
+    def __init__(self, message: str, status_code: int):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+@dataclass
+class BatchRequest:
+    """One line of a batch's input file"""
+
+    line: int
+    custom_id: str
+    body: Dict[str, Any]
+
+    def prefix_key(self) -> Tuple:
+        """Sort key placing requests that share a prompt prefix next to each other"""
+        extra = self.body.get("extra_body") or {}
+        adapter = self.body.get("adapter_path", extra.get("adapter_path"))
+        messages = [
+            (str(message.get("role", "")), json.dumps(message.get("content")))
+            for message in self.body.get("messages") or []
+            if isinstance(message, dict)
+        ]
+        # Tools are rendered ahead of the messages
+        tools = json.dumps(self.body.get("tools"), sort_keys=True)
+        return (str(self.body.get("model")), str(adapter), tools, messages)
+
+
+class BatchesService:
+    """Batches stored in a directory, their files in a files store"""
+
+    def __init__(
+        self, root: Optional[Path] = None, files: Optional[FilesService] = None
+    ):
+        self.root = root if root is not None else batches_dir()
+        self.files = files if files is not None else FilesService()
+
+    def path(self, batch_id: str) -> Path:
+        """
+        Directory of a batch
+
+        Raises:
+            FileNotFoundError: If the ID can't be a batch's
+        """
+        if not _ID_PATTERN.match(batch_id):
+            raise FileNotFoundError(f"No such batch: {batch_id}")
+        return self.root / batch_id
+
+    def output_path(self, batch_id: str) -> Path:
+        return self.path(batch_id) / "output.jsonl"
+
+    def errors_path(self, batch_id: str) -> Path:
+        return self.path(batch_id) / "errors.jsonl"
+
+    def lock_path(self, batch_id: str) -> Path:
+        return self.path(batch_id) / "lock"
+
+    def _cancel_path(self, batch_id: str) -> Path:
+        return self.path(batch_id) / "cancel"
+
+    def create(self, request: BatchCreateRequest) -> Batch:
+        """
+        Create a batch, to be run with :func:`start_batch`
+
+        Raises:
+            FileNotFoundError: If there is no such input file
+            ValueError: If the input file isn't a batch input, or the endpoint or
+                completion window isn't supported
+        """
+        if request.endpoint != CHAT_COMPLETIONS_ENDPOINT:
+            raise ValueError(
+                f"Invalid endpoint '{request.endpoint}', "
+                f"must be '{CHAT_COMPLETIONS_ENDPOINT}'"
+            )
+        if request.completion_window not in COMPLETION_WINDOWS:
+            raise ValueError(
+                f"Invalid completion window '{request.completion_window}', "
+                f"must be one of: {', '.join(COMPLETION_WINDOWS)}"
+            )
+        input_file = self.files.get(request.input_file_id)
+        if input_file.purpose != FilePurpose.BATCH:
+            raise ValueError(
+                f"File {input_file.id} has purpose '{input_file.purpose.value}', "
+                f"not '{FilePurpose.BATCH.value}'"
+            )
+
+        created_at = int(time.time())
+        batch = Batch(
+            id=f"batch_{secrets.token_hex(12)}",
+            endpoint=request.endpoint,
+            input_file_id=request.input_file_id,
+            completion_window=request.completion_window,
+            status=BatchStatus.VALIDATING,
+            created_at=created_at,
+            expires_at=created_at + COMPLETION_WINDOWS[request.completion_window],
+            metadata=request.metadata,
+        )
+        self.path(batch.id).mkdir(parents=True)
+        self.save(batch)
+        logger.info(f"Created batch {batch.id} of file {batch.input_file_id}")
+        return batch
+
+    def save(self, batch: Batch) -> None:
+        """Write a batch's description, replacing the previous one at once"""
+        path = self.path(batch.id) / "batch.json"
+        tmp_path = path.with_name(".batch.tmp.json")
+        data = batch.model_dump(mode="json")
+        # Kept for a resumed batch, though the API leaves it out
+        data["final_status"] = batch.final_status
+        tmp_path.write_text(json.dumps(data), encoding="utf-8")
+        os.replace(tmp_path, path)
+
+    def get(self, batch_id: str) -> Batch:
+        """
+        Describe a batch
+
+        Raises:
+            FileNotFoundError: If there is no such batch
+        """
+        try:
+            text = (self.path(batch_id) / "batch.json").read_text(encoding="utf-8")
+        except FileNotFoundError:
+            raise FileNotFoundError(f"No such batch: {batch_id}")
+        batch = Batch.model_validate_json(text)
+        running = (BatchStatus.VALIDATING, BatchStatus.IN_PROGRESS)
+        if batch.status in running and self.cancel_requested(batch_id):
+            batch.status = BatchStatus.CANCELLING
+            batch.cancelling_at = int(self._cancel_path(batch_id).stat().st_mtime)
+        return batch
+
+    def list(self) -> List[Batch]:
+        """Describe the batches, the latest first"""
+        batches = []
+        for path in self.root.glob("batch_*/batch.json"):
+            try:
+                batches.append(self.get(path.parent.name))
+            except (OSError, ValueError) as e:
+                logger.warning(f"Skipping unreadable batch {path}: {str(e)}")
+        return sorted(
+            batches, key=lambda batch: (batch.created_at, batch.id), reverse=True
+        )
+
+    def cancel(self, batch_id: str) -> Batch:
+        """
+        Ask for a batch to be cancelled
+
+        Requests that are running are aborted, the responses written so far are
+        kept in the batch's output file.
+
+        Raises:
+            FileNotFoundError: If there is no such batch
+            ValueError: If the batch is finalizing or already ended
+        """
+        batch = self.get(batch_id)
+        if batch.status in FINAL_STATUSES or batch.status == BatchStatus.FINALIZING:
+            raise ValueError(
+                f"Cannot cancel batch {batch_id} with status '{batch.status.value}'"
+            )
+        self._cancel_path(batch_id).touch()
+        logger.info(f"Cancelling batch {batch_id}")
+        return self.get(batch_id)
+
+    def cancel_requested(self, batch_id: str) -> bool:
+        return self._cancel_path(batch_id).exists()
+
+
+def _error_line(
+    custom_id: str, status_code: int, message: str, error_type: str
+) -> Dict[str, Any]:
+    return {
+        "id": f"batch_req_{secrets.token_hex(12)}",
+        "custom_id": custom_id,
+        "response": {
+            "status_code": status_code,
+            "request_id": None,
+            "body": {"error": {"message": message, "type": error_type}},
+        },
+        "error": None,
+    }
+
+
+def _expired_line(request: BatchRequest) -> Dict[str, Any]:
+    return {
+        "id": f"batch_req_{secrets.token_hex(12)}",
+        "custom_id": request.custom_id,
+        "response": None,
+        "error": {
+            "code": "batch_expired",
+            "message": "This request could not be executed before the completion "
+            "window expired.",
+        },
+    }
+
+
+def _read_checkpoint(path: Path) -> Set[str]:
+    """
+    Custom IDs answered in a responses file, cutting off a line left half
+    written when the server stopped
+    """
+    done = set()
+    if not path.exists():
+        return done
+    end = 0
+    with open(path, "rb+") as f:
+        for line in f:
+            try:
+                if not line.endswith(b"\n"):
+                    raise ValueError("Incomplete line")
+                done.add(json.loads(line)["custom_id"])
+            except (ValueError, KeyError, TypeError):
+                logger.warning(f"Discarding a partial response at the end of {path}")
+                break
+            end += len(line)
+        f.truncate(end)
+    return done
+
+
+class BatchRunner:
+    """
+    Runs the requests of one batch and writes their responses
+
+    Attributes:
+        service: Store of the batch
+        batch_id: ID of the batch
+        complete: Completes one request, :func:`complete_chat_request` unless
+            given
+        concurrency: Requests running at once
+    """
+
+    def __init__(
+        self,
+        service: BatchesService,
+        batch_id: str,
+        complete: Optional[Completer] = None,
+        concurrency: Optional[int] = None,
+    ):
+        self.service = service
+        self.batch_id = batch_id
+        self.complete = complete if complete is not None else complete_chat_request
+        self.concurrency = max(
+            concurrency
+            or load_config().get("batch_concurrency", DEFAULT_BATCH_CONCURRENCY),
+            1,
+        )
+        # Set once the batch is cancelled or expired, aborts the running requests
+        self._abort = threading.Event()
+        # Custom IDs of the requests answered, before and since a restart
+        self._done: Set[str] = set()
+        self._outputs: Dict[str, Any] = {}
+        # Response lines written at the next checkpoint, per output
+        self._lines: Dict[str, List[str]] = {"output": [], "errors": []}
+
+    async def run(self) -> None:
+        """Run the batch to its end, unless another process is running it"""
+        lock_path = self.service.lock_path(self.batch_id)
+        with open(lock_path, "a") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                logger.info(f"Batch {self.batch_id} is run by another process")
+                return
+            try:
+                await self._run()
+            except Exception as e:
+                logger.error(f"Batch {self.batch_id} failed: {str(e)}", exc_info=True)
+                batch = self.service.get(self.batch_id)
+                batch.status = BatchStatus.FAILED
+                batch.failed_at = int(time.time())
+                batch.errors = BatchErrors(
+                    data=[BatchError(code="server_error", message=str(e))]
+                )
+                self.service.save(batch)
+
+    async def _run(self) -> None:
+        batch = self.service.get(self.batch_id)
+        if batch.status in FINAL_STATUSES:
+            return
+        if batch.status == BatchStatus.FINALIZING:
+            # Interrupted while handing over its files, its requests are done
+            await self._finalize(batch, [])
+            return
+
+        requests, errors = await run_in_thread(self._read_input, batch)
+        if errors:
+            batch.status = BatchStatus.FAILED
+            batch.failed_at = int(time.time())
+            batch.errors = BatchErrors(data=errors)
+            self.service.save(batch)
+            logger.warning(f"Batch {self.batch_id} has an invalid input file")
+            return
+
+        answered, failed = await run_in_thread(self._read_checkpoints)
+        batch.request_counts.total = len(requests)
+        batch.request_counts.completed = len(answered)
+        batch.request_counts.failed = len(failed)
+        if batch.status == BatchStatus.VALIDATING:
+            batch.status = BatchStatus.IN_PROGRESS
+            batch.in_progress_at = int(time.time())
+        self.service.save(batch)
+
+        self._done = answered | failed
+        pending = sorted(
+            (request for request in requests if request.custom_id not in self._done),
+            key=BatchRequest.prefix_key,
+        )
+        if self._done:
+            logger.info(
+                f"Resuming batch {self.batch_id}, {len(self._done)} of "
+                f"{len(requests)} requests were answered"
+            )
+        await self._run_requests(batch, pending)
+        await self._finalize(batch, pending)
+
+    def _read_input(self, batch: Batch) -> Tuple[List[BatchRequest], List[BatchError]]:
+        requests: List[BatchRequest] = []
+        errors: List[BatchError] = []
+        custom_ids: Set[str] = set()
+
+        def invalid(line: int, code: str, message: str) -> None:
+            if len(errors) < MAX_VALIDATION_ERRORS:
+                errors.append(BatchError(code=code, message=message, line=line))
+
+        path = self.service.files.content_path(batch.input_file_id)
+        with open(path, "r", encoding="utf-8") as f:
+            for number, text in enumerate(f, start=1):
+                if not text.strip():
+                    continue
+                try:
+                    item = json.loads(text)
+                except ValueError:
+                    invalid(number, "invalid_json_line", "The line isn't valid JSON")
+                    continue
+                if not isinstance(item, dict):
+                    invalid(number, "invalid_request", "The line isn't a JSON object")
+                    continue
+                custom_id = item.get("custom_id")
+                if not isinstance(custom_id, str) or not custom_id:
+                    invalid(number, "missing_required_parameter", "Missing custom_id")
+                elif custom_id in custom_ids:
+                    invalid(number, "duplicate_custom_id", f"Duplicate '{custom_id}'")
+                elif item.get("method") != "POST":
+                    invalid(number, "invalid_method", "The method must be POST")
+                elif item.get("url") != batch.endpoint:
+                    invalid(number, "invalid_url", f"The url must be {batch.endpoint}")
+                elif not isinstance(item.get("body"), dict):
+                    invalid(number, "invalid_body", "The body must be a JSON object")
+                else:
+                    custom_ids.add(custom_id)
+                    requests.append(BatchRequest(number, custom_id, item["body"]))
+        if not requests and not errors:
+            invalid(1, "empty_file", "The input file has no requests")
+        return requests, errors
+
+    def _read_checkpoints(self) -> Tuple[Set[str], Set[str]]:
+        return (
+            _read_checkpoint(self.service.output_path(self.batch_id)),
+            _read_checkpoint(self.service.errors_path(self.batch_id)),
+        )
+
+    def _stop_reason(self, batch: Batch) -> Optional[BatchStatus]:
+        """The status the batch ends with early, if it's cancelled or expired"""
+        if self.service.cancel_requested(self.batch_id):
+            return BatchStatus.CANCELLED
+        if batch.expires_at is not None and time.time() >= batch.expires_at:
+            return BatchStatus.EXPIRED
+        return None
+
+    def _write(self, name: str, line: Dict[str, Any]) -> None:
+        self._lines[name].append(json.dumps(line) + "\n")
+
+    async def _checkpoint(self, batch: Batch) -> None:
+        """Write the new response lines and the batch off the event loop"""
+        lines = self._lines
+        self._lines = {name: [] for name in lines}
+        # Counts that match the lines, the batch changes while they're written
+        await run_in_thread(self._save_checkpoint, lines, batch.model_copy(deep=True))
+
+    def _save_checkpoint(self, lines: Dict[str, List[str]], batch: Batch) -> None:
+        for name, output in self._outputs.items():
+            output.writelines(lines[name])
+            output.flush()
+            os.fsync(output.fileno())
+        self.service.save(batch)
+
+    def _write_expired(self, requests: List[BatchRequest]) -> None:
+        with open(self.service.errors_path(self.batch_id), "a") as errors:
+            for request in requests:
+                errors.write(json.dumps(_expired_line(request)) + "\n")
+
+    async def _run_requests(self, batch: Batch, pending: List[BatchRequest]) -> None:
+        queue = iter(pending)
+        stopped = asyncio.Event()
+
+        async def worker() -> None:
+            for request in queue:
+                if self._abort.is_set():
+                    return
+                await self._run_request(batch, request)
+
+        async def watch() -> None:
+            # Ends with a checkpoint once the requests stopped, never cut short
+            # in the middle of one
+            while not stopped.is_set():
+                try:
+                    await asyncio.wait_for(stopped.wait(), CHECKPOINT_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                await self._checkpoint(batch)
+                if self._stop_reason(batch) is not None:
+                    self._abort.set()
+
+        with (
+            open(self.service.output_path(self.batch_id), "a") as output,
+            open(self.service.errors_path(self.batch_id), "a") as errors,
+        ):
+            self._outputs = {"output": output, "errors": errors}
+            watcher = asyncio.ensure_future(watch())
+            try:
+                if self._stop_reason(batch) is not None:
+                    self._abort.set()
+                await asyncio.gather(
+                    *(worker() for _ in range(min(self.concurrency, len(pending))))
+                )
+            finally:
+                stopped.set()
+                await watcher
+
+    async def _run_request(self, batch: Batch, request: BatchRequest) -> None:
+        try:
+            body = await self.complete(request.body, self._abort)
+        except BatchRequestError as e:
+            line = _error_line(
+                request.custom_id,
+                e.status_code,
+                str(e),
+                "invalid_request_error" if e.status_code < 500 else "server_error",
+            )
+        except Exception as e:
+            logger.error(
+                f"Request {request.custom_id} of batch {self.batch_id} failed: "
+                f"{str(e)}",
+                exc_info=True,
+            )
+            line = _error_line(request.custom_id, 500, str(e), "server_error")
+        else:
+            line = {
+                "id": f"batch_req_{secrets.token_hex(12)}",
+                "custom_id": request.custom_id,
+                "response": {
+                    "status_code": 200,
+                    "request_id": body.get("id"),
+                    "body": body,
+                },
+                "error": None,
+            }
+        if self._abort.is_set():
+            # Cut short, the request is left to a resumed or expired batch
+            return
+        self._done.add(request.custom_id)
+        if line["response"]["status_code"] == 200:
+            self._write("output", line)
+            batch.request_counts.completed += 1
+        else:
+            self._write("errors", line)
+            batch.request_counts.failed += 1
+
+    async def _finalize(self, batch: Batch, pending: List[BatchRequest]) -> None:
+        counts = batch.request_counts
+        # A resumed batch ends as decided before it was interrupted
+        status = batch.final_status
+        if status is None:
+            status = BatchStatus.COMPLETED
+            if counts.completed + counts.failed < counts.total:
+                status = self._stop_reason(batch) or BatchStatus.COMPLETED
+
+        if batch.status != BatchStatus.FINALIZING:
+            if status == BatchStatus.EXPIRED:
+                expired = [r for r in pending if r.custom_id not in self._done]
+                await run_in_thread(self._write_expired, expired)
+                counts.failed += len(expired)
+            batch.final_status = status
+            batch.status = BatchStatus.FINALIZING
+            batch.finalizing_at = int(time.time())
+
+        # IDs are saved before the files are added, so a resumed batch reuses them
+        outputs = {
+            "output": (self.service.output_path(self.batch_id), "output_file_id"),
+            "errors": (self.service.errors_path(self.batch_id), "error_file_id"),
+        }
+        for name, (path, field) in outputs.items():
+            if getattr(batch, field) is None and path.exists() and path.stat().st_size:
+                setattr(batch, field, new_file_id())
+        self.service.save(batch)
+        for name, (path, field) in outputs.items():
+            file_id = getattr(batch, field)
+            if file_id is not None:
+                await run_in_thread(
+                    self.service.files.add,
+                    path,
+                    file_id,
+                    f"{self.batch_id}_{name}.jsonl",
+                    FilePurpose.BATCH_OUTPUT,
+                )
+
+        now = int(time.time())
+        batch.status = status
+        if status == BatchStatus.CANCELLED:
+            batch.cancelled_at = now
+        elif status == BatchStatus.EXPIRED:
+            batch.expired_at = now
+        else:
+            batch.completed_at = now
+        self.service.save(batch)
+        logger.info(
+            f"Batch {self.batch_id} {status.value}, "
+            f"{batch.request_counts.completed} of {batch.request_counts.total} "
+            f"requests completed and {batch.request_counts.failed} failed"
+        )
+
+
+async def _acquire_batch_slot(model: str, abort: threading.Event) -> AdmissionSlot:
+    """
+    Wait for a batch slot of a model, however long the queue is
+
+    Raises:
+        BatchRequestError: If ``abort`` is set first
+    """
+    admission = get_admission_controller("chat", model, MAX_ACTIVE_REQUESTS)
+    while not abort.is_set():
+        acquire = asyncio.ensure_future(admission.acquire(priority=BATCH))
+        try:
+            # A cancelled or expired batch gives up its place in the queue
+            while not acquire.done() and not abort.is_set():
+                await asyncio.wait({acquire}, timeout=ABORT_POLL_INTERVAL)
+        finally:
+            acquire.cancel()
+        try:
+            slot = await acquire
+        except asyncio.CancelledError:
+            break
+        except AdmissionRejected as e:
+            await _sleep_unless_aborted(e.retry_after, abort)
+            continue
+        if abort.is_set():
+            slot.release()
+            break
+        return slot
+    raise BatchRequestError("The batch was cancelled or expired", 503)
+
+
+async def _sleep_unless_aborted(seconds: float, abort: threading.Event) -> None:
+    """Sleep for ``seconds``, waking up early once ``abort`` is set"""
+    end = time.monotonic() + seconds
+    while not abort.is_set() and time.monotonic() < end:
+        await asyncio.sleep(min(ABORT_POLL_INTERVAL, end - time.monotonic()))
+
+
+async def complete_chat_request(
+    body: Dict[str, Any], abort: threading.Event
+) -> Dict[str, Any]:
+    """
+    Complete the body of a chat completion request at batch priority
+
+    Args:
+        body: Request body, as sent to ``/v1/chat/completions``
+        abort: Stops the generation once set
+
+    Returns:
+        Dict[str, Any]: The chat completion
+
+    Raises:
+        BatchRequestError: If the request is invalid
+    """
+    try:
+        chat_request_data = parse_chat_request_data(body)
+        if chat_request_data.get("stream"):
+            raise ValueError("Streaming is not supported in batches")
+        chat_request_data["priority"] = BATCH
+        chat_request = ChatCompletionRequest(**chat_request_data)
+    except (ModelValidationError, KeyError, TypeError, ValueError) as e:
+        raise BatchRequestError(str(e), 400)
+
+    slot = await _acquire_batch_slot(chat_request.model, abort)
+    try:
+        text_model = await run_in_thread(
+            _create_text_model,
+            chat_request.model,
+            chat_request.get_extra_params().get("adapter_path"),
+        )
+        try:
+            text_model.check_request(chat_request)
+        except ValueError as e:
+            raise BatchRequestError(str(e), 400)
+        completion = await run_in_thread(text_model.generate, chat_request, abort=abort)
+    finally:
+        slot.release()
+    return recursive_to_dict(completion)
+
+
+_tasks: Dict[str, asyncio.Future] = {}
+
+
+def start_batch(batch_id: str, service: Optional[BatchesService] = None) -> None:
+    """Run a batch in the background of the event loop, unless it's running"""
+    task = _tasks.get(batch_id)
+    if task is None or task.done():
+        runner = BatchRunner(service or BatchesService(), batch_id)
+        _tasks[batch_id] = asyncio.ensure_future(runner.run())
+
+
+async def resume_batches() -> None:
+    """Resume the batches a restart interrupted, run when the server starts"""
+    service = BatchesService()
+    for batch in service.list():
+        if batch.status not in FINAL_STATUSES:
+            logger.info(f"Resuming batch {batch.id}")
+            start_batch(batch.id, service)
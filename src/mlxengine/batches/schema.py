@@ -0,0 +1,99 @@
+from enum import Enum
+from typing import Any, Dict, List, Optional
+
+from pydantic import BaseModel, Field
+
+CHAT_COMPLETIONS_ENDPOINT = "/v1/chat/completions"
+
+
+class BatchStatus(str, Enum):
+    VALIDATING = "validating"
+    FAILED = "failed"
+    IN_PROGRESS = "in_progress"
+    FINALIZING = "finalizing"
+    COMPLETED = "completed"
+    EXPIRED = "expired"
+    CANCELLING = "cancelling"
+    CANCELLED = "cancelled"
+
+
+# Statuses a batch never leaves
+FINAL_STATUSES = (
+    BatchStatus.FAILED,
+    BatchStatus.COMPLETED,
+    BatchStatus.EXPIRED,
+    BatchStatus.CANCELLED,
+)
+
+
+class BatchCreateRequest(BaseModel):
+    input_file_id: str = Field(
+        ..., description="ID of an uploaded JSONL file of requests"
+    )
+    endpoint: str = Field(
+        ..., description="Endpoint of the requests, /v1/chat/completions"
+    )
+    completion_window: str = Field(
+        default="24h", description="Time frame the batch should be processed in"
+    )
+    metadata: Optional[Dict[str, str]] = Field(
+        default=None, description="Key-value pairs attached to the batch"
+    )
+
+
+class BatchRequestCounts(BaseModel):
+    total: int = 0
+    completed: int = 0
+    failed: int = 0
+
+
+class BatchError(BaseModel):
+    code: str
+    message: str
+    param: Optional[str] = None
+    line: Optional[int] = None
+
+
+class BatchErrors(BaseModel):
+    object: str = "list"
+    data: List[BatchError] = Field(default_factory=list)
+
+
+class Batch(BaseModel):
+    """Batch information as per OpenAI API specification"""
+
+    id: str = Field(..., description="The batch identifier")
+    object: str = Field(default="batch", description="The object type (always 'batch')")
+    endpoint: str
+    errors: Optional[BatchErrors] = None
+    input_file_id: str
+    completion_window: str
+    status: BatchStatus
+    output_file_id: Optional[str] = None
+    error_file_id: Optional[str] = None
+    created_at: int
+    in_progress_at: Optional[int] = None
+    expires_at: Optional[int] = None
+    finalizing_at: Optional[int] = None
+    completed_at: Optional[int] = None
+    failed_at: Optional[int] = None
+    expired_at: Optional[int] = None
+    cancelling_at: Optional[int] = None
+    cancelled_at: Optional[int] = None
+    request_counts: BatchRequestCounts = Field(default_factory=BatchRequestCounts)
+    metadata: Optional[Dict[str, Any]] = None
+    final_status: Optional[BatchStatus] = Field(
+        default=None,
+        exclude=True,
+        description="Status a finalizing batch ends with, not part of the API",
+    )
+
+
+class BatchList(BaseModel):
+    """Response format for list of batches"""
+
+    object: str = Field(default="list", description="The object type (always 'list')")
+    data: List[Batch] = Field(..., description="List of batch objects")
+    first_id: Optional[str] = None
+    last_id: Optional[str] = None
+    has_more: bool = False
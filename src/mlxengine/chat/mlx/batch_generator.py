@@ -0,0 +1,544 @@
+"""
+Batched Decoding Module
+
+This module provides the primitives used to decode several independent sequences
+in lockstep: a KV cache that packs per-sequence caches into one left-padded
+tensor, and a step engine that runs a single forward pass for all of them.
+"""
+
+import inspect
+from dataclasses import dataclass
+from typing import Any, Callable, Iterable, List, Optional, Set
+
+import mlx.core as mx
+import mlx.nn as nn
+from mlx_lm.generate import generation_stream
+from mlx_lm.models.cache import KVCache, QuantizedKVCache, _BaseCache
+
+from ...utils.logger import logger
+
+
+def is_batchable(model: nn.Module) -> bool:
+    """
+    Check whether a model can be decoded with a BatchKVCache
+
+    Batching relies on the model accepting an explicit attention mask, using the
+    default per-layer KV cache, and on ``mx.fast.rope`` accepting one position
+    offset per batch row.
+    """
+    if hasattr(model, "make_cache") or not hasattr(model, "layers"):
+        return False
+    if "mask" not in inspect.signature(model.__call__).parameters:
+        return False
+
+    try:
+        x = mx.zeros((2, 1, 1, 8))
+        mx.eval(
+            mx.fast.rope(
+                x,
+                8,
+                traditional=False,
+                base=10000.0,
+                scale=1.0,
+                offset=mx.array([0, 1]),
+            )
+        )
+    except Exception as e:
+        logger.debug(f"Per-row rope offsets are not supported: {str(e)}")
+        return False
+    return True
+
+
+def _map(fn: Callable[[mx.array], mx.array], x: Any) -> Any:
+    """Apply ``fn`` to an array, or to each array of a quantized tuple"""
+    if isinstance(x, (tuple, list)):
+        return tuple(fn(a) for a in x)
+    return fn(x)
+
+
+def _concatenate(parts: List[Any], axis: int) -> Any:
+    if isinstance(parts[0], (tuple, list)):
+        return tuple(
+            mx.concatenate([part[i] for part in parts], axis=axis)
+            for i in range(len(parts[0]))
+        )
+    return mx.concatenate(parts, axis=axis)
+
+
+def _length(x: Any) -> int:
+    return (x[0] if isinstance(x, (tuple, list)) else x).shape[2]
+
+
+def _pad_left(x: Any, pad: int) -> Any:
+    if pad <= 0:
+        return x
+    return _map(lambda a: mx.pad(a, [(0, 0), (0, 0), (pad, 0), (0, 0)]), x)
+
+
+def _zeros_like(reference: Any, rows: int, length: int) -> Any:
+    return _map(
+        lambda a: mx.zeros((rows, a.shape[1], length, a.shape[3]), a.dtype),
+        reference,
+    )
+
+
+class BatchKVCache(_BaseCache):
+    """
+    KV cache holding several sequences as left-padded rows of one tensor
+
+    Every row ends at the same buffer index, shorter sequences are padded on the
+    left. ``offset`` holds the rope position of the next token for each row, so
+    padding never shifts the positions a sequence was prefilled with.
+
+    Attributes:
+        keys: Key buffer of shape (batch, kv_heads, capacity, head_dim)
+        values: Value buffer of shape (batch, kv_heads, capacity, head_dim)
+        left_padding: Number of padding slots at the start of each row
+        offset: Rope position of the next token for each row
+    """
+
+    step = 256
+
+    def __init__(self, left_padding: List[int]):
+        self.keys = None
+        self.values = None
+        self.left_padding = mx.array(left_padding, dtype=mx.int32)
+        self.offset = -self.left_padding
+        self._idx = 0
+
+    @classmethod
+    def merge(cls, caches: List[Any]) -> "BatchKVCache":
+        """Right-align single sequence caches (one layer each) into a batch cache
+
+        Quantized caches are merged into a BatchQuantizedKVCache with the same
+        group size and bits.
+        """
+        lengths = [c.offset if c.keys is not None else 0 for c in caches]
+        max_length = max(lengths)
+        left_padding = [max_length - length for length in lengths]
+
+        reference = next((c for c in caches if c.keys is not None), None)
+        if isinstance(reference, QuantizedKVCache):
+            batch = BatchQuantizedKVCache(
+                left_padding, group_size=reference.group_size, bits=reference.bits
+            )
+        else:
+            batch = cls(left_padding)
+        batch._idx = max_length
+        batch.offset = mx.array(lengths, dtype=mx.int32)
+        if reference is None:
+            return batch
+
+        keys, values = [], []
+        for c, length in zip(caches, lengths):
+            if c.keys is None:
+                keys.append(_zeros_like(reference.keys, 1, max_length))
+                values.append(_zeros_like(reference.values, 1, max_length))
+                continue
+            pad = max_length - length
+            keys.append(_pad_left(_map(lambda a: a[..., :length, :], c.keys), pad))
+            values.append(_pad_left(_map(lambda a: a[..., :length, :], c.values), pad))
+        batch.keys = _concatenate(keys, axis=0)
+        batch.values = _concatenate(values, axis=0)
+        return batch
+
+    @property
+    def size(self) -> int:
+        return self.left_padding.size
+
+    def is_trimmable(self) -> bool:
+        return False
+
+    def _padded(self, pad: int):
+        keys, values = self.state
+        return _pad_left(keys, pad), _pad_left(values, pad)
+
+    def extend(self, other: "BatchKVCache") -> None:
+        """Append the rows of another batch cache, re-aligning both on the right"""
+        max_idx = max(self._idx, other._idx)
+        parts = []
+        for c in (self, other):
+            pad = max_idx - c._idx
+            c.left_padding = c.left_padding + pad
+            if c.keys is not None:
+                parts.append(c._padded(pad))
+            else:
+                parts.append(None)
+
+        reference = next((p for p in parts if p is not None), None)
+        if reference is not None:
+            keys, values = [], []
+            for c, part in zip((self, other), parts):
+                if part is None:
+                    part = (
+                        _zeros_like(reference[0], c.size, max_idx),
+                        _zeros_like(reference[1], c.size, max_idx),
+                    )
+                keys.append(part[0])
+                values.append(part[1])
+            self.keys = _concatenate(keys, axis=0)
+            self.values = _concatenate(values, axis=0)
+
+        self.left_padding = mx.concatenate([self.left_padding, other.left_padding])
+        self.offset = mx.concatenate([self.offset, other.offset])
+        self._idx = max_idx
+
+    def filter(self, keep: List[int]) -> None:
+        """Keep only the given rows and drop padding columns no row needs anymore"""
+        indices = mx.array(keep, dtype=mx.int32)
+        self.left_padding = self.left_padding[indices]
+        self.offset = self.offset[indices]
+        if self.keys is not None:
+            self.keys = _map(lambda a: a[indices], self.keys)
+            self.values = _map(lambda a: a[indices], self.values)
+
+        if not keep:
+            self.keys, self.values, self._idx = None, None, 0
+            return
+
+        min_pad = min(self.left_padding.min().item(), self._idx)
+        if min_pad > 0:
+            if self.keys is not None:
+                self.keys = _map(lambda a: a[..., min_pad:, :], self.keys)
+                self.values = _map(lambda a: a[..., min_pad:, :], self.values)
+            self._idx -= min_pad
+            self.left_padding = self.left_padding - min_pad
+
+    def _empty_single(self) -> KVCache:
+        return KVCache()
+
+    def extract(self, row: int) -> KVCache:
+        """Copy one row out as a regular single sequence cache"""
+        cache = self._empty_single()
+        pad = self.left_padding[row].item()
+        if self.keys is not None and self._idx > pad:
+            cache.keys = _map(
+                lambda a: a[row : row + 1, :, pad : self._idx, :], self.keys
+            )
+            cache.values = _map(
+                lambda a: a[row : row + 1, :, pad : self._idx, :], self.values
+            )
+            cache.offset = self._idx - pad
+        return cache
+
+    def make_mask(self, num_tokens: int) -> mx.array:
+        """Causal mask for ``num_tokens`` new tokens that also hides left padding"""
+        key_positions = mx.arange(self._idx + num_tokens)
+        query_positions = mx.arange(self._idx, self._idx + num_tokens)
+        causal = query_positions[:, None] >= key_positions[None]
+        valid = key_positions[None] >= self.left_padding[:, None]
+        return (causal[None] & valid[:, None])[:, None]
+
+    def _encode(self, x: mx.array) -> Any:
+        return x
+
+    def update_and_fetch(self, keys, values):
+        keys, values = self._encode(keys), self._encode(values)
+        prev = self._idx
+        num_steps = _length(keys)
+        if self.keys is None or (prev + num_steps) > _length(self.keys):
+            capacity = (self.step + num_steps - 1) // self.step * self.step
+            new_k = _zeros_like(keys, self.size, capacity)
+            new_v = _zeros_like(values, self.size, capacity)
+            if self.keys is not None:
+                if prev % self.step != 0:
+                    self.keys = _map(lambda a: a[..., :prev, :], self.keys)
+                    self.values = _map(lambda a: a[..., :prev, :], self.values)
+                self.keys = _concatenate([self.keys, new_k], axis=2)
+                self.values = _concatenate([self.values, new_v], axis=2)
+            else:
+                self.keys, self.values = new_k, new_v
+
+        self.offset = self.offset + num_steps
+        self._idx += num_steps
+        for buffer, update in ((self.keys, keys), (self.values, values)):
+            if isinstance(buffer, (tuple, list)):
+                for b, u in zip(buffer, update):
+                    b[..., prev : self._idx, :] = u
+            else:
+                buffer[..., prev : self._idx, :] = update
+        return self.state
+
+    @property
+    def state(self):
+        return (
+            _map(lambda a: a[..., : self._idx, :], self.keys),
+            _map(lambda a: a[..., : self._idx, :], self.values),
+        )
+
+    def to_quantized(self, group_size: int = 64, bits: int = 4) -> "BatchKVCache":
+        """Return a quantized copy of the cache"""
+        quantized = BatchQuantizedKVCache([], group_size=group_size, bits=bits)
+        quantized.left_padding = self.left_padding
+        quantized.offset = self.offset
+        quantized._idx = self._idx
+        if self.keys is not None:
+            keys, values = self.state
+            quantized.keys = quantized._encode(keys)
+            quantized.values = quantized._encode(values)
+        return quantized
+
+
+class BatchQuantizedKVCache(BatchKVCache, QuantizedKVCache):
+    """
+    BatchKVCache whose rows are stored quantized
+
+    Keys and values are ``(packed, scales, biases)`` tuples as in mlx_lm's
+    QuantizedKVCache, which makes the model's attention use the quantized
+    kernels. Those add the mask to the scores, so the mask is additive.
+    """
+
+    def __init__(self, left_padding: List[int], group_size: int = 64, bits: int = 8):
+        super().__init__(left_padding)
+        self.group_size = group_size
+        self.bits = bits
+
+    def _encode(self, x: mx.array) -> Any:
+        return mx.quantize(x, group_size=self.group_size, bits=self.bits)
+
+    def _empty_single(self) -> QuantizedKVCache:
+        return QuantizedKVCache(group_size=self.group_size, bits=self.bits)
+
+    def make_mask(self, num_tokens: int) -> Optional[mx.array]:
+        if self.keys is None:
+            return None
+        # Quantized attention groups query heads per KV head, adding an axis
+        mask = super().make_mask(num_tokens)[:, None]
+        dtype = self.keys[1].dtype
+        return mx.where(mask, mx.array(0, dtype), mx.array(-mx.inf, dtype))
+
+    def to_quantized(self, group_size: int = 64, bits: int = 4) -> "BatchKVCache":
+        return self
+
+
+@dataclass
+class BatchResponse:
+    """One decoded token for one sequence of the batch"""
+
+    uid: int
+    token: int
+    logprobs: mx.array
+    finish_reason: Optional[str]
+    cache: Optional[List[Any]] = None
+
+
+@dataclass
+class _BatchRow:
+    uid: int
+    sampler: Callable[[mx.array], mx.array]
+    logits_processors: Optional[List[Callable[[mx.array, mx.array], mx.array]]]
+    max_tokens: int
+    tokens: Optional[mx.array] = None
+    generation_tokens: int = 0
+
+
+class BatchGenerator:
+    """
+    Decode engine that advances every active sequence by one token per step
+
+    Sequences are prefilled on their own and then inserted with the last prompt
+    token as their pending input. Rows join and leave between two steps. With
+    ``kv_bits`` set, the batch cache is quantized once it holds more than
+    ``quantized_kv_start`` tokens.
+    """
+
+    def __init__(
+        self,
+        model: nn.Module,
+        eos_token_ids: Iterable[int],
+        kv_bits: Optional[int] = None,
+        kv_group_size: int = 64,
+        quantized_kv_start: int = 0,
+    ):
+        self._model = model
+        self._eos_token_ids: Set[int] = set(eos_token_ids)
+        self._kv_bits = kv_bits
+        self._kv_group_size = kv_group_size
+        self._quantized_kv_start = quantized_kv_start
+        self._cache: Optional[List[BatchKVCache]] = None
+        self._rows: List[_BatchRow] = []
+        self._inputs: Optional[mx.array] = None
+
+    @property
+    def active(self) -> int:
+        return len(self._rows)
+
+    @property
+    def cache(self) -> List[BatchKVCache]:
+        return self._cache or []
+
+    def insert(
+        self,
+        uid: int,
+        prompt_cache: List[Any],
+        prompt: List[int],
+        sampler: Callable[[mx.array], mx.array],
+        logits_processors: Optional[List[Callable[[mx.array, mx.array], mx.array]]],
+        max_tokens: int,
+    ) -> None:
+        """
+        Add a prefilled sequence to the batch
+
+        Args:
+            uid: Identifier reported back in every BatchResponse
+            prompt_cache: Per-layer cache holding every prompt token but the last
+            prompt: The full prompt, its last token is the next decode input
+            sampler: Sampler for this sequence
+            logits_processors: Logits processors for this sequence
+            max_tokens: Maximum number of tokens to generate
+        """
+        row = _BatchRow(
+            uid=uid,
+            sampler=sampler,
+            logits_processors=logits_processors,
+            max_tokens=max_tokens,
+        )
+        if logits_processors:
+            row.tokens = mx.array(prompt[:-1], dtype=mx.uint32)
+
+        cache = [BatchKVCache.merge([c]) for c in prompt_cache]
+        last_token = mx.array(prompt[-1:], dtype=mx.uint32)
+        if self._cache is None:
+            self._cache = cache
+            self._inputs = last_token
+        else:
+            # Rows of one batch are either all quantized or all full precision
+            quantized = next(
+                (
+                    c
+                    for c in (cache[0], self._cache[0])
+                    if isinstance(c, BatchQuantizedKVCache)
+                ),
+                None,
+            )
+            if quantized is not None:
+                cache = [
+                    c.to_quantized(quantized.group_size, quantized.bits) for c in cache
+                ]
+                self._cache = [
+                    c.to_quantized(quantized.group_size, quantized.bits)
+                    for c in self._cache
+                ]
+            for batch_cache, new_cache in zip(self._cache, cache):
+                batch_cache.extend(new_cache)
+            self._inputs = mx.concatenate([self._inputs, last_token])
+        self._rows.append(row)
+        self._maybe_quantize()
+
+    def _maybe_quantize(self) -> None:
+        if (
+            self._kv_bits is None
+            or not self._cache
+            or isinstance(self._cache[0], BatchQuantizedKVCache)
+            or self._cache[0]._idx <= self._quantized_kv_start
+        ):
+            return
+        self._cache = [
+            c.to_quantized(group_size=self._kv_group_size, bits=self._kv_bits)
+            for c in self._cache
+        ]
+        logger.debug(
+            f"Quantized batch KV cache to {self._kv_bits} bits "
+            f"after {self._cache[0]._idx} tokens"
+        )
+
+    def extract(self, uid: int) -> List[Any]:
+        """
+        Copy one sequence out of the batch
+
+        Args:
+            uid: Identifier the sequence was inserted with
+
+        Returns:
+            List[Any]: Per-layer single sequence caches, holding the prompt and
+            every generated token but the last, which was never fed
+        """
+        row = next(i for i, r in enumerate(self._rows) if r.uid == uid)
+        return [c.extract(row) for c in self._cache]
+
+    def remove(self, uids: Iterable[int]) -> None:
+        """Drop the given sequences from the batch"""
+        uids = set(uids)
+        keep = [i for i, row in enumerate(self._rows) if row.uid not in uids]
+        if len(keep) == len(self._rows):
+            return
+        if not keep:
+            self.reset()
+            return
+
+        for c in self._cache:
+            c.filter(keep)
+        self._inputs = self._inputs[mx.array(keep, dtype=mx.int32)]
+        self._rows = [self._rows[i] for i in keep]
+
+    def reset(self) -> None:
+        self._cache = None
+        self._rows = []
+        self._inputs = None
+
+    def step(self, extract_finished: bool = False) -> List[BatchResponse]:
+        """
+        Run one batched decode step and retire the sequences that finished
+
+        Args:
+            extract_finished: Return the cache of every finished sequence with
+                its last response, see :meth:`extract`
+
+        Returns:
+            List[BatchResponse]: One response per sequence of the batch
+        """
+        if not self._rows:
+            return []
+
+        with mx.stream(generation_stream):
+            mask = self._cache[0].make_mask(1)
+            logits = self._model(self._inputs[:, None], mask=mask, cache=self._cache)
+            logits = logits[:, -1, :]
+            self._maybe_quantize()
+
+            if any(row.logits_processors for row in self._rows):
+                rows = []
+                for i, row in enumerate(self._rows):
+                    row_logits = logits[i : i + 1]
+                    if row.logits_processors:
+                        row.tokens = mx.concatenate(
+                            [row.tokens, self._inputs[i : i + 1]]
+                        )
+                        for processor in row.logits_processors:
+                            row_logits = processor(row.tokens, row_logits)
+                    rows.append(row_logits)
+                logits = mx.concatenate(rows, axis=0)
+
+            logprobs = logits - mx.logsumexp(logits, axis=-1, keepdims=True)
+            sampled = mx.concatenate(
+                [row.sampler(logprobs[i : i + 1]) for i, row in enumerate(self._rows)]
+            )
+        mx.eval(sampled, logprobs)
+        self._inputs = sampled.astype(mx.uint32)
+
+        responses = []
+        finished = []
+        for i, (row, token) in enumerate(zip(self._rows, sampled.tolist())):
+            row.generation_tokens += 1
+            finish_reason = None
+            if token in self._eos_token_ids:
+                finish_reason = "stop"
+            elif row.generation_tokens >= row.max_tokens:
+                finish_reason = "length"
+            cache = None
+            if finish_reason is not None:
+                finished.append(row.uid)
+                if extract_finished:
+                    cache = self.extract(row.uid)
+            responses.append(
+                BatchResponse(
+                    uid=row.uid,
+                    token=token,
+                    logprobs=logprobs[i],
+                    finish_reason=finish_reason,
+                    cache=cache,
+                )
+            )
+
+        self.remove(finished)
+        return responses
@@ -0,0 +1,82 @@
+"""
+Incremental Detokenizer Module
+
+This module turns a stream of generated token ids into text without decoding
+the whole completion on every step. Only a short window of tokens around the
+read position is decoded, so the per-token cost does not grow with the length
+of the completion.
+"""
+
+from typing import List
+
+REPLACEMENT_CHAR = "�"
+
+
+class IncrementalDetokenizer:
+    """
+    Streaming detokenizer that decodes only the newly generated tail
+
+    Each step decodes the tokens from ``prefix_offset`` up to the end twice,
+    once without and once with the unread tokens, and emits the difference.
+    Keeping the already emitted prefix tokens in the window gives the tokenizer
+    the context it needs at merge boundaries, such as the leading space that
+    SentencePiece tokenizers drop at the start of a decode. Text that ends in
+    an incomplete UTF-8 sequence is held back until the sequence completes.
+
+    Attributes:
+        tokens: Every token added so far
+    """
+
+    def __init__(self, tokenizer):
+        self._tokenizer = tokenizer
+        self.tokens: List[int] = []
+        self._segments: List[str] = []
+        self._prefix_offset = 0
+        self._read_offset = 0
+
+    @property
+    def text(self) -> str:
+        """Text emitted so far"""
+        return "".join(self._segments)
+
+    def add_token(self, token: int) -> str:
+        """
+        Add one token and return the text it completes
+
+        Args:
+            token: Generated token id
+
+        Returns:
+            str: Newly completed text, empty while a character is still partial
+        """
+        self.tokens.append(token)
+        return self._emit(final=False)
+
+    def flush(self) -> str:
+        """
+        Return any text held back for an incomplete character
+
+        Returns:
+            str: The remaining text, decoded as the full decode would
+        """
+        return self._emit(final=True)
+
+    def _emit(self, final: bool) -> str:
+        if self._read_offset == len(self.tokens):
+            return ""
+
+        prefix_text = self._tokenizer.decode(
+            self.tokens[self._prefix_offset : self._read_offset]
+        )
+        new_text = self._tokenizer.decode(self.tokens[self._prefix_offset :])
+
+        if not final and (
+            len(new_text) <= len(prefix_text) or new_text.endswith(REPLACEMENT_CHAR)
+        ):
+            return ""
+
+        delta = new_text[len(prefix_text) :]
+        self._prefix_offset = self._read_offset
+        self._read_offset = len(self.tokens)
+        self._segments.append(delta)
+        return delta
@@ -0,0 +1,127 @@
+"""
+Logprobs Module
+
+This module formats the logprobs of generated tokens for chat completions. The
+text and UTF-8 bytes of every token in the vocabulary are decoded once per
+tokenizer, and the chosen and top logprobs are picked on the device and copied
+to Python for a window of tokens at a time, so a logprobs request only adds a
+small fixed cost per token.
+"""
+
+import time
+from typing import Any, Dict, List, Optional
+
+import mlx.core as mx
+
+from ...utils.logger import logger
+
+# Tokens whose logprobs are converted at once when nobody waits for them
+LOGPROBS_WINDOW = 16
+
+
+class TokenTable:
+    """
+    Text and UTF-8 bytes of every token of a vocabulary
+
+    Attributes:
+        strings: Text of each token ID, as decoding it alone gives
+        bytes: UTF-8 encoding of each of those texts
+    """
+
+    def __init__(self, tokenizer):
+        start = time.perf_counter()
+        self._tokenizer = tokenizer
+        size = max(tokenizer.get_vocab().values()) + 1
+        self.strings: List[str] = tokenizer.batch_decode([[i] for i in range(size)])
+        self.bytes: List[bytes] = [s.encode("utf-8") for s in self.strings]
+        logger.debug(
+            f"Decoded {size} vocabulary tokens in {time.perf_counter() - start:.2f}s"
+        )
+
+    def entry(self, token: int, logprob: float) -> Dict[str, Any]:
+        """
+        Logprob of one token in the OpenAI format
+
+        Args:
+            token: Token ID
+            logprob: Its log probability
+
+        Returns:
+            Dict[str, Any]: The token's text, logprob and bytes
+        """
+        if token < len(self.strings):
+            text, data = self.strings[token], self.bytes[token]
+        else:
+            # Models may pad their output layer past the tokenizer's vocabulary
+            text = self._tokenizer.decode([token])
+            data = text.encode("utf-8")
+        return {"token": text, "logprob": logprob, "bytes": list(data)}
+
+
+class LogprobsBuffer:
+    """
+    Logprobs of generated tokens waiting to be copied to Python
+
+    Each added token only queues device work that keeps the chosen logprob and
+    the top ones, so the full vocabulary logprobs of earlier steps aren't held.
+    :meth:`flush` then copies all queued tokens at once.
+    """
+
+    def __init__(self, table: TokenTable, top_k: Optional[int] = None):
+        self._table = table
+        self._top_k = top_k or 0
+        self._tokens: List[int] = []
+        self._values: List[mx.array] = []
+        self._indices: List[mx.array] = []
+
+    def __len__(self) -> int:
+        return len(self._tokens)
+
+    def add(self, token: int, logprobs: mx.array) -> None:
+        """
+        Queue the logprobs of a generated token
+
+        Args:
+            token: The generated token ID
+            logprobs: Logprobs over the vocabulary at its step
+        """
+        values = logprobs[token : token + 1]
+        if self._top_k:
+            indices = mx.argpartition(-logprobs, kth=self._top_k - 1)[: self._top_k]
+            top = logprobs[indices]
+            order = mx.argsort(-top)
+            indices = indices[order]
+            values = mx.concatenate([values, top[order]])
+            mx.async_eval(values, indices)
+            self._indices.append(indices)
+        else:
+            mx.async_eval(values)
+        self._tokens.append(token)
+        self._values.append(values)
+
+    def flush(self) -> List[Dict[str, Any]]:
+        """
+        Convert every queued token
+
+        Returns:
+            List[Dict[str, Any]]: Logprobs of each token in the OpenAI format,
+            with its ``top_logprobs`` sorted by logprob
+        """
+        if not self._tokens:
+            return []
+        values = mx.stack(self._values).tolist()
+        indices = mx.stack(self._indices).tolist() if self._top_k else None
+        entries = []
+        for i, token in enumerate(self._tokens):
+            top_logprobs = []
+            if indices is not None:
+                top_logprobs = [
+                    self._table.entry(index, value)
+                    for index, value in zip(indices[i], values[i][1:])
+                ]
+            entry = self._table.entry(token, values[i][0])
+            entries.append({**entry, "top_logprobs": top_logprobs})
+        self._tokens.clear()
+        self._values.clear()
+        self._indices.clear()
+        return entries
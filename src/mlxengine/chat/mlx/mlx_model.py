@@ -1,13 +1,17 @@
+import bisect
+import threading
 import time
 import uuid
-from typing import Any, Dict, Generator, List, Optional
+from dataclasses import replace
+from functools import partial
+from typing import Any, Callable, Dict, Generator, Iterator, List, Optional, Tuple
 
 import mlx.core as mx
 import mlx.nn as nn
 from mlx_lm.generate import GenerationResponse, stream_generate
-from mlx_lm.sample_utils import make_logits_processors, make_sampler
-from mlx_lm.tokenizer_utils import TokenizerWrapper
+from mlx_lm.models.cache import make_prompt_cache
 
+from ...utils.admission import INTERACTIVE, check_priority, make_deadline
 from ...utils.logger import logger
 from ..schema import (
     ChatCompletionChoice,
@@ -16,30 +20,101 @@ from ..schema import (
     ChatCompletionRequest,
     ChatCompletionResponse,
     ChatCompletionUsage,
+    ChatCompletionUsageDetails,
     ChatMessage,
+    Function,
+    FunctionParameters,
+    PromptTokensDetails,
     Role,
+    Tool,
 )
 from ..text_models import BaseTextModel, GenerateResult
+from .detokenizer import IncrementalDetokenizer
+from .logprobs import LOGPROBS_WINDOW, LogprobsBuffer, TokenTable
 from .outlines_logits_processor import OutlinesLogitsProcessor
-from .prompt_cache import PromptCache, process_prompt_cache, update_prompt_cache
-from .stop_tokens_checker import StopTokensChecker
+from .penalty_logits_processor import PenaltyLogitsProcessor
+from .prompt_cache import PromptCache, prefill_prompt_cache, process_prompt_cache
+from .prompt_lookup import prompt_lookup_generate
+from .radix_cache import RadixTree, is_sliceable
+from .sampler import make_seeded_samplers, random_seed
+from .scheduler import ContinuousBatchScheduler, SequenceHandle
+from .snapshots import (
+    SnapshotKey,
+    adapter_revision,
+    load_snapshot,
+    save_snapshot,
+    snapshot_path,
+)
+from .spill_cache import SpillStore
+from .stop_matcher import StopMatcher
 from .tools.chat_tokenizer import ChatTokenizer
 
 
 class MLXModel(BaseTextModel):
     """MLX Chat Model wrapper with internal parameter management"""
 
-    def __init__(self, model_id: str, model: nn.Module, tokenizer: ChatTokenizer):
+    def __init__(
+        self,
+        model_id: str,
+        model: nn.Module,
+        tokenizer: ChatTokenizer,
+        draft_model_id: Optional[str] = None,
+        num_draft_tokens: int = 3,
+        allowed_draft_models: Optional[List[str]] = None,
+        prefill_step_size: int = 512,
+        kv_bits: Optional[int] = None,
+        kv_group_size: int = 64,
+        quantized_kv_start: int = 0,
+        max_kv_size: Optional[int] = None,
+        attention_sink_tokens: int = 4,
+        prompt_cache_bytes: int = 2 * 1024**3,
+        prompt_cache_spill_bytes: int = 0,
+        prompt_cache_spill_bits: Optional[int] = None,
+        prompt_cache_spill_dir: Optional[str] = None,
+        request_timeout: Optional[float] = None,
+        revision: str = "",
+        adapter_path: Optional[str] = None,
+    ):
         self._model_id = model_id
+        self._revision = revision
+        self._adapter_path = adapter_path
+        self._prefill_step_size = prefill_step_size
         self._model: nn.Module = model
+        self._draft_model_id = draft_model_id
+        self._num_draft_tokens = num_draft_tokens
+        # Draft models requests may pick, besides the model's own
+        self._allowed_draft_models = set(allowed_draft_models or [])
+        if draft_model_id:
+            self._allowed_draft_models.add(draft_model_id)
+        self._kv_params = {
+            "kv_bits": kv_bits,
+            "kv_group_size": kv_group_size,
+            "quantized_kv_start": quantized_kv_start,
+        }
+        self._max_kv_size = max_kv_size
+        self._attention_sink_tokens = attention_sink_tokens
         self._default_max_tokens = 2048
         self._default_temperature = 1.0
         self._default_top_p = 1.0
         self._default_top_k = -1
+        self._request_timeout = request_timeout
         self._chat_tokenizer = tokenizer
-        self._prompt_cache = PromptCache()
-        self._cached_token_count = (
-            0  # Track the number of cached tokens used in the current request
+        self._token_table: Optional[TokenTable] = None
+        spill = None
+        if prompt_cache_spill_bytes > 0:
+            spill = SpillStore(
+                prompt_cache_spill_bytes,
+                directory=prompt_cache_spill_dir,
+                bits=prompt_cache_spill_bits,
+            )
+        self._prompt_cache = PromptCache(tree=RadixTree(prompt_cache_bytes, spill))
+        self._scheduler = ContinuousBatchScheduler(
+            model_key=self._cache_key(self._kv_params),
+            model=model,
+            tokenizer=tokenizer.tokenizer,
+            prompt_cache=self._prompt_cache,
+            prefill_step_size=prefill_step_size,
+            **self._kv_params,
         )
         logger.info(f"Initialized MLXModel with model_id: {model_id}")
 
@@ -50,177 +125,699 @@ class MLXModel(BaseTextModel):
             "min_tokens_to_keep",
             "min_p",
             "adapter_path",
+            "priority",
+            "timeout",
         }
-        return {k: v for k, v in params.items() if k not in known_params}
+        params = {k: v for k, v in params.items() if k not in known_params}
+
+        # KV cache settings matching the model's own keep the request batchable
+        defaults = {**self._kv_params, "max_kv_size": self._max_kv_size}
+        for key, value in defaults.items():
+            if params.get(key, value) == value:
+                params.pop(key, None)
+
+        # Prompt lookup is opted into per request and replaces the draft model
+        if params.get("prompt_lookup_num_tokens"):
+            params.pop("draft_model", None)
+            params.pop("num_draft_tokens", None)
+            return params
+        params.pop("prompt_lookup_num_tokens", None)
+        params.pop("max_matching_ngram_size", None)
+
+        # A request can pick its own draft model, or turn speculative decoding
+        # off with an empty one
+        draft_model_id = params.pop("draft_model", self._draft_model_id)
+        if draft_model_id:
+            params["draft_model"] = draft_model_id
+            params.setdefault("num_draft_tokens", self._num_draft_tokens)
+        else:
+            params.pop("num_draft_tokens", None)
+        return params
+
+    def _runs_exclusive(self, params: Dict[str, Any]) -> bool:
+        """Whether a request runs alone through mlx_lm's own loop"""
+        # Extra generation params are only understood by mlx_lm's own loop, and
+        # the batched cache can't rotate, so bounded models run one at a time
+        return (
+            bool(params)
+            or self._max_kv_size is not None
+            or not self._scheduler.batching_enabled
+        )
+
+    def check_request(self, request: ChatCompletionRequest) -> None:
+        params = self._get_generation_params(request)
+        # Loading any model a client names would let it fill the disk and memory
+        draft_model_id = params.get("draft_model")
+        if draft_model_id and draft_model_id not in self._allowed_draft_models:
+            raise ValueError(
+                f"Draft model '{draft_model_id}' is not allowed for {self._model_id}"
+            )
+        # mlx_lm's loop generates a single sequence, choices would each run the
+        # whole generation one after another
+        if (request.n or 1) > 1 and self._runs_exclusive(params):
+            raise ValueError(
+                "n > 1 is not supported with extra generation params, a bounded "
+                "KV cache or a model that can't be batched"
+            )
+
+    def _get_draft_model(self, draft_model_id: str) -> nn.Module:
+        from .models import load_draft_model
 
-    def _get_prompt_cache(self, prompt: List[int]) -> List[int]:
-        processed_prompt, cached_token_count = process_prompt_cache(
-            prompt, self._prompt_cache, self._model_id, self._model
+        return load_draft_model(draft_model_id)
+
+    def _cache_key(
+        self, kv_params: Dict[str, Any], max_kv_size: Optional[int] = None
+    ) -> str:
+        """Prompt cache key, a cache quantized or bounded differently can't be reused"""
+        key = self._model_id
+        if kv_params.get("kv_bits") is not None:
+            key += (
+                f"#kv{kv_params['kv_bits']}"
+                f"g{kv_params['kv_group_size']}s{kv_params['quantized_kv_start']}"
+            )
+        if max_kv_size is not None:
+            key += f"#window{max_kv_size}sink{self._attention_sink_tokens}"
+        return key
+
+    def _snapshot_key(self) -> SnapshotKey:
+        return SnapshotKey(
+            model_id=self._model_id,
+            revision=self._revision,
+            adapter=adapter_revision(self._adapter_path),
+            cache_key=self._cache_key(self._kv_params),
         )
 
-        self._cached_token_count = cached_token_count
-        return processed_prompt
+    def _encode_prompt(
+        self,
+        messages: List[Dict[str, Any]],
+        tools: Optional[List[Dict[str, Any]]] = None,
+    ) -> List[int]:
+        """Tokens of a prompt given in the chat request format"""
+        typed_tools = None
+        if tools:
+            typed_tools = []
+            for tool in tools:
+                function = dict(tool["function"])
+                if isinstance(function.get("parameters"), dict):
+                    function["parameters"] = FunctionParameters(
+                        **function["parameters"]
+                    )
+                typed_tools.append(Tool(**{**tool, "function": Function(**function)}))
+        prompt = self._chat_tokenizer.encode(
+            messages=[ChatMessage(**message) for message in messages],
+            tools=typed_tools,
+        )
+        return self._chat_tokenizer.tokenizer.encode(prompt)
 
-    def _process_logprobs(
+    def _prefill(
         self,
-        tokenizer: TokenizerWrapper,
-        response: GenerationResponse,
-        top_k: Optional[int],
-    ) -> Optional[Dict[str, Any]]:
-        """Process logprobs information from generation response to match OpenAI format"""
-        current_token = response.token
-        current_logprobs = response.logprobs
-
-        # Get current token info
-        token_str = tokenizer.decode([current_token])
-        token_logprob = current_logprobs[current_token].item()
-        token_bytes = token_str.encode("utf-8")
-
-        # Base token info
-        token_info = {
-            "token": token_str,
-            "logprob": token_logprob,
-            "bytes": list(token_bytes),
-        }
+        tokens: List[int],
+        kv_params: Dict[str, Any],
+        draft_model_id: Optional[str] = None,
+        max_kv_size: Optional[int] = None,
+    ) -> int:
+        """
+        Feed ``tokens`` into the prompt cache, reusing what it already holds
+
+        Returns:
+            int: Number of tokens that were already cached
+        """
+        remaining, cached_tokens = self._get_prompt_cache(
+            tokens, kv_params, draft_model_id, max_kv_size
+        )
+        cache = self._prompt_cache.cache
+        targets = [(self._model, cache)]
+        if draft_model_id is not None:
+            # The draft model's layers follow the model's own
+            draft_model = self._get_draft_model(draft_model_id)
+            split = len(cache) - len(make_prompt_cache(draft_model))
+            targets = [(self._model, cache[:split]), (draft_model, cache[split:])]
+        for model, layers in targets:
+            for start in range(0, len(remaining), self._prefill_step_size):
+                prefill_prompt_cache(
+                    model,
+                    layers,
+                    remaining[start : start + self._prefill_step_size],
+                    **kv_params,
+                )
+        return cached_tokens
+
+    def _prefill_snapshot(self, name: str, tokens: List[int]) -> Dict[str, Any]:
+        """Prefill ``tokens`` into the prompt cache and save them as a snapshot"""
+        cached_tokens = self._prefill(tokens, self._kv_params)
+        logger.info(
+            f"Prefilled {len(tokens) - cached_tokens} tokens for prompt snapshot "
+            f"'{name}', {cached_tokens} were cached"
+        )
+        if not is_sliceable(self._prompt_cache.cache):
+            raise ValueError(f"Model {self._model_id} can't snapshot its KV cache")
+        info = save_snapshot(
+            self._snapshot_key(), name, tokens, self._prompt_cache.cache
+        )
+        self._insert_snapshot(tokens, self._prompt_cache.cache)
+        return info
+
+    def _insert_snapshot(self, tokens: List[int], cache: List[Any]) -> None:
+        self._prompt_cache.tree.insert(
+            self._cache_key(self._kv_params), tokens, cache, pin=True
+        )
+
+    def _check_snapshots_supported(self, name: str) -> None:
+        if self._max_kv_size is not None:
+            raise ValueError("Prompt snapshots need an unbounded KV cache")
+        snapshot_path(self._snapshot_key(), name)
+
+    def save_snapshot(
+        self,
+        name: str,
+        messages: List[Dict[str, Any]],
+        tools: Optional[List[Dict[str, Any]]] = None,
+    ) -> Dict[str, Any]:
+        """
+        Prefill a prompt, save its KV cache to disk and keep it cached
+
+        The snapshot stays in the prompt cache for good, and requests whose
+        prompt starts with it skip its prefill.
+
+        Args:
+            name: Snapshot name
+            messages: Chat messages making up the prompt, usually the system one
+            tools: Tools the prompt describes, in the chat request format
+
+        Returns:
+            Dict[str, Any]: Description of the saved snapshot
+        """
+        self._check_snapshots_supported(name)
+        tokens = self._encode_prompt(messages, tools)
+        return self._scheduler.call_exclusive(
+            partial(self._prefill_snapshot, name, tokens)
+        )
+
+    def load_snapshot(self, name: str) -> Dict[str, Any]:
+        """
+        Load a snapshot saved for this model into the prompt cache
+
+        Raises:
+            FileNotFoundError: If the model has no snapshot of that name
+            ValueError: If the snapshot was made with other weights or settings
+        """
+        self._check_snapshots_supported(name)
+        tokens, cache = load_snapshot(self._snapshot_key(), name)
+        self._scheduler.call_exclusive(partial(self._insert_snapshot, tokens, cache))
+        return {"name": name, "model": self._model_id, "tokens": len(tokens)}
 
-        # Process top logprobs
-        top_logprobs = []
-        if top_k is not None:
-            # Get indices of top_k tokens
-            top_indices = mx.argpartition(-current_logprobs, kth=top_k - 1)[:top_k]
-            top_probs = current_logprobs[top_indices]
-
-            # Create detailed token information for each top token
-            for idx, logprob in zip(top_indices.tolist(), top_probs.tolist()):
-                token = tokenizer.decode([idx])
-                token_bytes = token.encode("utf-8")
-                top_logprobs.append(
-                    {"token": token, "logprob": logprob, "bytes": list(token_bytes)}
+    def restore_snapshot(
+        self,
+        name: str,
+        messages: List[Dict[str, Any]],
+        tools: Optional[List[Dict[str, Any]]] = None,
+    ) -> Dict[str, Any]:
+        """
+        Load a snapshot, saving it first if it is missing or its prompt changed
+
+        Args:
+            name: Snapshot name
+            messages: Chat messages making up the prompt
+            tools: Tools the prompt describes
+
+        Returns:
+            Dict[str, Any]: Description of the snapshot
+        """
+        self._check_snapshots_supported(name)
+        tokens = self._encode_prompt(messages, tools)
+        try:
+            saved_tokens, cache = load_snapshot(self._snapshot_key(), name)
+        except (FileNotFoundError, ValueError) as e:
+            logger.info(f"Recreating prompt snapshot '{name}': {str(e)}")
+        else:
+            if saved_tokens == tokens:
+                self._scheduler.call_exclusive(
+                    partial(self._insert_snapshot, tokens, cache)
                 )
+                return {"name": name, "model": self._model_id, "tokens": len(tokens)}
+            logger.info(f"Recreating prompt snapshot '{name}' for its new prompt")
+        return self._scheduler.call_exclusive(
+            partial(self._prefill_snapshot, name, tokens)
+        )
+
+    def warm_up(
+        self,
+        messages: List[Dict[str, Any]],
+        tools: Optional[List[Dict[str, Any]]] = None,
+    ) -> Tuple[int, int]:
+        """
+        Prefill a prompt into the prompt cache ahead of the requests using it
+
+        The prompt is cached under the model's default settings, the way a chat
+        request without extra parameters would use it.
+
+        Args:
+            messages: Chat messages making up the prompt
+            tools: Tools the prompt describes, in the chat request format
+
+        Returns:
+            Tuple[int, int]: Tuple containing:
+                1. Number of prompt tokens
+                2. Number of them that were already cached
+        """
+        tokens = self._encode_prompt(messages, tools)
+        kv_params = dict(self._kv_params)
+        # Same fallbacks as requests running outside the batch
+        draft_model_id = self._draft_model_id
+        if self._max_kv_size is not None:
+            draft_model_id = None
+            kv_params["kv_bits"] = None
+        if draft_model_id is not None:
+            kv_params["kv_bits"] = None
+        cached_tokens = self._scheduler.call_exclusive(
+            partial(self._prefill, tokens, kv_params, draft_model_id, self._max_kv_size)
+        )
+        return len(tokens), cached_tokens
 
-        return {**token_info, "top_logprobs": top_logprobs}
+    def _get_prompt_cache(
+        self,
+        prompt: List[int],
+        kv_params: Dict[str, Any],
+        draft_model_id: Optional[str] = None,
+        max_kv_size: Optional[int] = None,
+    ) -> Tuple[List[int], int]:
+        model_key = self._cache_key(kv_params, max_kv_size)
+        if draft_model_id is None:
+            return process_prompt_cache(
+                prompt,
+                self._prompt_cache,
+                model_key,
+                self._model,
+                max_kv_size=max_kv_size,
+                attention_sink_tokens=self._attention_sink_tokens,
+            )
+
+        # Speculative decoding keeps the draft model's layers after the model's own
+        return process_prompt_cache(
+            prompt,
+            self._prompt_cache,
+            f"{model_key}+{draft_model_id}",
+            self._model,
+            draft_model=self._get_draft_model(draft_model_id),
+        )
+
+    def _sequential_generate(
+        self,
+        handle: SequenceHandle,
+        prompt: List[int],
+        max_tokens: int,
+        sampler,
+        logits_processors,
+        params: Dict[str, Any],
+    ) -> Iterator[GenerationResponse]:
+        """Run mlx_lm's own generation loop for requests the batch engine can't serve"""
+        params = {**self._kv_params, **params}
+        draft_model_id = params.pop("draft_model", None)
+        max_kv_size = params.pop("max_kv_size", self._max_kv_size)
+        if max_kv_size is not None:
+            # mlx_lm can neither quantize a rotating cache nor rewind it once it
+            # wrapped around, which rejected drafts need
+            if draft_model_id:
+                logger.warning("Ignoring draft_model with a bounded KV cache")
+                draft_model_id = None
+                params.pop("num_draft_tokens", None)
+            if params["kv_bits"] is not None:
+                logger.warning("Ignoring kv_bits with a bounded KV cache")
+                params["kv_bits"] = None
+        if draft_model_id and params["kv_bits"] is not None:
+            # mlx_lm verifies drafts with the "causal" mask shortcut, which its
+            # quantized attention can't apply
+            logger.warning("KV cache quantization is not supported with a draft model")
+            params["kv_bits"] = None
+        kv_params = {key: params[key] for key in self._kv_params}
+        processed_prompt, handle.cached_tokens = self._get_prompt_cache(
+            prompt, kv_params, draft_model_id, max_kv_size
+        )
+        logger.debug(
+            f"Using {handle.cached_tokens} cached tokens out of {len(prompt)} total tokens"
+        )
+
+        num_lookup_tokens = params.pop("prompt_lookup_num_tokens", None)
+        if num_lookup_tokens:
+            max_ngram_size = params.pop("max_matching_ngram_size", 3)
+            prefill_step_size = params.pop("prefill_step_size", 2048)
+            for key in kv_params:
+                params.pop(key)
+            if params:
+                logger.warning(f"Ignoring {sorted(params)} for prompt lookup decoding")
+            return prompt_lookup_generate(
+                self._model,
+                self._chat_tokenizer.tokenizer,
+                prompt=processed_prompt,
+                context=prompt,
+                prompt_cache=self._prompt_cache.cache,
+                num_draft_tokens=num_lookup_tokens,
+                max_ngram_size=max_ngram_size,
+                max_tokens=max_tokens,
+                sampler=sampler,
+                logits_processors=logits_processors,
+                prefill_step_size=prefill_step_size,
+                on_verify=handle.record_draft,
+                **kv_params,
+            )
+
+        num_prompt_tokens = len(processed_prompt)
+        if kv_params["kv_bits"] is not None:
+            # mlx_lm prefills a quantized cache with the same mask shortcut, so
+            # it is only left the last prompt token
+            prefill_step_size = params.get("prefill_step_size", 2048)
+            for i in range(0, num_prompt_tokens - 1, prefill_step_size):
+                prefill_prompt_cache(
+                    self._model,
+                    self._prompt_cache.cache,
+                    processed_prompt[
+                        i : min(i + prefill_step_size, num_prompt_tokens - 1)
+                    ],
+                    **kv_params,
+                )
+            processed_prompt = processed_prompt[-1:]
+
+        responses = stream_generate(
+            model=self._model,
+            tokenizer=self._chat_tokenizer.tokenizer,
+            prompt=processed_prompt,
+            draft_model=(
+                self._get_draft_model(draft_model_id) if draft_model_id else None
+            ),
+            max_tokens=max_tokens,
+            sampler=sampler,
+            logits_processors=logits_processors,
+            prompt_cache=self._prompt_cache.cache,
+            **params,
+        )
+        if kv_params["kv_bits"] is not None:
+            return self._with_prompt_tokens(responses, num_prompt_tokens)
+        if not draft_model_id:
+            return responses
+        return self._count_draft_tokens(
+            handle, responses, params["num_draft_tokens"], max_tokens
+        )
+
+    @staticmethod
+    def _with_prompt_tokens(
+        responses: Iterator[GenerationResponse], prompt_tokens: int
+    ) -> Iterator[GenerationResponse]:
+        """Report the prompt tokens prefilled before mlx_lm took over"""
+        try:
+            for response in responses:
+                yield replace(response, prompt_tokens=prompt_tokens)
+        finally:
+            responses.close()
+
+    @staticmethod
+    def _count_draft_tokens(
+        handle: SequenceHandle,
+        responses: Iterator[GenerationResponse],
+        num_draft_tokens: int,
+        max_tokens: int,
+    ) -> Iterator[GenerationResponse]:
+        """Tally accepted and rejected draft tokens of each verification round
+
+        A round yields the accepted draft tokens followed by one token from the
+        model, and drafts at most ``num_draft_tokens`` tokens.
+        """
+        generated = 0
+        accepted = 0
+        try:
+            for response in responses:
+                if response.finish_reason is None:
+                    if response.from_draft:
+                        accepted += 1
+                    else:
+                        round_start = generated - accepted
+                        drafted = min(num_draft_tokens, max_tokens - round_start)
+                        handle.record_draft(drafted, accepted)
+                        accepted = 0
+                    generated += 1
+                else:
+                    # The last round was cut short by max_tokens
+                    handle.record_draft(accepted, accepted)
+                    accepted = 0
+                yield response
+        finally:
+            responses.close()
+
+    def _get_token_table(self) -> TokenTable:
+        """Vocabulary strings for logprobs, decoded on first use"""
+        if self._token_table is None:
+            self._token_table = TokenTable(self._chat_tokenizer.tokenizer)
+        return self._token_table
+
+    @staticmethod
+    def _with_logprobs(
+        results: List[GenerateResult], logprobs: Optional[LogprobsBuffer]
+    ) -> Iterator[GenerateResult]:
+        """Yield results held back for their logprobs, which arrive in bulk"""
+        if logprobs is not None:
+            for result, entry in zip(results, logprobs.flush()):
+                result.logprobs = entry
+        yield from results
+        results.clear()
+
+    def _make_logits_processors(
+        self, request: ChatCompletionRequest
+    ) -> Optional[List[Callable[[mx.array, mx.array], mx.array]]]:
+        processors = []
+        if request.logit_bias or request.presence_penalty or request.frequency_penalty:
+            processors.append(
+                PenaltyLogitsProcessor(
+                    request.logit_bias,
+                    request.presence_penalty,
+                    request.frequency_penalty,
+                )
+            )
+        # The schema mask goes last, so a bias can't bring back a masked token
+        if request.response_format and request.response_format.json_schema:
+            processors.append(
+                OutlinesLogitsProcessor(
+                    self._chat_tokenizer.tokenizer, request.response_format
+                )
+            )
+        return processors or None
+
+    def _stream_choice(
+        self,
+        index: int,
+        handle: SequenceHandle,
+        request: ChatCompletionRequest,
+        stops: List[str],
+        logprobs_window: int = 1,
+    ) -> Generator[GenerateResult, None, None]:
+        tokenizer = self._chat_tokenizer.tokenizer
+        detokenizer = IncrementalDetokenizer(tokenizer)
+        stop_matcher = StopMatcher(stops) if stops else None
+        # Characters decoded after each token, to find the tokens before a stop
+        decoded_lengths: List[int] = []
+        logprobs = None
+        if request.logprobs:
+            logprobs = LogprobsBuffer(self._get_token_table(), request.top_logprobs)
+        # Results waiting for the logprobs of their token
+        pending: List[GenerateResult] = []
+
+        for response in handle:
+            finish_reason = response.finish_reason
+            if finish_reason is None:
+                if logprobs is not None:
+                    logprobs.add(response.token, response.logprobs)
+                delta_text = detokenizer.add_token(response.token)
+                decoded_lengths.append(
+                    len(delta_text) + (decoded_lengths[-1] if decoded_lengths else 0)
+                )
+            else:
+                # Release whatever was held back for an incomplete character
+                delta_text = detokenizer.flush()
+
+            if stop_matcher is not None:
+                delta_text, stopped = stop_matcher.feed(delta_text)
+                if stopped:
+                    # The stop string and the tokens it spans aren't kept
+                    finish_reason = "stop"
+                    handle.keep_tokens(
+                        bisect.bisect_right(decoded_lengths, stop_matcher.released)
+                    )
+                elif finish_reason is not None:
+                    delta_text += stop_matcher.flush()
+
+            if finish_reason is not None:
+                result = GenerateResult(
+                    text=delta_text,
+                    token=response.token,
+                    finish_reason=finish_reason,
+                    prompt_tokens=response.prompt_tokens,
+                    generation_tokens=response.generation_tokens,
+                    cached_tokens=handle.cached_tokens,
+                    index=index,
+                    accepted_prediction_tokens=handle.accepted_draft_tokens,
+                    rejected_prediction_tokens=handle.rejected_draft_tokens,
+                )
+                if response.finish_reason is None:
+                    # The token completing a stop string carries its logprobs
+                    pending.append(result)
+                    yield from self._with_logprobs(pending, logprobs)
+                else:
+                    yield from self._with_logprobs(pending, logprobs)
+                    yield result
+                return
+
+            if delta_text or logprobs is not None:
+                pending.append(
+                    GenerateResult(
+                        text=delta_text,
+                        token=response.token,
+                        finish_reason=None,
+                        prompt_tokens=response.prompt_tokens,
+                        generation_tokens=response.generation_tokens,
+                        cached_tokens=handle.cached_tokens,
+                        index=index,
+                    )
+                )
+                if logprobs is None or len(pending) >= logprobs_window:
+                    yield from self._with_logprobs(pending, logprobs)
 
     def _stream_generate(
         self,
         prompt: str,
         request: ChatCompletionRequest,
-    ) -> Generator[GenerationResponse, None, None]:
+        seed: int,
+        logprobs_window: int = 1,
+        abort: Optional[threading.Event] = None,
+        deadline: Optional[float] = None,
+    ) -> Generator[GenerateResult, None, None]:
+        """
+        Generate the choices of a request, reading them round-robin
+
+        Args:
+            prompt: The encoded chat prompt
+            request: The chat completion request
+            seed: Seed of the random streams the choices are sampled from
+            logprobs_window: Number of tokens whose logprobs are converted at
+                once, results are held back until their window is full
+            abort: Event that stops the generation once set, within a step
+            deadline: When to stop generating, on the ``time.monotonic``
+                clock, choices then end with what they generated so far and a
+                ``length`` finish reason. Defaults to the request's
+                ``timeout`` extra param, or the model's request timeout
+        """
+        handles = []
+        choices = []
         try:
             params = self._get_generation_params(request)
-
-            tokenizer = self._chat_tokenizer.tokenizer
-            stop_checker = None
-            if request.stop:
-                stop_checker = StopTokensChecker(
-                    stop_words=request.stop,
-                    tokenizer=tokenizer,
+            priority = check_priority(
+                request.get_extra_params().get("priority", INTERACTIVE)
+            )
+            if deadline is None:
+                deadline = make_deadline(
+                    request.get_extra_params().get("timeout", self._request_timeout)
                 )
 
-            logits_processors = None
-            if request.response_format and request.response_format.json_schema:
-                logits_processors = [
-                    OutlinesLogitsProcessor(
-                        self._chat_tokenizer.tokenizer, request.response_format
-                    )
-                ]
-            else:
-                if request.presence_penalty:
-                    logits_processors = make_logits_processors(
-                        repetition_penalty=request.presence_penalty
-                    )
+            tokenizer = self._chat_tokenizer.tokenizer
+            stops = [request.stop] if isinstance(request.stop, str) else request.stop
 
-            current_tokens = []
-            last_text = ""
+            # Logits processors can be stateful, so every choice gets its own
+            n = request.n or 1
+            logits_processors = [
+                self._make_logits_processors(request) for _ in range(n)
+            ]
 
             max_completion_tokens = (
                 request.max_completion_tokens
                 or request.max_tokens
                 or self._default_max_tokens
             )
-            sampler = make_sampler(
-                temp=request.temperature or self._default_temperature,
-                top_p=request.top_p or self._default_top_p,
+            samplers = make_seeded_samplers(
+                seed,
+                n,
+                temp=(
+                    request.temperature
+                    if request.temperature is not None
+                    else self._default_temperature
+                ),
+                top_p=(
+                    request.top_p if request.top_p is not None else self._default_top_p
+                ),
                 min_p=params.get("min_p", 0.0),
                 min_tokens_to_keep=params.get("min_tokens_to_keep", 1),
                 top_k=params.get("top_k", self._default_top_k),
             )
 
-            # 处理提示缓存
+            self.check_request(request)
             tokenized_prompt = tokenizer.encode(prompt)
-            processed_prompt = self._get_prompt_cache(tokenized_prompt)
-            logger.debug(
-                f"Using {self._cached_token_count} cached tokens out of {len(tokenized_prompt)} total tokens"
-            )
-
-            for response in stream_generate(
-                model=self._model,
-                tokenizer=tokenizer,
-                prompt=processed_prompt,
-                max_tokens=max_completion_tokens,
-                sampler=sampler,
-                logits_processors=logits_processors,
-                prompt_cache=self._prompt_cache.cache,
-                **params,
-            ):
-                if response.finish_reason is not None:
-                    break
-
-                current_tokens.append(response.token)
-
-                logprobs = None
-                if request.logprobs:
-                    logprobs = self._process_logprobs(
-                        tokenizer, response, request.top_logprobs
-                    )
-
-                finish_reason = response.finish_reason
-                should_trim = False
-                if request.stop and stop_checker:
-                    stop_condition = stop_checker.check_stop_condition(current_tokens)
-                    if stop_condition.stop_met:
-                        finish_reason = "stop"
-                        if stop_condition.trim_length > 0:
-                            current_tokens = current_tokens[
-                                : -stop_condition.trim_length
-                            ]
-                            should_trim = True
-
-                text = tokenizer.decode(current_tokens)
-                delta_text = text[len(last_text) :]
-
-                if delta_text or should_trim:
-                    yield GenerateResult(
-                        text=delta_text,
-                        token=response.token,
-                        finish_reason=finish_reason,
-                        prompt_tokens=response.prompt_tokens,
-                        generation_tokens=response.generation_tokens,
-                        logprobs=logprobs,
+            if "draft_model" in params:
+                # Load a newly requested draft model outside the worker thread
+                self._get_draft_model(params["draft_model"])
+            if self._runs_exclusive(params):
+                handles = [
+                    self._scheduler.submit_exclusive(
+                        partial(
+                            self._sequential_generate,
+                            prompt=tokenized_prompt,
+                            max_tokens=max_completion_tokens,
+                            sampler=samplers[0],
+                            logits_processors=logits_processors[0],
+                            params=params,
+                        ),
+                        abort=abort,
+                        priority=priority,
+                        deadline=deadline,
                     )
-                    last_text = text
+                ]
+            else:
+                handles = self._scheduler.submit(
+                    tokenized_prompt,
+                    max_tokens=max_completion_tokens,
+                    samplers=samplers,
+                    logits_processors=logits_processors,
+                    abort=abort,
+                    priority=priority,
+                    deadline=deadline,
+                )
 
-                if should_trim:
-                    break
+            # Choices advance in lockstep, so reading them round-robin keeps
+            # the stream interleaved without buffering
+            choices = [
+                self._stream_choice(
+                    index, handle, request, stops or [], logprobs_window
+                )
+                for index, handle in enumerate(handles)
+            ]
+            active = list(choices)
+            while active:
+                for choice in list(active):
+                    result = next(choice, None)
+                    if result is None:
+                        active.remove(choice)
+                    else:
+                        yield result
 
             logger.debug(
                 f"The generation is completed, with a total of {len(self._prompt_cache.tokens)} tokens cached."
             )
-
-            logger.debug(response)
         except Exception as e:
             logger.error(f"Error during stream generation: {str(e)}", exc_info=True)
             raise
+        finally:
+            for choice in choices:
+                choice.close()
+            for handle in handles:
+                handle.cancel()
 
     def generate(
         self,
         request: ChatCompletionRequest,
+        abort: Optional[threading.Event] = None,
+        deadline: Optional[float] = None,
     ) -> ChatCompletionResponse:
         try:
-            completion = ""
-            logprobs_result_list = []
-            current_tokens = []
-            finish_reason = "stop"
-            result = None
+            n = request.n or 1
+            logprobs_result_lists = [[] for _ in range(n)]
+            completions = [[] for _ in range(n)]
+            finish_reasons = ["stop"] * n
+            results: List[Optional[GenerateResult]] = [None] * n
 
             prompt = self._chat_tokenizer.encode(
                 messages=request.messages,
@@ -229,82 +826,108 @@ class MLXModel(BaseTextModel):
             )
             logger.debug(f"Encoded prompt:\n{prompt}")
 
+            # Nothing is sent before the end, so logprobs are converted in bulk
+            seed = request.seed if request.seed is not None else random_seed()
             for result in self._stream_generate(
                 prompt=prompt,
                 request=request,
+                seed=seed,
+                logprobs_window=LOGPROBS_WINDOW,
+                abort=abort,
+                deadline=deadline,
             ):
-                current_tokens.append(result.token)
-                completion = self._chat_tokenizer.tokenizer.decode(current_tokens)
+                index = result.index
+                completions[index].append(result.text)
+                results[index] = result
 
-                if request.logprobs:
-                    logprobs_result_list.append(result.logprobs)
-
-                if not prompt:
-                    prompt = result.text
+                if result.logprobs is not None:
+                    logprobs_result_lists[index].append(result.logprobs)
 
                 if result.finish_reason:
-                    finish_reason = result.finish_reason
+                    finish_reasons[index] = result.finish_reason
 
-            if result is None:
+            first = next((result for result in results if result is not None), None)
+            if first is None:
                 raise RuntimeError("No tokens generated")
 
-            logger.debug(f"Model Response:\n{completion}")
-            if request.tools:
-                message = self._chat_tokenizer.decode(completion)
-            else:
-                message = ChatMessage(role=Role.ASSISTANT, content=completion)
-
-            tokenized_prompt = self._chat_tokenizer.tokenizer.encode(prompt)
-            update_prompt_cache(self._prompt_cache, tokenized_prompt, self._model_id)
-            logger.debug(
-                f"Update the prompt cache, totaling {len(self._prompt_cache.tokens)} tokens."
-            )
-
-            # 使用在 _stream_generate 中记录的缓存令牌数量
-            cached_tokens = self._cached_token_count
-            logger.debug(f"Generate response with {cached_tokens} cached tokens")
-
-            # 创建 prompt_tokens_details
-            prompt_tokens_details = None
-            if cached_tokens > 0:
-                from ..schema import PromptTokensDetails
+            choices = []
+            for index in range(n):
+                completion = "".join(completions[index])
+                logger.debug(f"Model Response:\n{completion}")
+                if request.tools:
+                    message = self._chat_tokenizer.decode(completion)
+                else:
+                    message = ChatMessage(role=Role.ASSISTANT, content=completion)
 
-                prompt_tokens_details = PromptTokensDetails(cached_tokens=cached_tokens)
-
-            return ChatCompletionResponse(
-                id=f"chatcmpl-{uuid.uuid4().hex[:10]}",
-                created=int(time.time()),
-                model=request.model,
-                choices=[
+                choices.append(
                     ChatCompletionChoice(
-                        index=0,
+                        index=index,
                         message=message,
                         finish_reason=(
-                            "tool_calls" if message.tool_calls else finish_reason
+                            "tool_calls"
+                            if message.tool_calls
+                            else finish_reasons[index]
                         ),
                         logprobs=(
-                            {"content": logprobs_result_list}
-                            if logprobs_result_list
+                            {"content": logprobs_result_lists[index]}
+                            if logprobs_result_lists[index]
                             else None
                         ),
                     )
-                ],
-                usage=ChatCompletionUsage(
-                    prompt_tokens=result.prompt_tokens + cached_tokens,
-                    completion_tokens=result.generation_tokens,
-                    total_tokens=result.prompt_tokens
-                    + result.generation_tokens
-                    + cached_tokens,
-                    prompt_tokens_details=prompt_tokens_details,
-                ),
+                )
+
+            # 使用在 _stream_generate 中记录的缓存令牌数量
+            cached_tokens = first.cached_tokens
+            logger.debug(f"Generate response with {cached_tokens} cached tokens")
+
+            return ChatCompletionResponse(
+                id=f"chatcmpl-{uuid.uuid4().hex[:10]}",
+                created=int(time.time()),
+                model=request.model,
+                choices=choices,
+                usage=self._make_usage(first, results),
+                seed=seed,
             )
         except Exception as e:
             logger.error(f"Failed to generate completion: {str(e)}", exc_info=True)
             raise RuntimeError(f"Failed to generate completion: {str(e)}")
 
+    @staticmethod
+    def _make_usage(
+        first: GenerateResult, results: List[Optional[GenerateResult]]
+    ) -> ChatCompletionUsage:
+        """Usage for all choices, the shared prompt is only counted once"""
+        cached_tokens = first.cached_tokens
+        results = [result for result in results if result is not None]
+        completion_tokens = sum(result.generation_tokens for result in results)
+        accepted_tokens = sum(result.accepted_prediction_tokens for result in results)
+        rejected_tokens = sum(result.rejected_prediction_tokens for result in results)
+
+        # 创建 prompt_tokens_details
+        prompt_tokens_details = None
+        if cached_tokens > 0:
+            prompt_tokens_details = PromptTokensDetails(cached_tokens=cached_tokens)
+
+        completion_tokens_details = None
+        if accepted_tokens or rejected_tokens:
+            completion_tokens_details = ChatCompletionUsageDetails(
+                accepted_prediction_tokens=accepted_tokens,
+                rejected_prediction_tokens=rejected_tokens,
+            )
+
+        return ChatCompletionUsage(
+            prompt_tokens=first.prompt_tokens + cached_tokens,
+            completion_tokens=completion_tokens,
+            total_tokens=first.prompt_tokens + completion_tokens + cached_tokens,
+            prompt_tokens_details=prompt_tokens_details,
+            completion_tokens_details=completion_tokens_details,
+        )
+
     def stream_generate(
         self,
         request: ChatCompletionRequest,
+        abort: Optional[threading.Event] = None,
+        deadline: Optional[float] = None,
     ) -> Generator[ChatCompletionChunk, None, None]:
         try:
             chat_id = f"chatcmpl-{uuid.uuid4().hex[:10]}"
@@ -315,39 +938,42 @@ class MLXModel(BaseTextModel):
             )
             logger.debug(f"Encoded prompt:\n{prompt}")
 
-            completion = ""
+            results: List[Optional[GenerateResult]] = [None] * (request.n or 1)
+            seed = request.seed if request.seed is not None else random_seed()
             for result in self._stream_generate(
                 prompt=prompt,
                 request=request,
+                seed=seed,
+                abort=abort,
+                deadline=deadline,
             ):
                 created = int(time.time())
-                completion += result.text
+                results[result.index] = result
                 yield ChatCompletionChunk(
                     id=chat_id,
                     created=created,
                     model=request.model,
                     choices=[
                         ChatCompletionChunkChoice(
-                            index=0,
+                            index=result.index,
                             delta=ChatMessage(role=Role.ASSISTANT, content=result.text),
                             finish_reason=result.finish_reason,
                             logprobs=result.logprobs,
                         )
                     ],
+                    seed=seed,
                 )
 
-            if request.stream_options and request.stream_options.include_usage:
+            first = next((result for result in results if result is not None), None)
+            if (
+                first is not None
+                and request.stream_options
+                and request.stream_options.include_usage
+            ):
                 created = int(time.time())
-                cached_tokens = self._cached_token_count
-                logger.debug(f"Stream response with {cached_tokens} cached tokens")
-
-                prompt_tokens_details = None
-                if cached_tokens > 0:
-                    from ..schema import PromptTokensDetails
-
-                    prompt_tokens_details = PromptTokensDetails(
-                        cached_tokens=cached_tokens
-                    )
+                logger.debug(
+                    f"Stream response with {first.cached_tokens} cached tokens"
+                )
 
                 yield ChatCompletionChunk(
                     id=chat_id,
@@ -361,14 +987,8 @@ class MLXModel(BaseTextModel):
                             logprobs=None,
                         )
                     ],
-                    usage=ChatCompletionUsage(
-                        prompt_tokens=result.prompt_tokens + cached_tokens,
-                        completion_tokens=result.generation_tokens,
-                        total_tokens=result.prompt_tokens
-                        + result.generation_tokens
-                        + cached_tokens,
-                        prompt_tokens_details=prompt_tokens_details,
-                    ),
+                    usage=self._make_usage(first, results),
+                    seed=seed,
                 )
 
         except Exception as e:
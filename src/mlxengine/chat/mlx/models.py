@@ -1,10 +1,15 @@
-from typing import Type
+import threading
+from typing import Dict, Type
 
+import mlx.nn as nn
 from mlx_lm.tokenizer_utils import TokenizerWrapper
 from mlx_lm.utils import get_model_path, load, load_config
 
+from ...config import get_model_config, get_setting
+from ...utils.logger import logger
 from ..text_models import BaseTextModel
 from .mlx_model import MLXModel
+from .snapshots import model_revision
 from .tools.chat_tokenizer import ChatTokenizer
 from .tools.hugging_face import HuggingFaceChatTokenizer
 from .tools.llama3 import Llama3ChatTokenizer
@@ -25,8 +30,32 @@ def load_tools_handler(model_type: str, tokenizer: TokenizerWrapper) -> ChatToke
     return handler_class(tokenizer)
 
 
-def load_model(model_id: str, adapter_path: str = None) -> BaseTextModel:
-    """Load a model and tokenizer from the given model ID."""
+_draft_models: Dict[str, nn.Module] = {}
+# Requests load draft models on their own threads, one load at a time
+_draft_models_lock = threading.Lock()
+
+
+def load_draft_model(draft_model_id: str) -> nn.Module:
+    """Load a draft model for speculative decoding, cached by model ID."""
+    with _draft_models_lock:
+        if draft_model_id not in _draft_models:
+            logger.info(f"Loading draft model: {draft_model_id}")
+            draft_model, _ = load(
+                draft_model_id, tokenizer_config={"trust_remote_code": True}
+            )
+            _draft_models[draft_model_id] = draft_model
+        return _draft_models[draft_model_id]
+
+
+def load_model(
+    model_id: str, adapter_path: str = None, draft_model_id: str = None
+) -> BaseTextModel:
+    """Load a model and tokenizer from the given model ID.
+
+    The draft model, taken from the argument or else from the model's server
+    config, is loaded and cached along with it, and the prompt snapshots listed
+    in the server config are loaded, or created if they are missing.
+    """
     model, tokenizer = load(
         model_id,
         tokenizer_config={"trust_remote_code": True},
@@ -38,4 +67,38 @@ def load_model(model_id: str, adapter_path: str = None) -> BaseTextModel:
 
     chat_tokenizer = load_tools_handler(config["model_type"], tokenizer)
 
-    return MLXModel(model_id=model_id, model=model, tokenizer=chat_tokenizer)
+    model_config = get_model_config(model_id)
+    draft_model_id = draft_model_id or model_config.get("draft_model")
+    if draft_model_id:
+        load_draft_model(draft_model_id)
+
+    text_model = MLXModel(
+        model_id=model_id,
+        model=model,
+        tokenizer=chat_tokenizer,
+        draft_model_id=draft_model_id,
+        num_draft_tokens=model_config.get("num_draft_tokens", 3),
+        allowed_draft_models=get_setting(model_id, "allowed_draft_models", []),
+        prefill_step_size=model_config.get("prefill_step_size", 512),
+        kv_bits=model_config.get("kv_bits"),
+        kv_group_size=model_config.get("kv_group_size", 64),
+        quantized_kv_start=model_config.get("quantized_kv_start", 0),
+        max_kv_size=model_config.get("max_kv_size"),
+        attention_sink_tokens=model_config.get("attention_sink_tokens", 4),
+        prompt_cache_bytes=model_config.get("prompt_cache_bytes", 2 * 1024**3),
+        prompt_cache_spill_bytes=model_config.get("prompt_cache_spill_bytes", 0),
+        prompt_cache_spill_bits=model_config.get("prompt_cache_spill_bits"),
+        prompt_cache_spill_dir=model_config.get("prompt_cache_spill_dir"),
+        request_timeout=get_setting(model_id, "request_timeout"),
+        revision=model_revision(model_path),
+        adapter_path=adapter_path,
+    )
+    for snapshot in model_config.get("prompt_snapshots", []):
+        try:
+            text_model.restore_snapshot(**snapshot)
+        except Exception as e:
+            logger.error(
+                f"Failed to restore prompt snapshot {snapshot.get('name')}: {str(e)}",
+                exc_info=True,
+            )
+    return text_model
@@ -0,0 +1,121 @@
+"""
+Penalty Logits Processor Module
+
+This module applies ``logit_bias``, ``presence_penalty`` and
+``frequency_penalty`` with OpenAI semantics. Each completion keeps the count of
+every token it generated in an array on the device, and the bias and both
+penalties are applied to the logits in one compiled operation per step, so the
+cost doesn't depend on how many tokens were generated or biased.
+"""
+
+from typing import Dict, Optional
+
+import mlx.core as mx
+
+# OpenAI accepts biases in this range, -100 and 100 ban or force a token
+MAX_LOGIT_BIAS = 100.0
+
+
+def parse_logit_bias(logit_bias: Optional[Dict[str, float]]) -> Dict[int, float]:
+    """
+    Check a ``logit_bias`` request field and key it by token ID
+
+    Raises:
+        ValueError: If a key isn't a token ID or a bias is out of range
+    """
+    parsed: Dict[int, float] = {}
+    for token, bias in (logit_bias or {}).items():
+        try:
+            token_id = int(token)
+        except (TypeError, ValueError):
+            raise ValueError(f"Invalid token ID in logit_bias: {token!r}")
+        if token_id < 0:
+            raise ValueError(f"Invalid token ID in logit_bias: {token!r}")
+        if isinstance(bias, bool) or not isinstance(bias, (int, float)):
+            raise ValueError(f"logit_bias for token {token_id} must be a number")
+        if not -MAX_LOGIT_BIAS <= bias <= MAX_LOGIT_BIAS:
+            raise ValueError(
+                f"logit_bias for token {token_id} must be between "
+                f"{-MAX_LOGIT_BIAS:g} and {MAX_LOGIT_BIAS:g}, got {bias}"
+            )
+        parsed[token_id] = float(bias)
+    return parsed
+
+
+@mx.compile
+def _apply_penalties(
+    logits: mx.array,
+    counts: mx.array,
+    bias: mx.array,
+    presence: mx.array,
+    frequency: mx.array,
+) -> mx.array:
+    penalty = presence * (counts > 0) + frequency * counts
+    return (logits + bias - penalty).astype(logits.dtype)
+
+
+class PenaltyLogitsProcessor:
+    """
+    Logits processor for the token bias and penalties of one completion
+
+    The tokens passed on the first call are taken as the prompt, only tokens
+    after them count towards the penalties. Token histories that don't grow by
+    exactly one token, as when speculative decoding rejects drafted tokens, are
+    counted again from scratch.
+    """
+
+    def __init__(
+        self,
+        logit_bias: Optional[Dict[str, float]] = None,
+        presence_penalty: float = 0.0,
+        frequency_penalty: float = 0.0,
+    ):
+        """
+        Args:
+            logit_bias: Bias added to the logit of each token ID, keyed by the
+                ID as a string
+            presence_penalty: Subtracted from the logit of every token that
+                was generated at least once
+            frequency_penalty: Subtracted from the logit of every token once
+                for each time it was generated
+
+        Raises:
+            ValueError: If a key of ``logit_bias`` isn't a token ID or a bias is
+                out of range
+        """
+        self._logit_bias = parse_logit_bias(logit_bias)
+        # Passed as arrays, so different values don't recompile the operation
+        self._presence = mx.array(presence_penalty or 0.0, dtype=mx.float32)
+        self._frequency = mx.array(frequency_penalty or 0.0, dtype=mx.float32)
+
+        self._prompt_length: Optional[int] = None
+        self._seen = 0
+        self._counts: Optional[mx.array] = None
+        self._bias: Optional[mx.array] = None
+
+    def _setup(self, tokens: mx.array, vocab_size: int) -> None:
+        self._prompt_length = len(tokens)
+        self._seen = len(tokens)
+        self._counts = mx.zeros((vocab_size,), dtype=mx.float32)
+        bias = [0.0] * vocab_size
+        for token, value in self._logit_bias.items():
+            # Biases for IDs past the model's output layer can't apply
+            if token < vocab_size:
+                bias[token] = value
+        self._bias = mx.array(bias, dtype=mx.float32)
+
+    def __call__(self, tokens: mx.array, logits: mx.array) -> mx.array:
+        if self._counts is None:
+            self._setup(tokens, logits.shape[-1])
+        elif len(tokens) == self._seen + 1:
+            self._counts = self._counts.at[tokens[-1:]].add(1)
+        else:
+            generated = tokens[self._prompt_length :]
+            counts = mx.zeros_like(self._counts)
+            if len(generated):
+                counts = counts.at[generated].add(1)
+            self._counts = counts
+        self._seen = len(tokens)
+        return _apply_penalties(
+            logits, self._counts, self._bias, self._presence, self._frequency
+        )
@@ -6,9 +6,21 @@ to improve performance in multi-turn conversations.
 """
 
 from dataclasses import dataclass, field
-from typing import Any, List, Tuple
+from typing import Any, List, Optional, Tuple
+
+import mlx.core as mx
+from mlx_lm.generate import generation_stream, maybe_quantize_kv_cache
+from mlx_lm.models.base import create_causal_mask
+from mlx_lm.models.cache import (
+    QuantizedKVCache,
+    RotatingKVCache,
+    can_trim_prompt_cache,
+    make_prompt_cache,
+)
 
 from ...utils.logger import logger
+from ...utils.metrics import metrics
+from .radix_cache import RadixTree, is_sliceable
 
 
 @dataclass
@@ -16,15 +28,48 @@ class PromptCache:
     """
     Prompt cache class for storing and managing model prompt caches
 
+    ``tokens`` and ``cache`` are the working sequence the model is fed. Before a
+    new prompt is processed, the working sequence is stored in ``tree``, which
+    keeps the KV of earlier prompts so that any of them can be continued.
+
+    With a bounded cache, ``tokens`` still holds every token fed so far while
+    the KV cache only keeps the attention sinks and the most recent window of
+    them. Prompts extending ``tokens`` continue from that window. Bounded caches
+    are not stored in the tree.
+
     Attributes:
         tokens: Cached token sequence
         cache: Model's KV cache state, a list matching the number of model layers
         model_key: Model identifier to ensure cache matches the model
+        tree: Radix tree of earlier prompts, None to only keep the working one
+        lease: Tree node leased for the working sequence
     """
 
     tokens: List[int] = field(default_factory=list)
     cache: List[Any] = field(default_factory=list)
     model_key: str = ""
+    tree: Optional[RadixTree] = None
+    lease: Any = None
+
+
+@dataclass
+class CacheLease:
+    """
+    A private KV cache continuing a prefix leased from the tree of a prompt cache
+
+    The cache reads the KV of the leased prefix from the tree without copying it,
+    and copies it the first time it writes past it, so every request appends to
+    its own tail while the shared prefix stays read-only.
+
+    Attributes:
+        tokens: Tokens whose KV ``cache`` holds
+        cache: Per-layer KV cache private to the lease
+        node: Tree node leased for the prefix
+    """
+
+    tokens: List[int] = field(default_factory=list)
+    cache: List[Any] = field(default_factory=list)
+    node: Any = None
 
 
 def update_prompt_cache(
@@ -53,8 +98,42 @@ def update_prompt_cache(
     logger.debug(f"Updated cache with {len(tokenized_prompt)} tokens")
 
 
+def make_cache(
+    model: Any, max_kv_size: Optional[int] = None, attention_sink_tokens: int = 4
+) -> List[Any]:
+    """
+    Create a model's KV cache, optionally bounded to a sliding window
+
+    Args:
+        model: Model object to create the cache for
+        max_kv_size: Maximum number of tokens each layer keeps, None for no limit
+        attention_sink_tokens: Number of leading tokens a bounded cache never
+            evicts, which the model keeps attending to
+
+    Returns:
+        List[Any]: One cache per layer
+    """
+    if max_kv_size is None:
+        return make_prompt_cache(model)
+    if hasattr(model, "make_cache"):
+        logger.warning(
+            "Model defines its own KV cache, ignoring max_kv_size=" f"{max_kv_size}"
+        )
+        return make_prompt_cache(model)
+    return [
+        RotatingKVCache(max_size=max_kv_size, keep=attention_sink_tokens)
+        for _ in model.layers
+    ]
+
+
 def process_prompt_cache(
-    prompt: List[int], prompt_cache: PromptCache, model_key: str, model: Any
+    prompt: List[int],
+    prompt_cache: PromptCache,
+    model_key: str,
+    model: Any,
+    draft_model: Any = None,
+    max_kv_size: Optional[int] = None,
+    attention_sink_tokens: int = 4,
 ) -> Tuple[List[int], int]:
     """
     Process prompt cache using official logic
@@ -64,13 +143,17 @@ def process_prompt_cache(
         prompt_cache: Prompt cache object
         model_key: Model identifier
         model: Model object used to create cache
+        draft_model: Draft model for speculative decoding, whose layers are
+            appended to the cache after the model's own
+        max_kv_size: Bound a new cache to this many tokens per layer
+        attention_sink_tokens: Leading tokens a bounded cache never evicts
 
     Returns:
         Tuple[List[int], int]: Tuple containing:
             1. List of prompt tokens to process (if cached, only returns uncached portion)
             2. Number of tokens retrieved from cache
     """
-    from mlx_lm.models.cache import make_prompt_cache
+    commit_prompt_cache(prompt_cache)
 
     cache_len = len(prompt_cache.tokens)
     prompt_len = len(prompt)
@@ -81,22 +164,290 @@ def process_prompt_cache(
         logger.debug(f"Cache tokens prefix: {prompt_cache.tokens[:prefix_len]}")
         logger.debug(f"Prompt tokens prefix: {prompt[:prefix_len]}")
 
-    if (
-        prompt_cache.model_key != model_key
-        or cache_len >= prompt_len
-        or prompt_cache.tokens != prompt[:cache_len]
-    ):
+    # The working sequence is trimmed back to where it diverges from the prompt,
+    # if its cache supports that. The last prompt token is always left to be fed.
+    reusable_len = 0
+    if prompt_cache.model_key == model_key:
+        reusable_len = common_prefix_length(prompt_cache.tokens, prompt[:-1])
+        if reusable_len < cache_len and not can_trim_prompt_cache(prompt_cache.cache):
+            logger.debug("Prompt diverges from a cache that can't be trimmed")
+            reusable_len = 0
+
+    # Another branch of the tree may share more of the prompt, in memory or
+    # spilled to disk
+    tree = prompt_cache.tree if max_kv_size is None else None
+    memory_len = tree.match_length(model_key, prompt[:-1]) if tree else 0
+    tree_len = tree.restore(model_key, prompt[:-1]) if tree else 0
+    if tree_len > reusable_len:
+        tree_len, cache, lease = tree.fetch(model_key, prompt[:-1])
+        release_prompt_cache(prompt_cache)
+        prompt_cache.model_key = model_key
+        prompt_cache.cache = cache
+        prompt_cache.lease = lease
+        prompt_cache.tokens = list(prompt)
+        logger.debug(f"Using prompt cache tree. Cached tokens: {tree_len}")
+        _record_hit(model_key, min(memory_len, tree_len), tree_len - memory_len)
+        return prompt[tree_len:], tree_len
+
+    if reusable_len == 0:
         logger.debug("Resetting cache based on official logic")
+        metrics.increment("prompt_cache_misses", model=model_key)
+        release_prompt_cache(prompt_cache)
         prompt_cache.model_key = model_key
-        prompt_cache.cache = make_prompt_cache(model)
+        prompt_cache.cache = make_cache(model, max_kv_size, attention_sink_tokens)
+        if draft_model is not None:
+            prompt_cache.cache += make_prompt_cache(draft_model)
         prompt_cache.tokens = []
 
         prompt_cache.tokens.extend(prompt)
         return prompt, 0
     else:
-        result_prompt = prompt[cache_len:]
-        cached_tokens = cache_len
-        logger.debug(f"Using cache. Cached tokens: {cached_tokens}")
+        # Also drops KV that generation left after the cached tokens
+        for c in prompt_cache.cache:
+            if c.is_trimmable() and c.offset > reusable_len:
+                c.trim(c.offset - reusable_len)
 
-        prompt_cache.tokens.extend(result_prompt)
+        result_prompt = prompt[reusable_len:]
+        cached_tokens = reusable_len
+        logger.debug(
+            f"Using cache. Cached tokens: {cached_tokens}, "
+            f"trimmed: {cache_len - reusable_len}"
+        )
+
+        prompt_cache.tokens = prompt_cache.tokens[:reusable_len] + result_prompt
+        _record_hit(model_key, cached_tokens, 0)
         return result_prompt, cached_tokens
+
+
+def lease_prompt_cache(
+    prompt: List[int], prompt_cache: PromptCache, model_key: str, model: Any
+) -> Tuple[CacheLease, List[int], int]:
+    """
+    Lease the longest cached prefix of a prompt from the tree of a prompt cache
+
+    Unlike :func:`process_prompt_cache`, this leaves the working sequence alone,
+    so any number of leases can be prefilled side by side.
+
+    Args:
+        prompt: List of encoded prompt tokens
+        prompt_cache: Prompt cache object, without a tree nothing is cached
+        model_key: Model identifier
+        model: Model object used to create a cache without a match
+
+    Returns:
+        Tuple[CacheLease, List[int], int]: Tuple containing:
+            1. The lease, to pass to :func:`return_lease` once prefilled
+            2. List of prompt tokens to process
+            3. Number of tokens retrieved from cache
+    """
+    # The working sequence may hold a prefix the tree doesn't have yet
+    commit_prompt_cache(prompt_cache)
+
+    tree = prompt_cache.tree
+    memory_len = tree.match_length(model_key, prompt[:-1]) if tree else 0
+    tree_len = tree.restore(model_key, prompt[:-1]) if tree else 0
+    if tree_len == 0:
+        metrics.increment("prompt_cache_misses", model=model_key)
+        return CacheLease(cache=make_prompt_cache(model)), prompt, 0
+
+    tree_len, cache, node = tree.fetch(model_key, prompt[:-1])
+    logger.debug(f"Leased {tree_len} cached tokens from the prompt cache tree")
+    _record_hit(model_key, min(memory_len, tree_len), tree_len - memory_len)
+    lease = CacheLease(tokens=prompt[:tree_len], cache=cache, node=node)
+    return lease, prompt[tree_len:], tree_len
+
+
+def return_lease(prompt_cache: PromptCache, model_key: str, lease: CacheLease) -> None:
+    """
+    Store the KV a lease computed in the tree and release its prefix
+
+    Args:
+        prompt_cache: Prompt cache object the lease was taken from
+        model_key: Model identifier the KV belongs to
+        lease: Lease to return, it must not be used afterwards
+    """
+    try:
+        store_prompt_cache(prompt_cache, model_key, lease.tokens, lease.cache)
+    finally:
+        release_lease(prompt_cache, lease)
+
+
+def release_lease(prompt_cache: PromptCache, lease: CacheLease) -> None:
+    """Release the prefix of a lease without storing what it computed"""
+    if prompt_cache.tree is not None:
+        prompt_cache.tree.release(lease.node)
+    lease.node = None
+
+
+def _record_hit(model_key: str, memory_tokens: int, disk_tokens: int) -> None:
+    """Count a prompt cache hit in each tier that served some of its tokens"""
+    for tier, tokens in (("memory", memory_tokens), ("disk", disk_tokens)):
+        if tokens > 0:
+            metrics.increment("prompt_cache_hits", model=model_key, tier=tier)
+            metrics.increment(
+                "prompt_cache_hit_tokens", tokens, model=model_key, tier=tier
+            )
+
+
+def common_prefix_length(a: List[int], b: List[int]) -> int:
+    """Number of leading tokens two sequences share"""
+    length = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        length += 1
+    return length
+
+
+def commit_prompt_cache(prompt_cache: PromptCache) -> None:
+    """
+    Store the working sequence of a prompt cache in its tree
+
+    Args:
+        prompt_cache: Prompt cache object
+    """
+    store_prompt_cache(
+        prompt_cache, prompt_cache.model_key, prompt_cache.tokens, prompt_cache.cache
+    )
+
+
+def store_prompt_cache(
+    prompt_cache: PromptCache, model_key: str, tokens: List[int], cache: List[Any]
+) -> None:
+    """
+    Store the KV of a token sequence in the tree of a prompt cache
+
+    Args:
+        prompt_cache: Prompt cache object
+        model_key: Model identifier the KV belongs to
+        tokens: Token sequence the KV was computed for
+        cache: Per-layer KV cache of the sequence
+    """
+    if prompt_cache.tree is None or not model_key or not is_sliceable(cache):
+        return
+    # The KV may cover fewer tokens if prefill stopped early, or if the last
+    # generated token was never fed
+    num_tokens = min(len(tokens), *(c.offset for c in cache))
+    if num_tokens > 0:
+        prompt_cache.tree.insert(model_key, tokens[:num_tokens], cache)
+
+
+def extend_prompt_cache(prompt_cache: PromptCache, tokens: List[int]) -> None:
+    """
+    Append generated tokens to the working sequence of a prompt cache
+
+    Only the tokens the KV cache holds are appended, the last generated token is
+    usually never fed. KV beyond the appended tokens, such as that of a stop
+    sequence, is trimmed when the cache allows it, so that ``tokens`` matches
+    the KV cache exactly.
+
+    Args:
+        prompt_cache: Prompt cache object
+        tokens: Generated tokens to keep in the cache
+    """
+    cache = prompt_cache.cache
+    if not cache or not all(hasattr(c, "offset") for c in cache):
+        return
+    sequence = prompt_cache.tokens + tokens
+    if can_trim_prompt_cache(cache):
+        for c in cache:
+            if c.offset > len(sequence):
+                c.trim(c.offset - len(sequence))
+    prompt_cache.tokens = sequence[: min(c.offset for c in cache)]
+
+
+def release_prompt_cache(prompt_cache: PromptCache) -> None:
+    """Release the tree branch leased for the working sequence"""
+    if prompt_cache.tree is not None:
+        prompt_cache.tree.release(prompt_cache.lease)
+    prompt_cache.lease = None
+
+
+def kv_cache_nbytes(cache: List[Any]) -> Tuple[int, int]:
+    """
+    Memory held by a KV cache
+
+    Args:
+        cache: Per-layer KV caches, quantized or not
+
+    Returns:
+        Tuple[int, int]: Tuple containing:
+            1. Bytes the cache holds
+            2. Bytes it would hold without quantization
+    """
+    nbytes = full_precision_nbytes = 0
+    for layer in cache:
+        if getattr(layer, "keys", None) is None:
+            continue
+        for x in layer.state:
+            if isinstance(x, (tuple, list)):
+                packed, scales, biases = x
+                nbytes += packed.nbytes + scales.nbytes + biases.nbytes
+                full_precision_nbytes += (
+                    packed.size * 32 // layer.bits * scales.dtype.size
+                )
+            else:
+                nbytes += x.nbytes
+                full_precision_nbytes += x.nbytes
+    return nbytes, full_precision_nbytes
+
+
+def make_prefill_mask(cache: List[Any], num_tokens: int) -> Optional[mx.array]:
+    """
+    Additive causal mask for feeding several tokens into a quantized cache
+
+    mlx_lm's quantized attention adds the mask to the scores, so it can't use the
+    ``"causal"`` shortcut models pass for full precision caches.
+
+    Args:
+        cache: Per-layer KV caches the tokens are fed into
+        num_tokens: Number of tokens fed at once
+
+    Returns:
+        Optional[mx.array]: The mask, None when the model's default mask works
+    """
+    if (
+        num_tokens <= 1
+        or not cache
+        or not isinstance(cache[0], QuantizedKVCache)
+        or cache[0].keys is None
+    ):
+        return None
+    mask = create_causal_mask(num_tokens, cache[0].offset)
+    dtype = cache[0].keys[1].dtype
+    return mx.where(mask, mx.array(0, dtype), mx.array(-mx.inf, dtype))
+
+
+def prefill_prompt_cache(
+    model: Any,
+    cache: List[Any],
+    tokens: List[int],
+    kv_bits: Optional[int] = None,
+    kv_group_size: int = 64,
+    quantized_kv_start: int = 0,
+) -> None:
+    """
+    Feed tokens through the model into its cache
+
+    The cache is quantized in place once it holds more than
+    ``quantized_kv_start`` tokens, like mlx_lm does during generation.
+
+    Args:
+        model: Model object the cache belongs to
+        cache: Per-layer KV caches, updated in place
+        tokens: Tokens to feed
+        kv_bits: Bits to quantize the cache to, None keeps full precision
+        kv_group_size: Group size for cache quantization
+        quantized_kv_start: Number of cached tokens after which to quantize
+    """
+    if not tokens:
+        return
+    inputs = mx.array(tokens)[None]
+    mask = make_prefill_mask(cache, len(tokens))
+    with mx.stream(generation_stream):
+        if mask is None:
+            model(inputs, cache=cache)
+        else:
+            model(inputs, cache=cache, mask=mask)
+        maybe_quantize_kv_cache(cache, quantized_kv_start, kv_group_size, kv_bits)
+        mx.eval([c.state for c in cache])
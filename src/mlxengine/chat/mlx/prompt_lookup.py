@@ -0,0 +1,262 @@
+"""
+Prompt Lookup Decoding Module
+
+This module implements draft-free speculative decoding. Draft tokens are taken
+from the context itself: the last few tokens are matched against earlier n-grams
+of the prompt and completion, and the tokens that followed the match are verified
+by the model in a single forward pass. Completions that copy long spans of the
+prompt, such as code edits or answers quoted from a document, accept several
+tokens per step.
+"""
+
+import time
+from typing import Callable, Dict, Generator, List, Optional, Tuple
+
+import mlx.core as mx
+import mlx.nn as nn
+from mlx_lm.generate import (
+    GenerationResponse,
+    generation_stream,
+    maybe_quantize_kv_cache,
+)
+from mlx_lm.models.cache import can_trim_prompt_cache, trim_prompt_cache
+from mlx_lm.tokenizer_utils import TokenizerWrapper
+
+from .prompt_cache import make_prefill_mask, prefill_prompt_cache
+
+
+class NgramIndex:
+    """
+    Index of the latest continuation of every n-gram in a token sequence
+
+    Each n-gram of ``min_ngram_size`` to ``max_ngram_size`` tokens maps to the
+    position of the token that followed its most recent occurrence, so a lookup
+    costs one dictionary access per n-gram size however long the context is.
+    """
+
+    def __init__(self, max_ngram_size: int, min_ngram_size: int = 1):
+        self.tokens: List[int] = []
+        self._max_ngram_size = max_ngram_size
+        self._min_ngram_size = min_ngram_size
+        self._continuations: Dict[Tuple[int, ...], int] = {}
+
+    def extend(self, tokens: List[int]) -> None:
+        for token in tokens:
+            position = len(self.tokens)
+            for n in range(self._min_ngram_size, self._max_ngram_size + 1):
+                if position >= n:
+                    ngram = tuple(self.tokens[position - n : position])
+                    self._continuations[ngram] = position
+            self.tokens.append(token)
+
+    def lookup(self, num_tokens: int) -> List[int]:
+        """
+        Propose the tokens that followed the longest matching suffix
+
+        Args:
+            num_tokens: Maximum number of tokens to propose
+
+        Returns:
+            List[int]: The proposed tokens, empty if no suffix occurred before
+        """
+        for n in range(self._max_ngram_size, self._min_ngram_size - 1, -1):
+            if len(self.tokens) < n:
+                continue
+            start = self._continuations.get(tuple(self.tokens[-n:]))
+            if start is not None:
+                return self.tokens[start : start + num_tokens]
+        return []
+
+
+def _rewindable_tokens(prompt_cache: List) -> float:
+    """Number of tokens that can still be fed into the cache and trimmed again"""
+    if not can_trim_prompt_cache(prompt_cache):
+        return 0
+    # A rotating cache can only be trimmed until it wraps around
+    return min(
+        (c.max_size - c.offset for c in prompt_cache if hasattr(c, "max_size")),
+        default=float("inf"),
+    )
+
+
+def prompt_lookup_generate_step(
+    prompt: List[int],
+    context: List[int],
+    model: nn.Module,
+    *,
+    prompt_cache: List,
+    num_draft_tokens: int = 10,
+    max_ngram_size: int = 3,
+    max_tokens: int = 256,
+    sampler: Optional[Callable[[mx.array], mx.array]] = None,
+    logits_processors: Optional[List[Callable[[mx.array, mx.array], mx.array]]] = None,
+    prefill_step_size: int = 2048,
+    on_verify: Optional[Callable[[int, int], None]] = None,
+    kv_bits: Optional[int] = None,
+    kv_group_size: int = 64,
+    quantized_kv_start: int = 0,
+) -> Generator[Tuple[int, mx.array, bool], None, None]:
+    """
+    Generate tokens, verifying prompt lookup drafts in one forward pass each
+
+    Args:
+        prompt: Tokens that still have to be prefilled into ``prompt_cache``
+        context: The whole token sequence, ending with ``prompt``
+        model: The model to generate with
+        prompt_cache: The model's KV cache, updated in place. Drafting is
+            skipped when the cache cannot be trimmed, and shortened so a
+            bounded cache never wraps around in the middle of a draft.
+        num_draft_tokens: Maximum number of draft tokens per step
+        max_ngram_size: Longest suffix matched against the context
+        max_tokens: Maximum number of tokens to generate
+        sampler: Sampler for the log probabilities, greedy by default
+        logits_processors: Functions applied to the logits before sampling
+        prefill_step_size: Step size for processing the prompt
+        on_verify: Called with the number of drafted and accepted tokens after
+            every step that verified a draft
+        kv_bits: Bits to quantize the KV cache to, None keeps full precision
+        kv_group_size: Group size for KV cache quantization
+        quantized_kv_start: Number of cached tokens after which to quantize
+
+    Yields:
+        Tuple[int, mx.array, bool]: One token, its log probabilities, and whether
+        it was accepted from the draft
+    """
+    sampler = sampler or (lambda x: mx.argmax(x, axis=-1))
+    index = NgramIndex(max_ngram_size)
+    index.extend(context)
+
+    def _sample(tokens: Optional[mx.array], logits: mx.array):
+        for processor in logits_processors or []:
+            logits = processor(tokens, logits)
+        logprobs = logits - mx.logsumexp(logits, axis=-1, keepdims=True)
+        return sampler(logprobs), logprobs.squeeze(0)
+
+    remaining = prompt[:-1]
+    while remaining:
+        prefill_prompt_cache(
+            model,
+            prompt_cache,
+            remaining[:prefill_step_size],
+            kv_bits=kv_bits,
+            kv_group_size=kv_group_size,
+            quantized_kv_start=quantized_kv_start,
+        )
+        remaining = remaining[prefill_step_size:]
+
+    # Tokens the logits processors see, extended on device as tokens are accepted
+    history = mx.array(index.tokens) if logits_processors else None
+    y = prompt[-1:]
+    ntoks = 0
+    while True:
+        limit = min(num_draft_tokens, max_tokens - ntoks - 1)
+        limit = min(limit, _rewindable_tokens(prompt_cache) - 1)
+        draft = index.lookup(limit) if limit > 0 else []
+
+        with mx.stream(generation_stream):
+            inputs = mx.array(y + draft)[None]
+            mask = make_prefill_mask(prompt_cache, inputs.shape[1])
+            if mask is None:
+                logits = model(inputs, cache=prompt_cache)
+            else:
+                logits = model(inputs, cache=prompt_cache, mask=mask)
+            logits = logits[0, -(len(draft) + 1) :, :]
+            candidates = None
+            if history is not None:
+                candidates = history
+                if draft:
+                    candidates = mx.concatenate([history, mx.array(draft)])
+            sampled, logprobs = [], []
+            for i in range(len(draft) + 1):
+                seen = None
+                if candidates is not None:
+                    seen = candidates[: history.size + i]
+                token, token_logprobs = _sample(seen, logits[i : i + 1])
+                sampled.append(token)
+                logprobs.append(token_logprobs)
+            sampled = mx.concatenate(sampled)
+            mx.eval(sampled, logprobs)
+        tokens = sampled.tolist()
+        maybe_quantize_kv_cache(
+            prompt_cache, quantized_kv_start, kv_group_size, kv_bits
+        )
+
+        accepted = 0
+        while accepted < len(draft) and tokens[accepted] == draft[accepted]:
+            accepted += 1
+        if draft:
+            if on_verify is not None:
+                on_verify(len(draft), accepted)
+            if accepted < len(draft):
+                trim_prompt_cache(prompt_cache, len(draft) - accepted)
+
+        if history is not None:
+            history = mx.concatenate([history, mx.array(tokens[: accepted + 1])])
+        for i in range(accepted + 1):
+            index.extend([tokens[i]])
+            ntoks += 1
+            yield tokens[i], logprobs[i], i < accepted
+            if ntoks == max_tokens:
+                return
+        y = [tokens[accepted]]
+
+
+def prompt_lookup_generate(
+    model: nn.Module,
+    tokenizer: TokenizerWrapper,
+    prompt: List[int],
+    context: List[int],
+    **kwargs,
+) -> Generator[GenerationResponse, None, None]:
+    """
+    Prompt lookup counterpart of mlx_lm's ``stream_generate``
+
+    Args:
+        model: The model to generate with
+        tokenizer: The model's tokenizer
+        prompt: Tokens that still have to be prefilled
+        context: The whole token sequence, ending with ``prompt``
+        kwargs: Passed on to :func:`prompt_lookup_generate_step`
+
+    Yields:
+        GenerationResponse: One response per token, then a final response with
+        the finish reason
+    """
+    tic = time.perf_counter()
+    prompt_tps = 0.0
+    token, logprobs, from_draft = None, None, False
+    n = 0
+    for n, (token, logprobs, from_draft) in enumerate(
+        prompt_lookup_generate_step(prompt, context, model, **kwargs)
+    ):
+        if n == 0:
+            prompt_tps = len(prompt) / (time.perf_counter() - tic)
+            tic = time.perf_counter()
+        if token in tokenizer.eos_token_ids:
+            break
+
+        yield GenerationResponse(
+            text="",
+            token=token,
+            logprobs=logprobs,
+            from_draft=from_draft,
+            prompt_tokens=len(prompt),
+            prompt_tps=prompt_tps,
+            generation_tokens=n + 1,
+            generation_tps=(n + 1) / (time.perf_counter() - tic),
+            peak_memory=mx.get_peak_memory() / 1e9,
+            finish_reason=None,
+        )
+
+    yield GenerationResponse(
+        text="",
+        token=token,
+        logprobs=logprobs,
+        from_draft=from_draft,
+        prompt_tokens=len(prompt),
+        prompt_tps=prompt_tps,
+        generation_tokens=n + 1,
+        generation_tps=(n + 1) / (time.perf_counter() - tic),
+        peak_memory=mx.get_peak_memory() / 1e9,
+        finish_reason="stop" if token in tokenizer.eos_token_ids else "length",
+    )
@@ -0,0 +1,411 @@
+"""
+Radix Prompt Cache Module
+
+This module keeps the KV cache of many prompts in a radix tree keyed by token
+IDs. Each node holds the KV of one run of tokens, so conversations that share a
+prefix, such as a system prompt, share its KV and diverge into separate branches
+after it. Nodes are evicted least recently used first once the tree outgrows its
+byte budget, except for the branches leased to running requests. Evicted nodes
+can be spilled to disk and restored when a prompt matches them again.
+"""
+
+import heapq
+import itertools
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import mlx.core as mx
+from mlx_lm.models.cache import KVCache, QuantizedKVCache
+
+from ...utils.logger import logger
+from ...utils.metrics import metrics
+from .spill_cache import SpillStore
+
+# Quantization of a node's KV as (group_size, bits), None for full precision
+_Quantization = Optional[Tuple[int, int]]
+
+
+def _slice(x: Any, start: int, end: int) -> Any:
+    """Copy positions ``start:end`` of an array or of each array of a quantized tuple"""
+    if isinstance(x, (tuple, list)):
+        return tuple(mx.contiguous(a[..., start:end, :]) for a in x)
+    return mx.contiguous(x[..., start:end, :])
+
+
+def _view(x: Any, end: int) -> Any:
+    """
+    Positions ``:end`` of an array or quantized tuple, sharing its memory
+
+    Always a new array object: a cache assigning into its keys would otherwise
+    change the tree's own array.
+    """
+    if isinstance(x, (tuple, list)):
+        return tuple(a[..., :end, :] for a in x)
+    return x[..., :end, :]
+
+
+def _concatenate(parts: List[Any]) -> Any:
+    if len(parts) == 1:
+        return parts[0]
+    if isinstance(parts[0], (tuple, list)):
+        return tuple(
+            mx.concatenate([part[i] for part in parts], axis=2)
+            for i in range(len(parts[0]))
+        )
+    return mx.concatenate(parts, axis=2)
+
+
+def _length(x: Any) -> int:
+    return (x[0] if isinstance(x, (tuple, list)) else x).shape[2]
+
+
+def _quantize(x: Any, group_size: int, bits: int) -> Any:
+    if isinstance(x, (tuple, list)):
+        return x
+    return mx.quantize(x, group_size=group_size, bits=bits)
+
+
+def _nbytes(x: Any) -> int:
+    if isinstance(x, (tuple, list)):
+        return sum(a.nbytes for a in x)
+    return x.nbytes
+
+
+def is_sliceable(cache: List[Any]) -> bool:
+    """Whether the KV of a cache can be split by token position"""
+    return bool(cache) and all(
+        type(c) in (KVCache, QuantizedKVCache) and c.keys is not None for c in cache
+    )
+
+
+class _Node:
+    """A run of tokens and, for every layer, the keys and values of that run"""
+
+    def __init__(
+        self,
+        tokens: List[int],
+        keys: List[Any],
+        values: List[Any],
+        quantization: _Quantization,
+        parent: Optional["_Node"],
+    ):
+        self.tokens = tokens
+        self.keys = keys
+        self.values = values
+        self.quantization = quantization
+        self.parent = parent
+        self.children: Dict[int, "_Node"] = {}
+        self.refs = 0
+        self.last_used = time.monotonic()
+        self.nbytes = self._count_bytes()
+
+    def _count_bytes(self) -> int:
+        return sum(_nbytes(k) + _nbytes(v) for k, v in zip(self.keys, self.values))
+
+    def split(self, at: int) -> "_Node":
+        """Move the first ``at`` tokens into a new parent node and return it"""
+        head = _Node(
+            self.tokens[:at],
+            [_slice(k, 0, at) for k in self.keys],
+            [_slice(v, 0, at) for v in self.values],
+            self.quantization,
+            self.parent,
+        )
+        head.last_used = self.last_used
+        self.parent.children[self.tokens[0]] = head
+        self.tokens = self.tokens[at:]
+        self.keys = [_slice(k, at, _length(k)) for k in self.keys]
+        self.values = [_slice(v, at, _length(v)) for v in self.values]
+        self.nbytes = self._count_bytes()
+        self.parent = head
+        head.children[self.tokens[0]] = self
+        return head
+
+
+class RadixTree:
+    """
+    Radix tree of KV cache segments, with one root per model key
+
+    A fetched branch is leased: its deepest node is referenced until the lease
+    is released, and since only leaves are evicted, the whole branch stays
+    resident meanwhile. Pinned branches, such as prompt snapshots, are leased for
+    good.
+
+    Attributes:
+        max_bytes: Byte budget for the KV held by the tree
+        nbytes: Bytes currently held
+        spill: Disk tier evicted nodes are written to, None to discard them
+    """
+
+    def __init__(self, max_bytes: int, spill: Optional[SpillStore] = None):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.spill = spill
+        self._roots: Dict[str, _Node] = {}
+        self._root_bytes: Dict[str, int] = {}
+        # Eviction candidates as (last_used, order, model_key, leaf), an entry
+        # is stale once its node was used again, got children or was evicted
+        self._leaves: List[Tuple[float, int, str, _Node]] = []
+        self._order = itertools.count()
+        self._nodes = 0
+
+    def _root(self, model_key: str) -> _Node:
+        if model_key not in self._roots:
+            self._roots[model_key] = _Node([], [], [], None, None)
+        return self._roots[model_key]
+
+    def _walk(self, model_key: str, tokens: List[int]) -> Tuple[List[_Node], int]:
+        """Nodes matching a prefix of ``tokens``, the last one maybe partially"""
+        path: List[_Node] = []
+        node = self._roots.get(model_key)
+        depth = 0
+        while node is not None and depth < len(tokens):
+            child = node.children.get(tokens[depth])
+            if child is None:
+                break
+            matched = 0
+            for a, b in zip(child.tokens, tokens[depth:]):
+                if a != b:
+                    break
+                matched += 1
+            path.append(child)
+            depth += matched
+            if matched < len(child.tokens):
+                break
+            node = child
+        return path, depth
+
+    def match_length(self, model_key: str, tokens: List[int]) -> int:
+        """Number of leading ``tokens`` whose KV the tree holds"""
+        return self._walk(model_key, tokens)[1]
+
+    def restore(self, model_key: str, tokens: List[int]) -> int:
+        """
+        Read spilled nodes extending the match of ``tokens`` back from disk
+
+        Args:
+            model_key: Model identifier the cache was stored under
+            tokens: Token sequence to look up
+
+        Returns:
+            int: Number of leading ``tokens`` the tree holds afterwards
+        """
+        depth = self.match_length(model_key, tokens)
+        while self.spill is not None:
+            entry = self.spill.find(model_key, tokens, depth)
+            if entry is None:
+                break
+            keys, values, quantization = self.spill.pop(entry)
+            self._insert(
+                model_key, entry.tokens, keys, values, quantization, entry.start
+            )
+            restored = self.match_length(model_key, tokens)
+            logger.debug(f"Restored {restored - depth} cached tokens from disk")
+            if restored <= depth:
+                break
+            depth = restored
+        return depth
+
+    def fetch(
+        self, model_key: str, tokens: List[int]
+    ) -> Tuple[int, Optional[List[Any]], Optional[_Node]]:
+        """
+        Build a KV cache for the longest cached prefix of ``tokens``
+
+        The cache reads the KV of the tree without copying it where it can. MLX
+        copies it before the cache writes into it, so the tree never changes
+        through a fetched cache.
+
+        Args:
+            model_key: Model identifier the cache was stored under
+            tokens: Token sequence to look up
+
+        Returns:
+            Tuple[int, Optional[List[Any]], Optional[_Node]]: Tuple containing:
+                1. Number of tokens of the prefix
+                2. A new per-layer cache holding them, None without a match
+                3. The leased node, to pass to :meth:`release` once the cache
+                   is no longer needed
+        """
+        path, depth = self._walk(model_key, tokens)
+        if depth == 0:
+            return 0, None, None
+
+        self._touch(model_key, path)
+        leased = path[-1]
+        leased.refs += 1
+
+        # The last node may only be needed up to the end of the match
+        keep = depth - sum(len(node.tokens) for node in path[:-1])
+        quantization = next(
+            (node.quantization for node in path if node.quantization), None
+        )
+        cache = []
+        for layer in range(len(path[0].keys)):
+            keys = [node.keys[layer] for node in path]
+            values = [node.values[layer] for node in path]
+            keys[-1] = _view(keys[-1], keep)
+            values[-1] = _view(values[-1], keep)
+            if quantization is None:
+                c = KVCache()
+            else:
+                group_size, bits = quantization
+                c = QuantizedKVCache(group_size=group_size, bits=bits)
+                keys = [_quantize(k, group_size, bits) for k in keys]
+                values = [_quantize(v, group_size, bits) for v in values]
+            c.keys = _concatenate(keys)
+            c.values = _concatenate(values)
+            c.offset = depth
+            cache.append(c)
+        return depth, cache, leased
+
+    def release(self, node: Optional[_Node]) -> None:
+        """Release a node leased by :meth:`fetch`"""
+        if node is not None:
+            node.refs -= 1
+
+    def insert(
+        self, model_key: str, tokens: List[int], cache: List[Any], pin: bool = False
+    ) -> None:
+        """
+        Store the KV of ``tokens`` that the tree doesn't hold yet
+
+        Args:
+            model_key: Model identifier to store the cache under
+            tokens: Tokens whose KV is at the start of ``cache``
+            cache: Per-layer KV cache holding at least ``len(tokens)`` positions
+            pin: Lease the branch of ``tokens`` for good, so it is never evicted
+        """
+        quantization = None
+        if isinstance(cache[0], QuantizedKVCache):
+            quantization = (cache[0].group_size, cache[0].bits)
+        self._insert(
+            model_key,
+            tokens,
+            [c.keys for c in cache],
+            [c.values for c in cache],
+            quantization,
+            pin=pin,
+        )
+
+    def _insert(
+        self,
+        model_key: str,
+        tokens: List[int],
+        keys: List[Any],
+        values: List[Any],
+        quantization: _Quantization,
+        start: int = 0,
+        pin: bool = False,
+    ) -> None:
+        """Store the KV of ``tokens``, given per layer from position ``start``"""
+        path, depth = self._walk(model_key, tokens)
+        self._touch(model_key, path)
+        if depth == len(tokens):
+            if pin and path:
+                path[-1].refs += 1
+            return
+        if depth < start:
+            # The prefix the KV continues from is gone
+            return
+
+        parent = path[-1] if path else self._root(model_key)
+        matched = depth - sum(len(node.tokens) for node in path[:-1])
+        if path and matched < len(parent.tokens):
+            # Diverged in the middle of a node
+            nbytes = parent.nbytes
+            parent = parent.split(matched)
+            (tail,) = parent.children.values()
+            self._nodes += 1
+            self._add_bytes(model_key, parent.nbytes + tail.nbytes - nbytes)
+
+        node = _Node(
+            tokens[depth:],
+            [_slice(k, depth - start, len(tokens) - start) for k in keys],
+            [_slice(v, depth - start, len(tokens) - start) for v in values],
+            quantization,
+            parent,
+        )
+        mx.eval(node.keys, node.values)
+        parent.children[node.tokens[0]] = node
+        if pin:
+            node.refs += 1
+        self._nodes += 1
+        self._push_leaf(model_key, node)
+        self._add_bytes(model_key, node.nbytes)
+        logger.debug(
+            f"Cached {len(node.tokens)} tokens after a {depth} token prefix, "
+            f"prompt cache holds {self.nbytes} bytes"
+        )
+        self._evict()
+
+    def _add_bytes(self, model_key: str, nbytes: int) -> None:
+        self.nbytes += nbytes
+        self._root_bytes[model_key] = self._root_bytes.get(model_key, 0) + nbytes
+        metrics.set("prompt_cache_bytes", self._root_bytes[model_key], model=model_key)
+
+    def _touch(self, model_key: str, path: List[_Node]) -> None:
+        now = time.monotonic()
+        for node in path:
+            node.last_used = now
+        if path and not path[-1].children:
+            self._push_leaf(model_key, path[-1])
+
+    def _push_leaf(self, model_key: str, node: _Node) -> None:
+        heapq.heappush(
+            self._leaves, (node.last_used, next(self._order), model_key, node)
+        )
+        if len(self._leaves) > 2 * self._nodes + 64:
+            # Drop the stale entries left by nodes used again and again
+            self._leaves = [entry for entry in self._leaves if _is_current(entry)]
+            heapq.heapify(self._leaves)
+
+    def _evict(self) -> None:
+        """Drop least recently used unleased leaves until within budget"""
+        leased = []
+        while self.nbytes > self.max_bytes and self._leaves:
+            entry = heapq.heappop(self._leaves)
+            if not _is_current(entry):
+                continue
+            _, _, model_key, victim = entry
+            if victim.refs > 0:
+                leased.append(entry)
+                continue
+            parent = victim.parent
+            del parent.children[victim.tokens[0]]
+            victim.parent = None
+            self._nodes -= 1
+            if not parent.children and parent.parent is not None:
+                self._push_leaf(model_key, parent)
+            self._add_bytes(model_key, -victim.nbytes)
+            metrics.increment(
+                "prompt_cache_evicted_tokens", len(victim.tokens), model=model_key
+            )
+            logger.debug(f"Evicted {len(victim.tokens)} cached tokens")
+            if self.spill is not None:
+                prefix = _branch_tokens(parent)
+                self.spill.put(
+                    model_key,
+                    prefix + victim.tokens,
+                    len(prefix),
+                    victim.keys,
+                    victim.values,
+                    victim.quantization,
+                )
+        for entry in leased:
+            heapq.heappush(self._leaves, entry)
+
+
+def _is_current(entry: Tuple[float, int, str, _Node]) -> bool:
+    """Whether a heap entry still stands for an evictable leaf"""
+    last_used, _, _, node = entry
+    return node.parent is not None and not node.children and node.last_used == last_used
+
+
+def _branch_tokens(node: _Node) -> List[int]:
+    """Tokens from the root down to and including ``node``"""
+    runs = []
+    while node is not None:
+        runs.append(node.tokens)
+        node = node.parent
+    return [token for run in reversed(runs) for token in run]
@@ -0,0 +1,74 @@
+"""
+Seeded Sampler Module
+
+This module samples tokens from a random stream owned by one completion. The
+samplers made by mlx_lm draw from MLX's global random state, so the tokens of a
+request would depend on every other request decoded in the same process. Here
+each completion holds its own PRNG key, derived from the request's ``seed`` and
+split once per sampled token, so a seed gives the same tokens whether the
+request runs alone or batched with others.
+"""
+
+import secrets
+from typing import Callable, List
+
+import mlx.core as mx
+from mlx_lm.sample_utils import apply_min_p, apply_top_k, apply_top_p
+
+# Seeds are reduced to the 64 bits a PRNG key is made from
+_SEED_MASK = (1 << 64) - 1
+
+
+def random_seed() -> int:
+    """A seed for requests that don't set one, to report back to the client"""
+    return secrets.randbits(63)
+
+
+class SeededSampler:
+    """
+    Sampler with the same filters as mlx_lm's ``make_sampler``, drawing from
+    its own PRNG key instead of the global random state
+    """
+
+    def __init__(
+        self,
+        key: mx.array,
+        temp: float = 0.0,
+        top_p: float = 0.0,
+        min_p: float = 0.0,
+        min_tokens_to_keep: int = 1,
+        top_k: int = -1,
+    ):
+        self._key = key
+        self._temp = temp
+        self._filters: List[Callable[[mx.array], mx.array]] = []
+        if top_k > 0:
+            self._filters.append(lambda x: apply_top_k(x, top_k))
+        if 0 < top_p < 1.0:
+            self._filters.append(lambda x: apply_top_p(x, top_p))
+        if min_p != 0.0:
+            self._filters.append(lambda x: apply_min_p(x, min_p, min_tokens_to_keep))
+
+    def __call__(self, logprobs: mx.array) -> mx.array:
+        if self._temp == 0:
+            return mx.argmax(logprobs, axis=-1)
+        for apply_filter in self._filters:
+            logprobs = apply_filter(logprobs)
+        self._key, key = mx.random.split(self._key)
+        return mx.random.categorical(logprobs * (1 / self._temp), key=key)
+
+
+def make_seeded_samplers(seed: int, n: int = 1, **kwargs) -> List[SeededSampler]:
+    """
+    Make the samplers of the choices of one request
+
+    Args:
+        seed: The request's seed
+        n: Number of choices, each samples from its own stream
+        **kwargs: Sampling parameters, as taken by mlx_lm's ``make_sampler``
+
+    Returns:
+        List[SeededSampler]: One sampler per choice
+    """
+    keys = mx.random.split(mx.random.key(seed & _SEED_MASK), n)
+    return [SeededSampler(keys[i], **kwargs) for i in range(n)]
@@ -0,0 +1,910 @@
+"""
+Continuous Batching Scheduler Module
+
+This module runs every generation of one model on a single worker thread and
+merges concurrent requests into shared batched decode steps. Requests join the
+batch as soon as they are prefilled and leave it as soon as they finish. Long
+prompts are prefilled in chunks with decode steps in between, so streams that
+are already running keep producing tokens while a big prompt is ingested.
+
+Interactive requests go ahead of batch requests at every stage. They are
+admitted and prefilled first, batch sequences are preempted to make room for
+them in a full batch, and a batch that only decodes batch sequences pauses
+while an interactive prompt is prefilled. Preempted sequences keep their KV in
+the prompt cache and resume from it. Batch work that was held back for too many
+iterations in a row gets a turn ahead of interactive work, so it never starves.
+
+Sequences past their deadline are ended wherever they are, queued, prefilling
+or decoding, with a final response for what they generated so far.
+"""
+
+import itertools
+import queue
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, replace
+from typing import Callable, Deque, Dict, Iterator, List, Optional, TypeVar
+
+import mlx.core as mx
+import mlx.nn as nn
+from mlx_lm.generate import GenerationResponse
+from mlx_lm.tokenizer_utils import TokenizerWrapper
+
+from ...utils.admission import BATCH, INTERACTIVE, PRIORITIES, check_priority
+from ...utils.logger import logger
+from ...utils.metrics import metrics
+from .batch_generator import BatchGenerator, is_batchable
+from .prompt_cache import (
+    CacheLease,
+    PromptCache,
+    common_prefix_length,
+    extend_prompt_cache,
+    kv_cache_nbytes,
+    lease_prompt_cache,
+    prefill_prompt_cache,
+    release_lease,
+    return_lease,
+    store_prompt_cache,
+)
+
+T = TypeVar("T")
+
+
+class SequenceHandle:
+    """
+    Handle for one submitted generation
+
+    Iterating the handle yields GenerationResponse objects as the worker thread
+    produces them. Closing the iterator early cancels the generation, and so
+    does setting the ``abort`` event, which the worker checks every step
+    without waiting for the consumer. Once the deadline passes, the worker
+    ends the generation with a ``length`` finish reason.
+
+    Attributes:
+        uid: Scheduler-wide sequence identifier
+        cached_tokens: Number of prompt tokens served from the prompt cache
+        tokens: Tokens generated so far
+        accepted_draft_tokens: Speculative draft tokens accepted by the model
+        rejected_draft_tokens: Speculative draft tokens rejected by the model
+        abort: Event set once the client of the request went away
+        priority: ``interactive`` or ``batch``
+        deadline: When to stop generating, on the ``time.monotonic`` clock
+    """
+
+    def __init__(
+        self,
+        uid: int,
+        prompt: List[int],
+        max_tokens: int = 0,
+        sampler: Optional[Callable[[mx.array], mx.array]] = None,
+        logits_processors: Optional[List[Callable]] = None,
+        job: Optional[Callable[["SequenceHandle"], Iterator]] = None,
+        abort: Optional[threading.Event] = None,
+        priority: str = INTERACTIVE,
+        deadline: Optional[float] = None,
+    ):
+        self.uid = uid
+        self.prompt = prompt
+        self.max_tokens = max_tokens
+        self.sampler = sampler
+        self.logits_processors = logits_processors
+        self.job = job
+        self.cached_tokens = 0
+        self.tokens: List[int] = []
+        self.accepted_draft_tokens = 0
+        self.rejected_draft_tokens = 0
+        self.abort = abort
+        self.priority = check_priority(priority)
+        self.deadline = deadline
+        self._cancelled = False
+        self._prompt_tokens = 0
+        self._prompt_tps = 0.0
+        self._generation_tokens = 0
+        self._kept_tokens: Optional[int] = None
+        self._started = 0.0
+        self._outputs: "queue.Queue" = queue.Queue()
+        self._consumed = threading.Event()
+
+    @property
+    def exclusive(self) -> bool:
+        return self.job is not None
+
+    @property
+    def context(self) -> List[int]:
+        """The prompt and the tokens generated so far, where a preempted
+        sequence resumes from"""
+        return self.prompt + self.tokens
+
+    @property
+    def aborted(self) -> bool:
+        """Whether the client went away"""
+        return self.abort is not None and self.abort.is_set()
+
+    @property
+    def cancelled(self) -> bool:
+        """Whether the consumer no longer wants tokens"""
+        return self._cancelled or self.aborted
+
+    @property
+    def expired(self) -> bool:
+        """Whether the deadline passed"""
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+    @property
+    def stopped(self) -> bool:
+        """Whether the worker should stop the sequence before it finishes"""
+        return self.cancelled or self.expired
+
+    def cancel(self) -> None:
+        self._cancelled = True
+
+    def keep_tokens(self, num_tokens: int) -> None:
+        """
+        Only keep the first ``num_tokens`` generated tokens in the prompt cache
+
+        Called by the consumer when it discards the end of the completion, such
+        as a matched stop sequence, so the next turn doesn't miss on it.
+        """
+        self._kept_tokens = num_tokens
+
+    @property
+    def kept_tokens(self) -> List[int]:
+        """Generated tokens to keep in the prompt cache"""
+        return self.tokens[: self._kept_tokens]
+
+    @property
+    def consumed(self) -> bool:
+        """Whether the consumer stopped reading responses, after which
+        :attr:`kept_tokens` no longer changes"""
+        return self._consumed.is_set()
+
+    def record_draft(self, drafted: int, accepted: int) -> None:
+        self.accepted_draft_tokens += accepted
+        self.rejected_draft_tokens += drafted - accepted
+
+    def put(self, response: GenerationResponse) -> None:
+        self._outputs.put(response)
+
+    def finish(self) -> None:
+        self._outputs.put(None)
+
+    def fail(self, error: Exception) -> None:
+        self._outputs.put(error)
+
+    def __iter__(self) -> Iterator[GenerationResponse]:
+        try:
+            while True:
+                item = self._outputs.get()
+                if item is None:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            self.cancel()
+            self._consumed.set()
+
+
+def available_memory() -> Optional[int]:
+    """Bytes the device can still allocate, None when the device doesn't say"""
+    device_info = mx.device_info() if hasattr(mx, "device_info") else {}
+    if not device_info and mx.metal.is_available():
+        device_info = mx.metal.device_info()
+    limit = device_info.get("max_recommended_working_set_size")
+    if limit is None:
+        return None
+    return max(limit - mx.get_active_memory(), 0)
+
+
+@dataclass
+class _Prefill:
+    """A group whose prompt is being fed into the cache it leased"""
+
+    group: List[SequenceHandle]
+    prompt: List[int]
+    lease: CacheLease
+    remaining: List[int]
+    prompt_tokens: int
+    cached_tokens: int
+    started: float
+
+
+class ContinuousBatchScheduler:
+    """
+    Per-model scheduler that merges all active sequences into one decode step
+
+    Batched requests lease their cached prefix from the prompt cache tree and
+    are prefilled into a private copy-on-write cache, so several of them can be
+    prefilled side by side before they are decoded together. Every iteration of
+    the worker feeds at most one chunk of prefill before running a decode step
+    for the active sequences, so the inter-token latency of running streams
+    stays bounded by the chunk size. The chunk goes to the prefills in turn, so
+    a short prompt doesn't wait for a long one ahead of it to be ingested. The
+    chunk size shrinks when free memory runs low, based on the memory the
+    previous chunks needed per token.
+
+    Requests the batch engine cannot serve are submitted as exclusive jobs,
+    which run alone once the batch has drained and generate from the working
+    sequence of the prompt cache. The worker thread is started on demand and
+    exits when it runs out of work.
+
+    Interactive sequences are served first. Batch sequences make room for them
+    in a full batch by leaving it with their KV stored in the prompt cache tree,
+    and are queued again to resume from it. Once batch work has been held back
+    for ``max_batch_stalls`` iterations in a row, the next iteration serves it
+    first.
+    """
+
+    def __init__(
+        self,
+        model_key: str,
+        model: nn.Module,
+        tokenizer: TokenizerWrapper,
+        prompt_cache: PromptCache,
+        max_batch_size: int = 16,
+        prefill_step_size: int = 512,
+        min_prefill_step_size: int = 64,
+        prefill_memory_fraction: float = 0.5,
+        kv_bits: Optional[int] = None,
+        kv_group_size: int = 64,
+        quantized_kv_start: int = 0,
+        max_batch_stalls: int = 8,
+    ):
+        self._model_key = model_key
+        self._model = model
+        self._prompt_cache = prompt_cache
+        self._max_batch_size = max_batch_size
+        self._prefill_step_size = prefill_step_size
+        self._min_prefill_step_size = min(min_prefill_step_size, prefill_step_size)
+        self._prefill_memory_fraction = prefill_memory_fraction
+        self._prefill_bytes_per_token: Optional[float] = None
+        self._prefills: List[_Prefill] = []
+        self._batching_enabled = is_batchable(model)
+        self._kv_bits = kv_bits
+        self._kv_group_size = kv_group_size
+        self._quantized_kv_start = quantized_kv_start
+        self._generator = BatchGenerator(
+            model,
+            tokenizer.eos_token_ids,
+            kv_bits=kv_bits,
+            kv_group_size=kv_group_size,
+            quantized_kv_start=quantized_kv_start,
+        )
+        self._active: Dict[int, SequenceHandle] = {}
+        self._pending: Deque[List[SequenceHandle]] = deque()
+        self._condition = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self._uids = itertools.count()
+        self._max_batch_stalls = max_batch_stalls
+        # Iterations in a row in which batch work waited without progress
+        self._batch_stalls = 0
+        self._batch_turn = False
+        self._batch_progress = False
+        # Exclusive generation whose generated tokens aren't in the working
+        # sequence yet, until its consumer knows which ones to keep
+        self._unsettled: Optional[SequenceHandle] = None
+
+        if not self._batching_enabled:
+            logger.info(
+                f"Model {model_key} does not support batched decoding, "
+                "requests will run sequentially"
+            )
+
+    @property
+    def batching_enabled(self) -> bool:
+        return self._batching_enabled
+
+    def submit(
+        self,
+        prompt: List[int],
+        max_tokens: int,
+        samplers: List[Callable[[mx.array], mx.array]],
+        logits_processors: Optional[List[Optional[List[Callable]]]] = None,
+        abort: Optional[threading.Event] = None,
+        priority: str = INTERACTIVE,
+        deadline: Optional[float] = None,
+    ) -> List[SequenceHandle]:
+        """
+        Queue a prompt for batched decoding
+
+        The prompt is prefilled once and forked into one sequence per sampler,
+        all of which are decoded in the same batch.
+
+        Args:
+            prompt: Encoded prompt tokens
+            max_tokens: Maximum number of tokens to generate per sequence
+            samplers: One sampler per sequence
+            logits_processors: One list of logits processors per sequence
+            abort: Event that cancels every sequence once set
+            priority: ``interactive`` or ``batch``
+            deadline: When to stop generating, on the ``time.monotonic`` clock
+
+        Returns:
+            List[SequenceHandle]: One handle per sequence, in sampler order
+        """
+        logits_processors = logits_processors or [None] * len(samplers)
+        group = [
+            SequenceHandle(
+                uid=next(self._uids),
+                prompt=prompt,
+                max_tokens=max_tokens,
+                sampler=sampler,
+                logits_processors=processors,
+                abort=abort,
+                priority=priority,
+                deadline=deadline,
+            )
+            for sampler, processors in zip(samplers, logits_processors)
+        ]
+        self._enqueue(group)
+        return group
+
+    def submit_exclusive(
+        self,
+        job: Callable[[SequenceHandle], Iterator[GenerationResponse]],
+        abort: Optional[threading.Event] = None,
+        priority: str = INTERACTIVE,
+        deadline: Optional[float] = None,
+    ) -> SequenceHandle:
+        """
+        Queue a job that needs the model for itself
+
+        The job is called on the worker thread with its handle and must return an
+        iterator of GenerationResponse objects. Setting ``abort`` stops it after
+        the response it is producing, and so does reaching the ``deadline``.
+        An interactive job preempts the batch sequences it would wait for, but
+        a running job is never preempted.
+        """
+        handle = SequenceHandle(
+            uid=next(self._uids),
+            prompt=[],
+            job=job,
+            abort=abort,
+            priority=priority,
+            deadline=deadline,
+        )
+        self._enqueue([handle])
+        return handle
+
+    def call_exclusive(self, fn: Callable[[], T]) -> T:
+        """
+        Run a function on the worker thread once the batch has drained
+
+        This is how the prompt cache is changed from outside of generation.
+
+        Returns:
+            The function's result, exceptions are raised in the caller
+        """
+        results = []
+
+        def job(handle: SequenceHandle) -> Iterator[GenerationResponse]:
+            results.append(fn())
+            return iter(())
+
+        for _ in self.submit_exclusive(job):
+            pass
+        return results[0]
+
+    def _enqueue(self, group: List[SequenceHandle]) -> None:
+        with self._condition:
+            self._pending.append(group)
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run,
+                    name=f"scheduler-{self._model_key}",
+                    daemon=True,
+                )
+                self._thread.start()
+            self._condition.notify()
+
+    def _priority_order(self) -> List[str]:
+        """Priorities in the order they are served this iteration"""
+        if self._batch_turn:
+            return [BATCH, INTERACTIVE]
+        return list(PRIORITIES)
+
+    def _take_admission(self) -> Optional[List[SequenceHandle]]:
+        for group in [group for group in self._pending if group[0].stopped]:
+            if all(handle.stopped for handle in group):
+                self._count_aborted(group, "queued")
+                self._pending.remove(group)
+                for handle in group:
+                    self._end(handle, "queued")
+
+        # Groups of the same priority are admitted in order
+        group = None
+        for priority in self._priority_order():
+            group = next((g for g in self._pending if g[0].priority == priority), None)
+            if group is not None:
+                break
+        if group is None:
+            return None
+        preempts = group[0].priority == INTERACTIVE and not self._batch_turn
+
+        if group[0].exclusive:
+            if preempts:
+                self._preempt()
+            if self._prefills or self._generator.active:
+                return None
+        else:
+            # A group larger than the batch limit still runs once the batch is empty
+            rows = self._generator.active + sum(
+                len(prefill.group) for prefill in self._prefills
+            )
+            excess = rows + len(group) - self._max_batch_size
+            if rows > 0 and excess > 0 and not (preempts and self._preempt(excess)):
+                return None
+            if self._shares_running_prefill(group[0].context):
+                return None
+        self._pending.remove(group)
+        if group[0].priority == BATCH:
+            self._batch_progress = True
+        return group
+
+    def _preempt(self, rows: Optional[int] = None) -> bool:
+        """
+        Move batch sequences out of the batch to make room for interactive ones
+
+        The KV of preempted sequences is kept in the prompt cache tree, and they
+        are queued again ahead of other batch work to resume from it. The most
+        recently admitted sequences go first, decoding ones before prefilling.
+
+        Args:
+            rows: Number of batch rows to free, None frees all of them
+
+        Returns:
+            bool: Whether that many rows were freed, nothing is preempted if
+            they can't be
+        """
+        if self._prompt_cache.tree is None:
+            return False
+        decoding = [
+            handle
+            for handle in reversed(self._active.values())
+            if handle.priority == BATCH and not handle.stopped
+        ]
+        prefilling = [
+            prefill
+            for prefill in reversed(self._prefills)
+            if prefill.group[0].priority == BATCH
+        ]
+        if rows is None:
+            rows = len(decoding) + sum(len(p.group) for p in prefilling)
+        if rows <= 0 or len(decoding) + sum(len(p.group) for p in prefilling) < rows:
+            return False
+
+        requeued = []
+        freed = 0
+        for handle in decoding:
+            if freed >= rows:
+                break
+            self._store(handle, self._generator.extract(handle.uid))
+            self._generator.remove([handle.uid])
+            del self._active[handle.uid]
+            requeued.append([handle])
+            freed += 1
+        self._count_preempted(freed, "decode")
+        for prefill in prefilling:
+            if freed >= rows:
+                break
+            self._prefills.remove(prefill)
+            self._return_lease(prefill.lease)
+            requeued.append(prefill.group)
+            freed += len(prefill.group)
+            self._count_preempted(len(prefill.group), "prefill")
+
+        # Back in the order they were admitted, ahead of the other batch work
+        for group in requeued:
+            self._pending.appendleft(group)
+        return True
+
+    def _count_preempted(self, count: int, stage: str) -> None:
+        if count:
+            metrics.increment(
+                "preempted_sequences", count, model=self._model_key, stage=stage
+            )
+            logger.debug(f"Preempted {count} batch sequences during {stage}")
+
+    def _shares_running_prefill(self, prompt: List[int]) -> bool:
+        """
+        Whether a prompt should wait for a prefill computing the same prefix
+
+        Its lease would miss the tokens the running prefill is about to store in
+        the tree, and computing them twice costs more than waiting, unless only
+        a few tokens are shared.
+        """
+        tree = self._prompt_cache.tree
+        if not self._prefills or tree is None:
+            return False
+        cached = tree.match_length(self._model_key, prompt[:-1])
+        return any(
+            common_prefix_length(prefill.prompt[:-1], prompt[:-1])
+            >= cached + self._min_prefill_step_size
+            for prefill in self._prefills
+        )
+
+    def _run(self) -> None:
+        while True:
+            self._settle_exclusive()
+            # Sequences cancelled at a stop sequence store their KV before a
+            # next turn leases the prompt cache
+            self._drop_stopped()
+            self._batch_turn = self._batch_stalls >= self._max_batch_stalls
+            self._batch_progress = False
+            while True:
+                with self._condition:
+                    if (
+                        not self._pending
+                        and not self._prefills
+                        and not self._generator.active
+                    ):
+                        self._thread = None
+                        return
+                    group = self._take_admission()
+                if group is None:
+                    break
+                # The next job and lease start from the working sequence
+                self._settle_exclusive(force=True)
+                if group[0].exclusive:
+                    self._run_exclusive(group[0])
+                    break
+                self._start_prefill(group)
+
+            # Short prompts share one chunk budget, a long one takes several
+            # iterations with decode steps in between
+            budget = self.prefill_chunk_size()
+            order = self._priority_order()
+            for prefill in sorted(
+                self._prefills, key=lambda p: order.index(p.group[0].priority)
+            ):
+                if budget <= 0:
+                    break
+                budget -= self._prefill_chunk(prefill, budget)
+                if prefill.group[0].priority == BATCH:
+                    self._batch_progress = True
+                if prefill in self._prefills:
+                    # Next iteration starts with the prefills after this one
+                    self._prefills.remove(prefill)
+                    self._prefills.append(prefill)
+
+            self._drop_stopped()
+            if self._generator.active and not self._pause_batch():
+                if any(h.priority == BATCH for h in self._active.values()):
+                    self._batch_progress = True
+                self._step()
+
+            with self._condition:
+                batch_waiting = any(
+                    group[0].priority == BATCH for group in self._pending
+                ) or any(
+                    prefill.group[0].priority == BATCH for prefill in self._prefills
+                )
+            if self._batch_turn and self._batch_progress:
+                metrics.increment("batch_fairness_turns", model=self._model_key)
+            if self._batch_progress or not batch_waiting:
+                self._batch_stalls = 0
+            else:
+                self._batch_stalls += 1
+
+    def _pause_batch(self) -> bool:
+        """
+        Whether to skip the decode step so an interactive prompt is prefilled
+        sooner, when only batch sequences would be decoded
+
+        The paused sequences keep their rows and KV in the batch.
+        """
+        return (
+            not self._batch_turn
+            and any(
+                prefill.group[0].priority == INTERACTIVE for prefill in self._prefills
+            )
+            and all(handle.priority == BATCH for handle in self._active.values())
+        )
+
+    def _run_exclusive(self, handle: SequenceHandle) -> None:
+        responses = None
+        try:
+            responses = handle.job(handle)
+            for response in responses:
+                # The final response repeats the last token unless it is EOS
+                if response.finish_reason is None or response.finish_reason == "stop":
+                    handle.tokens.append(response.token)
+                if handle.cancelled:
+                    self._count_aborted([handle], "decode")
+                    break
+                handle.put(response)
+                if response.finish_reason is None and handle.expired:
+                    self._count_expired([handle], "decode")
+                    handle.put(replace(response, finish_reason="length"))
+                    break
+            handle.finish()
+        except Exception as e:
+            logger.error(f"Error during exclusive generation: {str(e)}", exc_info=True)
+            handle.fail(e)
+        finally:
+            if responses is not None and hasattr(responses, "close"):
+                responses.close()
+            # Jobs generate from the working sequence of the prompt cache. The
+            # consumer may still be matching stop sequences in the responses
+            # the job produced, so the tokens to keep are only known once it
+            # is done.
+            if handle.tokens:
+                self._unsettled = handle
+
+    def _settle_exclusive(self, force: bool = False) -> None:
+        """
+        Append the tokens the last exclusive generation keeps to the working
+        sequence, once its consumer is done or, with ``force``, right away
+
+        A consumer still reading hasn't matched its stop sequences yet, so all
+        of the tokens are appended. Whatever it keeps is their prefix, which a
+        next turn still finds in the tree.
+        """
+        handle = self._unsettled
+        if handle is None:
+            return
+        consumed = handle.consumed
+        if not (consumed or force):
+            return
+        self._unsettled = None
+        extend_prompt_cache(
+            self._prompt_cache, handle.kept_tokens if consumed else handle.tokens
+        )
+
+    def prefill_chunk_size(self) -> int:
+        """
+        Number of prompt tokens to prefill before the next decode step
+
+        Returns:
+            int: The configured chunk size, reduced so that the next chunk fits
+            in a fraction of the free memory once its cost per token is known
+        """
+        free = available_memory()
+        if free is None or not self._prefill_bytes_per_token:
+            return self._prefill_step_size
+        fits = int(free * self._prefill_memory_fraction / self._prefill_bytes_per_token)
+        return max(self._min_prefill_step_size, min(self._prefill_step_size, fits))
+
+    def _start_prefill(self, group: List[SequenceHandle]) -> None:
+        try:
+            # A preempted sequence continues after the tokens it generated
+            prompt = group[0].context
+            lease, processed_prompt, cached_tokens = lease_prompt_cache(
+                prompt, self._prompt_cache, self._model_key, self._model
+            )
+        except Exception as e:
+            logger.error(f"Error during prefill: {str(e)}", exc_info=True)
+            for handle in group:
+                handle.fail(e)
+            return
+
+        # The last prompt token is fed by the first batched step, so the lease
+        # only ever holds the tokens that were actually prefilled.
+        self._prefills.append(
+            _Prefill(
+                group=group,
+                prompt=prompt,
+                lease=lease,
+                remaining=processed_prompt[:-1],
+                prompt_tokens=len(processed_prompt),
+                cached_tokens=cached_tokens,
+                started=time.perf_counter(),
+            )
+        )
+
+    def _prefill_chunk(self, prefill: _Prefill, budget: int) -> int:
+        """Feed one chunk of a prefill, returns the tokens consumed"""
+        if all(handle.stopped for handle in prefill.group):
+            # What was prefilled so far stays in the prompt cache for reuse
+            self._count_aborted(prefill.group, "prefill")
+            self._prefills.remove(prefill)
+            self._return_lease(prefill.lease)
+            for handle in prefill.group:
+                self._end(handle, "prefill")
+            return 0
+
+        chunk = prefill.remaining[:budget]
+        try:
+            if chunk:
+                active_memory = mx.get_active_memory()
+                mx.reset_peak_memory()
+                prefill_prompt_cache(
+                    self._model,
+                    prefill.lease.cache,
+                    chunk,
+                    kv_bits=self._kv_bits,
+                    kv_group_size=self._kv_group_size,
+                    quantized_kv_start=self._quantized_kv_start,
+                )
+                bytes_per_token = (mx.get_peak_memory() - active_memory) / len(chunk)
+                self._prefill_bytes_per_token = max(
+                    bytes_per_token, 0.9 * (self._prefill_bytes_per_token or 0)
+                )
+                prefill.remaining = prefill.remaining[len(chunk) :]
+                prefill.lease.tokens.extend(chunk)
+        except Exception as e:
+            logger.error(f"Error during prefill: {str(e)}", exc_info=True)
+            self._prefills.remove(prefill)
+            release_lease(self._prompt_cache, prefill.lease)
+            for handle in prefill.group:
+                handle.fail(e)
+            return len(chunk)
+
+        if not prefill.remaining:
+            self._prefills.remove(prefill)
+            self._admit(prefill)
+            self._return_lease(prefill.lease)
+            self._report_memory()
+        return max(len(chunk), 1)
+
+    def _admit(self, prefill: _Prefill) -> None:
+        group = prefill.group
+        try:
+            prompt_tps = prefill.prompt_tokens / (time.perf_counter() - prefill.started)
+            for handle in group:
+                if handle.stopped:
+                    self._count_aborted([handle], "prefill")
+                    self._end(handle, "prefill")
+                    continue
+                self._generator.insert(
+                    uid=handle.uid,
+                    prompt_cache=prefill.lease.cache,
+                    prompt=prefill.prompt,
+                    sampler=handle.sampler,
+                    logits_processors=handle.logits_processors,
+                    max_tokens=handle.max_tokens - len(handle.tokens),
+                )
+                if not handle.tokens:
+                    # A resumed sequence reports the usage of its first prefill
+                    handle.cached_tokens = prefill.cached_tokens
+                    handle._prompt_tokens = prefill.prompt_tokens
+                    handle._prompt_tps = prompt_tps
+                    handle._started = time.perf_counter()
+                self._active[handle.uid] = handle
+            logger.debug(
+                f"Admitted {len(group)} sequences with {prefill.cached_tokens} cached "
+                f"tokens, {self._generator.active} active sequences"
+            )
+        except Exception as e:
+            logger.error(f"Error during prefill: {str(e)}", exc_info=True)
+            for handle in group:
+                if self._active.pop(handle.uid, None) is not None:
+                    self._generator.remove([handle.uid])
+                handle.fail(e)
+
+    def _drop_stopped(self) -> None:
+        stopped = [uid for uid, handle in self._active.items() if handle.stopped]
+        if not stopped:
+            return
+        self._count_aborted([self._active[uid] for uid in stopped], "decode")
+        if self._prompt_cache.tree is not None:
+            for uid in stopped:
+                self._store(self._active[uid], self._generator.extract(uid))
+        self._generator.remove(stopped)
+        for uid in stopped:
+            self._end(self._active.pop(uid), "decode")
+
+    def _end(self, handle: SequenceHandle, stage: str) -> None:
+        """
+        End a sequence the worker stopped, past its deadline its consumer gets
+        a final response for the tokens generated so far
+        """
+        if not handle.cancelled and handle.expired:
+            self._count_expired([handle], stage)
+            if not handle._prompt_tokens:
+                handle._prompt_tokens = len(handle.prompt)
+            # Like the final response of a finished sequence, it repeats the
+            # last token
+            token = handle.tokens[-1] if handle.tokens else 0
+            handle.put(self._make_response(handle, token, None, finish_reason="length"))
+        handle.finish()
+
+    def _count_expired(self, handles: List[SequenceHandle], stage: str) -> None:
+        metrics.increment(
+            "expired_sequences", len(handles), model=self._model_key, stage=stage
+        )
+        logger.debug(f"Ended {len(handles)} sequences at their deadline in {stage}")
+
+    def _count_aborted(self, handles: List[SequenceHandle], stage: str) -> None:
+        """Count the sequences dropped because their client went away"""
+        aborted = sum(handle.aborted for handle in handles)
+        if aborted:
+            metrics.increment(
+                "cancelled_sequences", aborted, model=self._model_key, stage=stage
+            )
+            logger.debug(f"Dropped {aborted} aborted sequences during {stage}")
+
+    def _report_memory(self) -> None:
+        """Publish the KV cache memory of the prompt cache and the batch"""
+        leased = [c for prefill in self._prefills for c in prefill.lease.cache]
+        for name, cache in (
+            ("prompt", self._prompt_cache.cache + leased),
+            ("batch", self._generator.cache),
+        ):
+            nbytes, full_precision_nbytes = kv_cache_nbytes(cache)
+            labels = {"model": self._model_key, "cache": name}
+            metrics.set("kv_cache_bytes", nbytes, **labels)
+            metrics.set(
+                "kv_cache_saved_bytes", full_precision_nbytes - nbytes, **labels
+            )
+
+    def _step(self) -> None:
+        try:
+            responses = self._generator.step(
+                extract_finished=self._prompt_cache.tree is not None
+            )
+        except Exception as e:
+            logger.error(f"Error during batched decoding: {str(e)}", exc_info=True)
+            for handle in self._active.values():
+                handle.fail(e)
+            self._active.clear()
+            self._generator.reset()
+            return
+
+        for response in responses:
+            handle = self._active[response.uid]
+            handle._generation_tokens += 1
+            handle.tokens.append(response.token)
+            if response.finish_reason != "stop":
+                handle.put(
+                    self._make_response(handle, response.token, response.logprobs)
+                )
+            if response.finish_reason is not None:
+                handle.put(
+                    self._make_response(
+                        handle,
+                        response.token,
+                        response.logprobs,
+                        finish_reason=response.finish_reason,
+                    )
+                )
+                handle.finish()
+                del self._active[response.uid]
+                self._store(handle, response.cache)
+
+        # Shapes are enough to size the cache, so this doesn't sync the device
+        if self._generator.cache and self._generator.cache[0]._idx % 64 == 0:
+            self._report_memory()
+
+    def _return_lease(self, lease: CacheLease) -> None:
+        """Keep the KV a lease prefilled in the prompt cache tree"""
+        try:
+            return_lease(self._prompt_cache, self._model_key, lease)
+        except Exception as e:
+            logger.warning(f"Failed to cache prompt tokens: {str(e)}")
+
+    def _store(self, handle: SequenceHandle, cache: Optional[List]) -> None:
+        """Keep the KV of a sequence leaving the batch in the prompt cache tree"""
+        if cache is None:
+            return
+        try:
+            store_prompt_cache(
+                self._prompt_cache,
+                self._model_key,
+                handle.prompt + handle.kept_tokens,
+                cache,
+            )
+        except Exception as e:
+            logger.warning(f"Failed to cache generated tokens: {str(e)}")
+
+    @staticmethod
+    def _make_response(
+        handle: SequenceHandle,
+        token: int,
+        logprobs: Optional[mx.array],
+        finish_reason: Optional[str] = None,
+    ) -> GenerationResponse:
+        elapsed = max(time.perf_counter() - handle._started, 1e-9)
+        return GenerationResponse(
+            text="",
+            token=token,
+            logprobs=logprobs,
+            from_draft=False,
+            prompt_tokens=handle._prompt_tokens,
+            prompt_tps=handle._prompt_tps,
+            generation_tokens=handle._generation_tokens,
+            generation_tps=handle._generation_tokens / elapsed,
+            peak_memory=mx.get_peak_memory() / 1e9,
+            finish_reason=finish_reason,
+        )
@@ -0,0 +1,198 @@
+"""
+Prompt Snapshot Module
+
+This module saves the KV cache of a prefilled prompt to disk and loads it back,
+so that long fixed prompts, such as agent instructions with a tool catalogue,
+don't have to be prefilled again after a restart. A snapshot is a safetensors
+file holding the per-layer cache and the prompt tokens. Snapshots are keyed by
+model ID, model revision, adapter and cache layout, so a snapshot made for other
+weights is never loaded.
+"""
+
+import hashlib
+import json
+import os
+import re
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import mlx.core as mx
+from mlx.utils import tree_unflatten
+from mlx_lm.models.cache import load_prompt_cache, save_prompt_cache
+
+from ...config import load_config
+from ...utils.logger import logger
+
+DEFAULT_SNAPSHOT_DIR = "~/.cache/mlxengine/snapshots"
+
+_NAME_PATTERN = re.compile(r"^[A-Za-z0-9_.-]+$")
+
+
+@dataclass(frozen=True)
+class SnapshotKey:
+    """
+    Everything a snapshot's KV cache depends on
+
+    Attributes:
+        model_id: Model identifier as used in requests
+        revision: Revision of the model weights, see :func:`model_revision`
+        adapter: Adapter path and revision, empty without an adapter
+        cache_key: Prompt cache key, which encodes the KV cache quantization
+    """
+
+    model_id: str
+    revision: str
+    adapter: str
+    cache_key: str
+
+    @property
+    def digest(self) -> str:
+        data = json.dumps(asdict(self), sort_keys=True).encode("utf-8")
+        return hashlib.sha256(data).hexdigest()[:16]
+
+
+def snapshot_dir() -> Path:
+    """Directory holding the snapshots, from the ``snapshot_dir`` server config"""
+    return Path(load_config().get("snapshot_dir", DEFAULT_SNAPSHOT_DIR)).expanduser()
+
+
+def _fingerprint(paths: Iterable[Path]) -> str:
+    """Hash of the names, sizes and modification times of some files"""
+    digest = hashlib.sha256()
+    for path in sorted(paths):
+        stat = path.stat()
+        digest.update(f"{path.name}:{stat.st_size}:{stat.st_mtime_ns};".encode())
+    return digest.hexdigest()[:16]
+
+
+def model_revision(model_path: Path) -> str:
+    """
+    Revision of the model weights in a directory
+
+    Args:
+        model_path: Local model directory
+
+    Returns:
+        str: The commit hash for a Hugging Face download, else a fingerprint of
+        the weight files
+    """
+    if model_path.parent.name == "snapshots":
+        return model_path.name
+    return _fingerprint(model_path.glob("*.safetensors"))
+
+
+def adapter_revision(adapter_path: Optional[str]) -> str:
+    """Adapter path and a fingerprint of its weights, empty without an adapter"""
+    if not adapter_path:
+        return ""
+    path = Path(adapter_path).expanduser().resolve()
+    return f"{path}@{_fingerprint(path.glob('*.safetensors'))}"
+
+
+def snapshot_path(key: SnapshotKey, name: str) -> Path:
+    """
+    File a snapshot is stored in
+
+    Raises:
+        ValueError: If the name is not made of letters, digits, ``_``, ``.``
+            and ``-``
+    """
+    if not _NAME_PATTERN.match(name):
+        raise ValueError(f"Invalid snapshot name '{name}'")
+    return snapshot_dir() / key.digest / f"{name}.safetensors"
+
+
+def _snapshot_info(name: str, metadata: Dict[str, str], path: Path) -> Dict[str, Any]:
+    return {
+        "name": name,
+        "model": metadata.get("model_id"),
+        "revision": metadata.get("revision"),
+        "adapter": metadata.get("adapter") or None,
+        "cache_key": metadata.get("cache_key"),
+        "tokens": len(json.loads(metadata.get("tokens", "[]"))),
+        "bytes": path.stat().st_size,
+    }
+
+
+def save_snapshot(
+    key: SnapshotKey, name: str, tokens: List[int], cache: List[Any]
+) -> Dict[str, Any]:
+    """
+    Save the KV cache of a prompt
+
+    Args:
+        key: Key of the model the cache was computed with
+        name: Snapshot name, unique per key
+        tokens: Prompt tokens, the cache must hold exactly their KV
+        cache: Per-layer KV cache
+
+    Returns:
+        Dict[str, Any]: Description of the saved snapshot
+    """
+    path = snapshot_path(key, name)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    metadata = {**asdict(key), "name": name, "tokens": json.dumps(tokens)}
+
+    # Write next to the target and rename, so a reader never sees a partial file
+    tmp_path = path.with_name(f".{name}.tmp.safetensors")
+    save_prompt_cache(str(tmp_path), cache, metadata)
+    os.replace(tmp_path, path)
+    logger.info(f"Saved prompt snapshot '{name}' of {len(tokens)} tokens to {path}")
+    return _snapshot_info(name, metadata, path)
+
+
+def load_snapshot(key: SnapshotKey, name: str) -> Tuple[List[int], List[Any]]:
+    """
+    Load the KV cache of a prompt
+
+    The arrays are read lazily from the file, so only what is used is paged in.
+
+    Args:
+        key: Key of the model the cache is loaded into
+        name: Snapshot name
+
+    Returns:
+        Tuple[List[int], List[Any]]: Tuple containing:
+            1. Prompt tokens
+            2. Per-layer KV cache holding their KV
+
+    Raises:
+        FileNotFoundError: If the model has no snapshot of that name
+        ValueError: If the snapshot was made with another model
+    """
+    path = snapshot_path(key, name)
+    if not path.exists():
+        raise FileNotFoundError(f"No prompt snapshot '{name}' for {key.model_id}")
+
+    cache, metadata = load_prompt_cache(str(path), return_metadata=True)
+    stored = {field: metadata.get(field) for field in asdict(key)}
+    if stored != asdict(key):
+        raise ValueError(
+            f"Prompt snapshot '{name}' was made for {stored}, not {asdict(key)}"
+        )
+    tokens = json.loads(metadata["tokens"])
+    logger.info(f"Loaded prompt snapshot '{name}' of {len(tokens)} tokens")
+    return tokens, cache
+
+
+def list_snapshots() -> List[Dict[str, Any]]:
+    """
+    Describe the snapshots on disk
+
+    Returns:
+        List[Dict[str, Any]]: Name, model, revision, adapter, cache key, number
+        of tokens and file size of every snapshot
+    """
+    snapshots = []
+    for path in sorted(snapshot_dir().glob("*/*.safetensors")):
+        if path.name.startswith("."):
+            continue
+        try:
+            _, flat_metadata = mx.load(str(path), return_metadata=True)
+            _, metadata, _ = tree_unflatten(list(flat_metadata.items()))
+        except Exception as e:
+            logger.warning(f"Skipping unreadable prompt snapshot {path}: {str(e)}")
+            continue
+        snapshots.append(_snapshot_info(path.stem, metadata, path))
+    return snapshots
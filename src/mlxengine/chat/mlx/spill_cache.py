@@ -0,0 +1,231 @@
+"""
+Spill Cache Module
+
+This module is the disk tier of the prompt cache. KV segments evicted from the
+radix tree are written to a spill directory instead of being discarded, and are
+read back when a later prompt continues the prefix they were evicted from. Full
+precision segments can be quantized on the way out to take less disk space.
+Files are compressed and the directory is capped in size, dropping the least
+recently spilled segments first.
+"""
+
+import itertools
+import os
+import shutil
+import tempfile
+import weakref
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Tuple
+
+import mlx.core as mx
+
+from ...utils.logger import logger
+from ...utils.metrics import metrics
+
+# Quantization of a segment's KV as (group_size, bits), None for full precision
+_Quantization = Optional[Tuple[int, int]]
+
+
+@dataclass
+class _SpillEntry:
+    """A spilled segment: the KV of ``tokens[start:]``, stored in ``path``"""
+
+    model_key: str
+    tokens: List[int]
+    start: int
+    quantization: _Quantization
+    spill_quantization: _Quantization
+    dtype: Any
+    path: str
+    nbytes: int
+
+
+def _flatten(prefix: str, x: Any, arrays: Dict[str, mx.array]) -> None:
+    if isinstance(x, (tuple, list)):
+        for i, a in enumerate(x):
+            arrays[f"{prefix}.{i}"] = a
+    else:
+        arrays[prefix] = x
+
+
+def _unflatten(prefix: str, arrays: Dict[str, mx.array]) -> Any:
+    if prefix in arrays:
+        return arrays[prefix]
+    return tuple(arrays[f"{prefix}.{i}"] for i in range(3))
+
+
+class SpillStore:
+    """
+    Size-capped directory of KV segments evicted from a radix tree
+
+    The directory is private to the store and removed with it, since segments
+    are only valid for the weights they were computed with.
+
+    Attributes:
+        max_bytes: Byte budget for the files of the store
+        nbytes: Bytes currently on disk
+        bits: Bits to quantize full precision segments to, None to keep them
+        group_size: Group size for that quantization
+    """
+
+    def __init__(
+        self,
+        max_bytes: int,
+        directory: Optional[str] = None,
+        bits: Optional[int] = None,
+        group_size: int = 64,
+    ):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.bits = bits
+        self.group_size = group_size
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._directory = tempfile.mkdtemp(prefix="mlxengine-spill-", dir=directory)
+        self._entries: "OrderedDict[int, _SpillEntry]" = OrderedDict()
+        self._model_bytes: Dict[str, int] = {}
+        self._ids = itertools.count()
+        weakref.finalize(self, shutil.rmtree, self._directory, True)
+
+    def put(
+        self,
+        model_key: str,
+        tokens: List[int],
+        start: int,
+        keys: List[Any],
+        values: List[Any],
+        quantization: _Quantization,
+    ) -> None:
+        """
+        Write the KV of an evicted segment
+
+        Args:
+            model_key: Model identifier the KV belongs to
+            tokens: Tokens of the whole branch, ending with the segment's own
+            start: Position of the segment's first token in ``tokens``
+            keys: Per-layer keys of ``tokens[start:]``
+            values: Per-layer values of ``tokens[start:]``
+            quantization: Quantization of the KV, None for full precision
+        """
+        dtype = None
+        spill_quantization = None
+        if (
+            quantization is None
+            and self.bits is not None
+            and keys[0].shape[-1] % self.group_size == 0
+        ):
+            dtype = keys[0].dtype
+            spill_quantization = (self.group_size, self.bits)
+            keys = [self._quantize(k) for k in keys]
+            values = [self._quantize(v) for v in values]
+
+        arrays: Dict[str, mx.array] = {}
+        for i, (k, v) in enumerate(zip(keys, values)):
+            _flatten(f"{i}.keys", k, arrays)
+            _flatten(f"{i}.values", v, arrays)
+        entry_id = next(self._ids)
+        path = os.path.join(self._directory, f"{entry_id}.npz")
+        mx.savez_compressed(path, **arrays)
+
+        nbytes = os.path.getsize(path)
+        if nbytes > self.max_bytes:
+            os.remove(path)
+            return
+        self._entries[entry_id] = _SpillEntry(
+            model_key=model_key,
+            tokens=list(tokens),
+            start=start,
+            quantization=quantization,
+            spill_quantization=spill_quantization,
+            dtype=dtype,
+            path=path,
+            nbytes=nbytes,
+        )
+        self._add_bytes(model_key, nbytes)
+        metrics.increment(
+            "prompt_cache_spilled_tokens", len(tokens) - start, model=model_key
+        )
+        logger.debug(
+            f"Spilled {len(tokens) - start} cached tokens to disk, "
+            f"spill directory holds {self.nbytes} bytes"
+        )
+        while self.nbytes > self.max_bytes:
+            _, oldest = self._entries.popitem(last=False)
+            self._remove(oldest)
+
+    def find(
+        self, model_key: str, tokens: List[int], depth: int
+    ) -> Optional[_SpillEntry]:
+        """
+        Segment extending a match of ``tokens`` the furthest
+
+        Args:
+            model_key: Model identifier to look up segments for
+            tokens: Token sequence to look up
+            depth: Number of leading ``tokens`` available without the disk;
+                a segment can only be restored on top of them
+
+        Returns:
+            Optional[_SpillEntry]: The segment, None if none matches more than
+            ``depth`` tokens
+        """
+        best, best_length = None, depth
+        for entry in self._entries.values():
+            if entry.model_key != model_key or entry.start > depth:
+                continue
+            if entry.tokens[: entry.start] != tokens[: entry.start]:
+                continue
+            length = entry.start
+            for a, b in zip(entry.tokens[entry.start :], tokens[entry.start :]):
+                if a != b:
+                    break
+                length += 1
+            if length > best_length:
+                best, best_length = entry, length
+        return best
+
+    def pop(self, entry: _SpillEntry) -> Tuple[List[Any], List[Any], _Quantization]:
+        """
+        Read a segment back and drop it from the store
+
+        Returns:
+            Tuple[List[Any], List[Any], _Quantization]: Tuple containing:
+                1. Per-layer keys of the segment
+                2. Per-layer values of the segment
+                3. Their quantization, None for full precision
+        """
+        entry_id = next(i for i, e in self._entries.items() if e is entry)
+        del self._entries[entry_id]
+        arrays = mx.load(entry.path)
+        num_layers = len({name.split(".")[0] for name in arrays})
+        keys = [_unflatten(f"{i}.keys", arrays) for i in range(num_layers)]
+        values = [_unflatten(f"{i}.values", arrays) for i in range(num_layers)]
+        if entry.spill_quantization is not None:
+            keys = [self._dequantize(k, entry) for k in keys]
+            values = [self._dequantize(v, entry) for v in values]
+        mx.eval(keys, values)
+        self._remove(entry)
+        return keys, values, entry.quantization
+
+    def _quantize(self, x: mx.array) -> Tuple[mx.array, mx.array, mx.array]:
+        return mx.quantize(x, group_size=self.group_size, bits=self.bits)
+
+    @staticmethod
+    def _dequantize(x: Tuple[mx.array, ...], entry: _SpillEntry) -> mx.array:
+        group_size, bits = entry.spill_quantization
+        return mx.dequantize(*x, group_size=group_size, bits=bits).astype(entry.dtype)
+
+    def _remove(self, entry: _SpillEntry) -> None:
+        try:
+            os.remove(entry.path)
+        except OSError:
+            pass
+        self._add_bytes(entry.model_key, -entry.nbytes)
+
+    def _add_bytes(self, model_key: str, nbytes: int) -> None:
+        self.nbytes += nbytes
+        self._model_bytes[model_key] = self._model_bytes.get(model_key, 0) + nbytes
+        metrics.set(
+            "prompt_cache_spill_bytes", self._model_bytes[model_key], model=model_key
+        )
@@ -0,0 +1,118 @@
+"""
+Stop Sequence Matcher Module
+
+This module finds stop sequences in the text of a completion as it is decoded.
+All stop strings are compiled into one Aho-Corasick automaton, so every new
+character costs the same however many stop strings a request has. Text that
+could still turn out to be the start of a stop string is held back until it no
+longer can, which lets the completion be cut exactly where the stop begins.
+Matching the decoded text also finds stops that tokenize differently in the
+middle of a completion than on their own.
+"""
+
+from collections import deque
+from typing import Dict, Iterable, List, Tuple
+
+
+class StopMatcher:
+    """
+    Incremental matcher for the stop strings of one completion
+
+    Attributes:
+        released: Number of characters released so far, which is where the
+            completion ends once a stop string has matched
+        stopped: Whether a stop string has matched
+    """
+
+    def __init__(self, stops: Iterable[str]):
+        # Trie of the stop strings: transitions, failure links, the length of
+        # the prefix each state stands for and of the longest stop ending there
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._depth: List[int] = [0]
+        self._match: List[int] = [0]
+        for stop in stops:
+            if stop:
+                self._add(stop)
+        self._link()
+
+        self._state = 0
+        self._held = ""
+        self.released = 0
+        self.stopped = False
+
+    def _add(self, stop: str) -> None:
+        state = 0
+        for char in stop:
+            if char not in self._goto[state]:
+                self._goto.append({})
+                self._fail.append(0)
+                self._depth.append(self._depth[state] + 1)
+                self._match.append(0)
+                self._goto[state][char] = len(self._goto) - 1
+            state = self._goto[state][char]
+        self._match[state] = len(stop)
+
+    def _link(self) -> None:
+        """Set the failure links breadth first, so shorter states come first"""
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, child in self._goto[state].items():
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[child] = self._goto[fail].get(char, 0)
+                if not self._match[child]:
+                    self._match[child] = self._match[self._fail[child]]
+                queue.append(child)
+
+    def feed(self, text: str) -> Tuple[str, bool]:
+        """
+        Add newly decoded text
+
+        Args:
+            text: Text that follows everything fed so far
+
+        Returns:
+            Tuple[str, bool]: Tuple containing:
+                1. Text that can be released, which ends right before the stop
+                   string once one matched
+                2. Whether a stop string matched
+        """
+        if self.stopped:
+            return "", True
+        held = self._held + text
+        start = len(self._held)
+        state = self._state
+        for i in range(start, len(held)):
+            char = held[i]
+            while state and char not in self._goto[state]:
+                state = self._fail[state]
+            state = self._goto[state].get(char, 0)
+            if self._match[state]:
+                self.stopped = True
+                released = held[: i + 1 - self._match[state]]
+                self._held = ""
+                self.released += len(released)
+                return released, True
+
+        # Only the text the current state stands for may still start a stop
+        keep = self._depth[state]
+        released = held[: len(held) - keep]
+        self._held = held[len(held) - keep :]
+        self._state = state
+        self.released += len(released)
+        return released, False
+
+    def flush(self) -> str:
+        """
+        Release the text held back at the end of the completion
+
+        Returns:
+            str: The held text, empty once a stop string has matched
+        """
+        held, self._held = self._held, ""
+        self._state = 0
+        self.released += len(held)
+        return held
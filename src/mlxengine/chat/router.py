@@ -1,5 +1,8 @@
 import json
-from typing import Generator, List, Dict, Any, Union # Added Dict, Any, Union
+import threading
+import time
+import weakref
+from typing import AsyncIterator, List, Dict, Any, Union # Added Dict, Any, Union
 import collections.abc # To check for Mapping/Sequence types
 
 from starlette.responses import StreamingResponse
@@ -7,6 +10,7 @@ from starlette.requests import Request
 from turboapi import APIRouter, JSONResponse
 
 from .mlx.models import load_model
+from .mlx.penalty_logits_processor import parse_logit_bias
 # Import the base Model class from satya to check instance types
 from satya import Model
 # Import necessary schema components
@@ -25,10 +29,24 @@ from .schema import (
     FunctionParameters, # Import FunctionParameters for deeply nested deserialization
 )
 from .text_models import BaseTextModel
+from ..config import get_setting
+from ..utils.admission import (
+    INTERACTIVE,
+    AdmissionRejected,
+    check_priority,
+    get_admission_controller,
+    make_deadline,
+)
+from ..utils.async_bridge import abort_on_disconnect, iterate_in_thread, run_in_thread
 from ..utils.serialization import recursive_to_dict # Import the helper function
 
 router = APIRouter(tags=["chat—completions"])
 
+# Chat completions running at once per model, the size of a decode batch
+MAX_ACTIVE_REQUESTS = 16
+# Request header with the priority of a completion, interactive or batch
+PRIORITY_HEADER = "x-priority"
+
 
 # --- Helper function for recursive serialization ---
 # def recursive_to_dict(item: Any) -> Any:
@@ -60,168 +78,233 @@ router = APIRouter(tags=["chat—completions"])
 # --- End Helper function ---
 
 
-@router.post("/chat/completions", response_model=ChatCompletionResponse)
-@router.post("/v1/chat/completions", response_model=ChatCompletionResponse)
-async def create_chat_completion(request: Request):
-    """Create a chat completion"""
-    try:
-        body = await request.json()
-        chat_request_initial = ChatCompletionRequest(**body) # Initial parse
+def parse_chat_request_data(body: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Parse the body of a chat completion request into the fields of a
+    ChatCompletionRequest, with nested messages, response format and tools typed
+    """
+    chat_request_initial = ChatCompletionRequest(**body) # Initial parse
 
-        # --- Explicit Deserialization for Nested Models ---
-        # Use .dict() or fallback to get a mutable dictionary representation
-        try:
-             chat_request_data = chat_request_initial.dict()
-        except AttributeError:
-             # Fallback if .dict() doesn't exist
-             # This assumes fields are accessible attributes
-             # Adjust if satya.Model stores fields differently (e.g., __fields__)
-             fields = getattr(chat_request_initial, '__fields__', None)
-             if fields:
-                 chat_request_data = {f: getattr(chat_request_initial, f) for f in fields}
-             else:
-                 # If no obvious way to get fields, try vars() as a last resort
-                 # This might include internal attributes, use with caution
-                 chat_request_data = vars(chat_request_initial)
-
-        # Deserialize 'messages'
-        raw_messages = chat_request_data.get('messages', [])
-        if raw_messages:
-            typed_messages = []
-            for msg in raw_messages:
-                if isinstance(msg, dict):
-                    typed_messages.append(ChatMessage(**msg))
-                elif isinstance(msg, ChatMessage): # Already typed
-                    typed_messages.append(msg)
-            chat_request_data['messages'] = typed_messages
+    # --- Explicit Deserialization for Nested Models ---
+    # Use .dict() or fallback to get a mutable dictionary representation
+    try:
+         chat_request_data = chat_request_initial.dict()
+    except AttributeError:
+         # Fallback if .dict() doesn't exist
+         # This assumes fields are accessible attributes
+         # Adjust if satya.Model stores fields differently (e.g., __fields__)
+         fields = getattr(chat_request_initial, '__fields__', None)
+         if fields:
+             chat_request_data = {f: getattr(chat_request_initial, f) for f in fields}
+         else:
+             # If no obvious way to get fields, try vars() as a last resort
+             # This might include internal attributes, use with caution
+             chat_request_data = vars(chat_request_initial)
 
-        # Deserialize 'response_format' and its nested 'json_schema'
-        raw_response_format = chat_request_data.get('response_format')
-        if isinstance(raw_response_format, dict):
-            # First, handle the nested 'json_schema' if it exists and is a dict
-            nested_json_schema = raw_response_format.get('json_schema')
-            if isinstance(nested_json_schema, dict):
-                try:
-                    # Convert the nested dict to JsonSchemaFormat model
-                    raw_response_format['json_schema'] = JsonSchemaFormat(**nested_json_schema)
-                except Exception as e_jsf:
-                    print(f"Error deserializing nested json_schema: {e_jsf}")
-                    raise ValueError(f"Invalid json_schema structure within response_format: {nested_json_schema}") from e_jsf
-            elif isinstance(nested_json_schema, JsonSchemaFormat):
-                # Already typed, no action needed
-                pass
+    # Deserialize 'messages'
+    raw_messages = chat_request_data.get('messages', [])
+    if raw_messages:
+        typed_messages = []
+        for msg in raw_messages:
+            if isinstance(msg, dict):
+                typed_messages.append(ChatMessage(**msg))
+            elif isinstance(msg, ChatMessage): # Already typed
+                typed_messages.append(msg)
+        chat_request_data['messages'] = typed_messages
 
-            # Now, instantiate the outer ResponseFormat model
+    # Deserialize 'response_format' and its nested 'json_schema'
+    raw_response_format = chat_request_data.get('response_format')
+    if isinstance(raw_response_format, dict):
+        # First, handle the nested 'json_schema' if it exists and is a dict
+        nested_json_schema = raw_response_format.get('json_schema')
+        if isinstance(nested_json_schema, dict):
             try:
-                chat_request_data['response_format'] = ResponseFormat(**raw_response_format)
-            except Exception as e_rf:
-                print(f"Error deserializing response_format: {e_rf}")
-                raise ValueError(f"Invalid response_format structure: {raw_response_format}") from e_rf
-        elif isinstance(raw_response_format, ResponseFormat):
-            # Already typed, check nested just in case (though unlikely if outer is typed)
-            if isinstance(raw_response_format.json_schema, dict):
-                 try:
-                     raw_response_format.json_schema = JsonSchemaFormat(**raw_response_format.json_schema)
-                 except Exception as e_jsf:
-                     print(f"Error deserializing nested json_schema within existing ResponseFormat: {e_jsf}")
-                     raise ValueError(f"Invalid json_schema dict within ResponseFormat object: {raw_response_format.json_schema}") from e_jsf
-            # No further action needed if both outer and nested are typed
+                # Convert the nested dict to JsonSchemaFormat model
+                raw_response_format['json_schema'] = JsonSchemaFormat(**nested_json_schema)
+            except Exception as e_jsf:
+                print(f"Error deserializing nested json_schema: {e_jsf}")
+                raise ValueError(f"Invalid json_schema structure within response_format: {nested_json_schema}") from e_jsf
+        elif isinstance(nested_json_schema, JsonSchemaFormat):
+            # Already typed, no action needed
+            pass
 
-        # Deserialize 'tools' and their nested 'function' -> 'parameters'
-        raw_tools = chat_request_data.get('tools')
-        if isinstance(raw_tools, list):
-            typed_tools = []
-            for tool_dict in raw_tools:
-                if isinstance(tool_dict, dict):
-                    # Handle nested 'function'
-                    function_dict = tool_dict.get('function')
-                    if isinstance(function_dict, dict):
-                        # Handle deeply nested 'parameters' within 'function'
-                        params_dict = function_dict.get('parameters')
-                        if isinstance(params_dict, dict):
-                            try:
-                                function_dict['parameters'] = FunctionParameters(**params_dict)
-                            except Exception as e_fp:
-                                print(f"Error deserializing function parameters: {e_fp}")
-                                raise ValueError(f"Invalid parameters structure in function: {params_dict}") from e_fp
-                        elif isinstance(params_dict, FunctionParameters):
-                            pass # Already typed
+        # Now, instantiate the outer ResponseFormat model
+        try:
+            chat_request_data['response_format'] = ResponseFormat(**raw_response_format)
+        except Exception as e_rf:
+            print(f"Error deserializing response_format: {e_rf}")
+            raise ValueError(f"Invalid response_format structure: {raw_response_format}") from e_rf
+    elif isinstance(raw_response_format, ResponseFormat):
+        # Already typed, check nested just in case (though unlikely if outer is typed)
+        if isinstance(raw_response_format.json_schema, dict):
+             try:
+                 raw_response_format.json_schema = JsonSchemaFormat(**raw_response_format.json_schema)
+             except Exception as e_jsf:
+                 print(f"Error deserializing nested json_schema within existing ResponseFormat: {e_jsf}")
+                 raise ValueError(f"Invalid json_schema dict within ResponseFormat object: {raw_response_format.json_schema}") from e_jsf
+        # No further action needed if both outer and nested are typed
 
-                        # Now instantiate Function with potentially typed parameters
+    # Deserialize 'tools' and their nested 'function' -> 'parameters'
+    raw_tools = chat_request_data.get('tools')
+    if isinstance(raw_tools, list):
+        typed_tools = []
+        for tool_dict in raw_tools:
+            if isinstance(tool_dict, dict):
+                # Handle nested 'function'
+                function_dict = tool_dict.get('function')
+                if isinstance(function_dict, dict):
+                    # Handle deeply nested 'parameters' within 'function'
+                    params_dict = function_dict.get('parameters')
+                    if isinstance(params_dict, dict):
                         try:
-                            tool_dict['function'] = Function(**function_dict)
-                        except Exception as e_f:
-                            print(f"Error deserializing function: {e_f}")
-                            raise ValueError(f"Invalid function structure in tool: {function_dict}") from e_f
-                    elif isinstance(function_dict, Function):
-                        # If function is already typed, still check its parameters
-                        if isinstance(function_dict.parameters, dict):
-                             try:
-                                function_dict.parameters = FunctionParameters(**function_dict.parameters)
-                             except Exception as e_fp_nested:
-                                 print(f"Error deserializing nested function parameters: {e_fp_nested}")
-                                 raise ValueError(f"Invalid parameters dict within Function object: {function_dict.parameters}") from e_fp_nested
+                            function_dict['parameters'] = FunctionParameters(**params_dict)
+                        except Exception as e_fp:
+                            print(f"Error deserializing function parameters: {e_fp}")
+                            raise ValueError(f"Invalid parameters structure in function: {params_dict}") from e_fp
+                    elif isinstance(params_dict, FunctionParameters):
+                        pass # Already typed
 
-                    # Now instantiate Tool with potentially typed function
+                    # Now instantiate Function with potentially typed parameters
                     try:
-                        typed_tools.append(Tool(**tool_dict))
-                    except Exception as e_t:
-                        print(f"Error deserializing tool: {e_t}")
-                        raise ValueError(f"Invalid tool structure: {tool_dict}") from e_t
-                elif isinstance(tool_dict, Tool):
-                    # If tool is already typed, perform nested checks just in case
-                    if isinstance(tool_dict.function, dict):
-                         # This case is less likely if outer is typed, but for robustness:
-                         function_dict_inner = tool_dict.function
-                         params_dict_inner = function_dict_inner.get('parameters')
-                         if isinstance(params_dict_inner, dict):
-                             try:
-                                 function_dict_inner['parameters'] = FunctionParameters(**params_dict_inner)
-                             except Exception as e_fp_deep:
-                                 print(f"Error deserializing deeply nested function parameters: {e_fp_deep}")
-                                 raise ValueError(f"Invalid parameters structure in function dict within Tool object: {params_dict_inner}") from e_fp_deep
+                        tool_dict['function'] = Function(**function_dict)
+                    except Exception as e_f:
+                        print(f"Error deserializing function: {e_f}")
+                        raise ValueError(f"Invalid function structure in tool: {function_dict}") from e_f
+                elif isinstance(function_dict, Function):
+                    # If function is already typed, still check its parameters
+                    if isinstance(function_dict.parameters, dict):
+                         try:
+                            function_dict.parameters = FunctionParameters(**function_dict.parameters)
+                         except Exception as e_fp_nested:
+                             print(f"Error deserializing nested function parameters: {e_fp_nested}")
+                             raise ValueError(f"Invalid parameters dict within Function object: {function_dict.parameters}") from e_fp_nested
+
+                # Now instantiate Tool with potentially typed function
+                try:
+                    typed_tools.append(Tool(**tool_dict))
+                except Exception as e_t:
+                    print(f"Error deserializing tool: {e_t}")
+                    raise ValueError(f"Invalid tool structure: {tool_dict}") from e_t
+            elif isinstance(tool_dict, Tool):
+                # If tool is already typed, perform nested checks just in case
+                if isinstance(tool_dict.function, dict):
+                     # This case is less likely if outer is typed, but for robustness:
+                     function_dict_inner = tool_dict.function
+                     params_dict_inner = function_dict_inner.get('parameters')
+                     if isinstance(params_dict_inner, dict):
+                         try:
+                             function_dict_inner['parameters'] = FunctionParameters(**params_dict_inner)
+                         except Exception as e_fp_deep:
+                             print(f"Error deserializing deeply nested function parameters: {e_fp_deep}")
+                             raise ValueError(f"Invalid parameters structure in function dict within Tool object: {params_dict_inner}") from e_fp_deep
+                     try:
+                         tool_dict.function = Function(**function_dict_inner)
+                     except Exception as e_f_inner:
+                         print(f"Error deserializing function dict within Tool object: {e_f_inner}")
+                         raise ValueError(f"Invalid function dict within Tool object: {function_dict_inner}") from e_f_inner
+                elif isinstance(tool_dict.function, Function):
+                    # Check parameters within the already-typed Function
+                    if isinstance(tool_dict.function.parameters, dict):
                          try:
-                             tool_dict.function = Function(**function_dict_inner)
-                         except Exception as e_f_inner:
-                             print(f"Error deserializing function dict within Tool object: {e_f_inner}")
-                             raise ValueError(f"Invalid function dict within Tool object: {function_dict_inner}") from e_f_inner
-                    elif isinstance(tool_dict.function, Function):
-                        # Check parameters within the already-typed Function
-                        if isinstance(tool_dict.function.parameters, dict):
-                             try:
-                                tool_dict.function.parameters = FunctionParameters(**tool_dict.function.parameters)
-                             except Exception as e_fp_nested_typed:
-                                 print(f"Error deserializing parameters dict within typed Function object: {e_fp_nested_typed}")
-                                 raise ValueError(f"Invalid parameters dict within Function object: {tool_dict.function.parameters}") from e_fp_nested_typed
-                    typed_tools.append(tool_dict) # Append the already typed (and potentially fixed) tool
-            chat_request_data['tools'] = typed_tools
+                            tool_dict.function.parameters = FunctionParameters(**tool_dict.function.parameters)
+                         except Exception as e_fp_nested_typed:
+                             print(f"Error deserializing parameters dict within typed Function object: {e_fp_nested_typed}")
+                             raise ValueError(f"Invalid parameters dict within Function object: {tool_dict.function.parameters}") from e_fp_nested_typed
+                typed_tools.append(tool_dict) # Append the already typed (and potentially fixed) tool
+        chat_request_data['tools'] = typed_tools
+
+    # Checked before generating, so a bad bias isn't an error mid-stream
+    parse_logit_bias(chat_request_data.get('logit_bias'))
+    return chat_request_data
+
+
+@router.post("/chat/completions", response_model=ChatCompletionResponse)
+@router.post("/v1/chat/completions", response_model=ChatCompletionResponse)
+async def create_chat_completion(request: Request):
+    """Create a chat completion"""
+    try:
+        body = await request.json()
+        try:
+            chat_request_data = parse_chat_request_data(body)
+        except ValueError as e:
+            return JSONResponse(status_code=400, content={"error": str(e)})
+
+        # The priority extra param takes precedence over the header
+        chat_request_data.setdefault(
+            'priority', request.headers.get(PRIORITY_HEADER, INTERACTIVE)
+        )
+        try:
+            priority = check_priority(chat_request_data['priority'])
+            # The deadline counts from arrival, time spent queued included
+            deadline = make_deadline(
+                chat_request_data.get(
+                    'timeout', get_setting(chat_request_data.get('model'), "request_timeout")
+                )
+            )
+        except ValueError as e:
+            return JSONResponse(status_code=400, content={"error": str(e)})
 
         # Re-create the ChatCompletionRequest with fully typed nested models
         chat_request = ChatCompletionRequest(**chat_request_data)
         # --- End Explicit Deserialization ---
 
-        text_model = _create_text_model(
-            chat_request.model, chat_request.get_extra_params().get("adapter_path")
+        # Held until the completion is sent, the stream releases it when it ends
+        admission = get_admission_controller('chat', chat_request.model, MAX_ACTIVE_REQUESTS)
+        slot = await admission.acquire(
+            timeout=None if deadline is None else deadline - time.monotonic(),
+            priority=priority,
         )
+        streaming = False
+        try:
+            # Loading and generating block, so they run off the event loop
+            text_model = await run_in_thread(
+                _create_text_model,
+                chat_request.model,
+                chat_request.get_extra_params().get("adapter_path"),
+            )
+            # A request the model can't serve is turned away before streaming
+            try:
+                text_model.check_request(chat_request)
+            except ValueError as e:
+                return JSONResponse(status_code=400, content={"error": str(e)})
 
-        if not chat_request.stream:
-            completion = text_model.generate(chat_request)
-            # Recursively serialize the entire completion object for the response
-            response_content = recursive_to_dict(completion)
-            return JSONResponse(content=response_content)
+            if not chat_request.stream:
+                # Generation stops when the client goes away
+                async with abort_on_disconnect(request) as abort:
+                    completion = await run_in_thread(
+                        text_model.generate, chat_request, abort=abort, deadline=deadline
+                    )
+                # Recursively serialize the entire completion object for the response
+                response_content = recursive_to_dict(completion)
+                return JSONResponse(content=response_content)
+            streaming = True
+        finally:
+            if not streaming:
+                slot.release()
 
         # Handling streaming response
-        async def event_generator() -> Generator[str, None, None]:
-            for chunk in text_model.stream_generate(chat_request):
-                # Recursively convert the chunk object to a plain dict structure
-                serializable_chunk_dict = recursive_to_dict(chunk)
-                # Now json.dumps should work
-                yield f"data: {json.dumps(serializable_chunk_dict)}\n\n"
+        async def event_generator() -> AsyncIterator[str]:
+            try:
+                async with abort_on_disconnect(request) as abort:
+                    async for chunk in iterate_in_thread(
+                        lambda: text_model.stream_generate(
+                            chat_request, abort=abort, deadline=deadline
+                        )
+                    ):
+                        # Recursively convert the chunk object to a plain dict structure
+                        serializable_chunk_dict = recursive_to_dict(chunk)
+                        # Now json.dumps should work
+                        yield f"data: {json.dumps(serializable_chunk_dict)}\n\n"
 
-            yield "data: [DONE]\n\n"
+                yield "data: [DONE]\n\n"
+            finally:
+                slot.release()
 
+        events = event_generator()
+        # A response cancelled before it starts never runs the generator
+        weakref.finalize(events, slot.release)
         return StreamingResponse(
-            event_generator(),
+            events,
             media_type="text/event-stream",
             headers={
                 "Cache-Control": "no-cache",
@@ -230,6 +313,10 @@ async def create_chat_completion(request: Request):
             },
         )
 
+    except AdmissionRejected as e:
+        return JSONResponse(
+            status_code=429, content={"error": str(e)}, headers=e.headers
+        )
     except Exception as e:
         import traceback # Import traceback for detailed logging
         print(f"Error during chat completion: {e}")
@@ -240,17 +327,20 @@ async def create_chat_completion(request: Request):
 # --- Model Caching Logic ---
 _last_model_id = None
 _last_text_model = None
+# Requests load models on their own threads, one load at a time
+_model_lock = threading.Lock()
 
 def _create_text_model(model_id: str, adapter_path: str = None) -> BaseTextModel:
     """Loads or retrieves a cached text model."""
     global _last_model_id, _last_text_model
     cache_key = f"{model_id}_{adapter_path}" if adapter_path else model_id
-    if cache_key == _last_model_id:
-        return _last_text_model
+    with _model_lock:
+        if cache_key == _last_model_id:
+            return _last_text_model
 
-    print(f"Loading model: {model_id}" + (f" with adapter: {adapter_path}" if adapter_path else ""))
-    model = load_model(model_id, adapter_path)
-    _last_text_model = model
-    _last_model_id = cache_key
-    print(f"Model {cache_key} loaded and cached.")
-    return model
\ No newline at end of file
+        print(f"Loading model: {model_id}" + (f" with adapter: {adapter_path}" if adapter_path else ""))
+        model = load_model(model_id, adapter_path)
+        _last_text_model = model
+        _last_model_id = cache_key
+        print(f"Model {cache_key} loaded and cached.")
+        return model
\ No newline at end of file
@@ -102,6 +102,9 @@ class ChatCompletionUsage(Model):
     completion_tokens: int
     total_tokens: int
     prompt_tokens_details: Optional[PromptTokensDetails] = Field(default=None)
+    completion_tokens_details: Optional[ChatCompletionUsageDetails] = Field(
+        default=None
+    )
 
 
 class ChatCompletionChoice(Model):
@@ -127,6 +130,8 @@ class ChatCompletionChunk(Model):
     choices: List[ChatCompletionChunkChoice]
     system_fingerprint: Optional[str] = Field(default=None)
     usage: Optional[ChatCompletionUsage] = Field(default=None)
+    # The request's seed, or the one drawn for it, to reproduce the completion
+    seed: Optional[int] = Field(default=None)
 
 
 class ChatCompletionResponse(Model):
@@ -137,6 +142,8 @@ class ChatCompletionResponse(Model):
     choices: List[ChatCompletionChoice]
     usage: ChatCompletionUsage
     system_fingerprint: Optional[str] = Field(default=None)
+    # The request's seed, or the one drawn for it, to reproduce the completion
+    seed: Optional[int] = Field(default=None)
 
 
 class StreamOptions(Model):
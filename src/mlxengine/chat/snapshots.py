@@ -0,0 +1,65 @@
+from starlette.requests import Request
+from turboapi import APIRouter, JSONResponse
+
+from ..utils.async_bridge import run_in_thread
+from ..utils.logger import logger
+from .mlx.snapshots import list_snapshots
+from .router import _create_text_model
+
+router = APIRouter(tags=["admin"])
+
+
+def _error_response(e: Exception) -> JSONResponse:
+    if isinstance(e, FileNotFoundError):
+        return JSONResponse(status_code=404, content={"error": str(e)})
+    if isinstance(e, (KeyError, TypeError, ValueError)):
+        return JSONResponse(status_code=400, content={"error": str(e)})
+    logger.error(f"Error handling prompt snapshot: {str(e)}", exc_info=True)
+    return JSONResponse(status_code=500, content={"error": str(e)})
+
+
+@router.get("/v1/admin/snapshots")
+async def get_snapshots():
+    """
+    Lists the prompt snapshots on disk with the model, revision and adapter each
+    one was made for.
+    """
+    try:
+        return JSONResponse(content={"object": "list", "data": list_snapshots()})
+    except Exception as e:
+        return _error_response(e)
+
+
+@router.post("/v1/admin/snapshots")
+async def create_snapshot(request: Request):
+    """
+    Prefills a prompt given as chat `messages` and optional `tools`, saves its KV
+    cache to disk as the snapshot `name` of `model` and keeps it cached.
+    """
+    try:
+        body = await request.json()
+        text_model = await run_in_thread(
+            _create_text_model, body["model"], body.get("adapter_path")
+        )
+        snapshot = await run_in_thread(
+            text_model.save_snapshot, body["name"], body["messages"], body.get("tools")
+        )
+        return JSONResponse(content=snapshot)
+    except Exception as e:
+        return _error_response(e)
+
+
+@router.post("/v1/admin/snapshots/load")
+async def load_snapshot(request: Request):
+    """
+    Loads the snapshot `name` of `model` from disk into its prompt cache.
+    """
+    try:
+        body = await request.json()
+        text_model = await run_in_thread(
+            _create_text_model, body["model"], body.get("adapter_path")
+        )
+        snapshot = await run_in_thread(text_model.load_snapshot, body["name"])
+        return JSONResponse(content=snapshot)
+    except Exception as e:
+        return _error_response(e)
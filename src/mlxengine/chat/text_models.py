@@ -1,3 +1,4 @@
+import threading
 from abc import ABC, abstractmethod
 from dataclasses import dataclass
 from typing import Any, Dict, Generator, Optional
@@ -15,6 +16,10 @@ class GenerateResult:
     prompt_tokens: int
     generation_tokens: int
     logprobs: Optional[Dict[str, Any]] = None
+    cached_tokens: int = 0
+    index: int = 0
+    accepted_prediction_tokens: int = 0
+    rejected_prediction_tokens: int = 0
 
 
 class BaseTextModel(ABC):
@@ -24,6 +29,8 @@ class BaseTextModel(ABC):
     def generate(
         self,
         request: ChatCompletionRequest,
+        abort: Optional[threading.Event] = None,
+        deadline: Optional[float] = None,
     ) -> ChatCompletionResponse:
         """Generate completion text with parameters from request"""
         pass
@@ -31,5 +38,16 @@ class BaseTextModel(ABC):
     def stream_generate(
         self,
         request: ChatCompletionRequest,
+        abort: Optional[threading.Event] = None,
+        deadline: Optional[float] = None,
     ) -> Generator[ChatCompletionChunk, None, None]:
         pass
+
+    def check_request(self, request: ChatCompletionRequest) -> None:
+        """
+        Check that the model can serve a request, before anything is generated
+
+        Raises:
+            ValueError: If the request asks for something the model can't do
+        """
+        pass
@@ -0,0 +1,52 @@
+"""
+Warm-up Module
+
+This module prefills the prompts listed under ``warmup`` in the server config,
+such as long system prompts and tool catalogues, into the prompt cache of their
+model when the server starts, so that the first requests using them don't pay
+for their prefill:
+
+    {
+        "warmup": [
+            {
+                "model": "mlx-community/Llama-3.2-1B-Instruct-4bit",
+                "messages": [{"role": "system", "content": "You are ..."}],
+                "tools": [{"type": "function", "function": {...}}]
+            }
+        ]
+    }
+"""
+
+import time
+
+from ..config import load_config
+from ..utils.logger import logger
+from .router import _create_text_model
+
+
+def warm_up() -> None:
+    """
+    Prefill every configured warm-up prompt
+
+    Entries are warmed in order, each loading its model (and ``adapter_path`` if
+    given) the way a request for it would. An entry that fails is logged and
+    skipped so that it can't keep the server from starting.
+    """
+    entries = load_config().get("warmup", [])
+    for i, entry in enumerate(entries):
+        start = time.perf_counter()
+        try:
+            text_model = _create_text_model(entry["model"], entry.get("adapter_path"))
+            tokens, cached_tokens = text_model.warm_up(
+                entry["messages"], entry.get("tools")
+            )
+        except Exception as e:
+            logger.error(
+                f"Failed to warm up entry {i} of the server config: {str(e)}",
+                exc_info=True,
+            )
+            continue
+        logger.info(
+            f"Warmed up {tokens} prompt tokens for {entry['model']} in "
+            f"{time.perf_counter() - start:.2f}s, {cached_tokens} were cached"
+        )
@@ -0,0 +1,75 @@
+"""
+Server Configuration Module
+
+This module loads the optional JSON configuration file passed to the server with
+``--config``. Settings for individual models live under ``models``, keyed by the
+model ID used in requests:
+
+    {
+        "models": {
+            "mlx-community/Llama-3.1-8B-Instruct-4bit": {
+                "draft_model": "mlx-community/Llama-3.2-1B-Instruct-4bit",
+                "num_draft_tokens": 3
+            }
+        }
+    }
+"""
+
+import json
+import os
+from functools import lru_cache
+from typing import Any, Dict
+
+from .utils.logger import logger
+
+CONFIG_ENV_VAR = "MLX_OMNI_CONFIG"
+
+
+@lru_cache(maxsize=None)
+def load_config() -> Dict[str, Any]:
+    """
+    Load the server configuration file
+
+    The path is read from the ``MLX_OMNI_CONFIG`` environment variable, which
+    ``main.start`` sets from ``--config`` so that every worker process sees it.
+
+    Returns:
+        Dict[str, Any]: The parsed configuration, empty if no file is configured
+    """
+    path = os.environ.get(CONFIG_ENV_VAR)
+    if not path:
+        return {}
+
+    with open(path, "r", encoding="utf-8") as f:
+        config = json.load(f)
+    logger.info(f"Loaded server config from {path}")
+    return config
+
+
+def get_model_config(model_id: str) -> Dict[str, Any]:
+    """
+    Get the configuration of one model
+
+    Args:
+        model_id: Model identifier as used in requests
+
+    Returns:
+        Dict[str, Any]: The model's settings, empty if it has none
+    """
+    return load_config().get("models", {}).get(model_id, {})
+
+
+def get_setting(model_id: str, key: str, default: Any = None) -> Any:
+    """
+    Get a setting that can be given for one model or for all of them
+
+    Args:
+        model_id: Model identifier as used in requests
+        key: Name of the setting
+        default: Value when the config sets it neither for the model nor at
+            the top level
+
+    Returns:
+        Any: The model's value, else the top level one, else ``default``
+    """
+    return get_model_config(model_id).get(key, load_config().get(key, default))
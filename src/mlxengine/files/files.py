@@ -0,0 +1,85 @@
+from typing import Optional
+
+from fastapi import APIRouter, File, Form, HTTPException, UploadFile
+from fastapi.responses import FileResponse
+
+from ..utils.async_bridge import run_in_thread
+from .files_service import FilesService
+from .schema import FileDeletion, FileList, FileObject, FilePurpose
+
+router = APIRouter(tags=["files"])
+
+
+@router.post("/files")
+@router.post("/v1/files")
+async def upload_file(
+    file: UploadFile = File(..., description="The file to upload"),
+    purpose: str = Form(..., description="The intended purpose of the file"),
+) -> FileObject:
+    """
+    Upload a file, a JSONL file of requests for the Batch API.
+    """
+    if purpose != FilePurpose.BATCH.value:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Invalid purpose '{purpose}', must be '{FilePurpose.BATCH.value}'",
+        )
+    try:
+        return await run_in_thread(
+            FilesService().create,
+            file.file,
+            file.filename or "upload.jsonl",
+            FilePurpose.BATCH,
+        )
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@router.get("/files")
+@router.get("/v1/files")
+async def list_files(purpose: Optional[FilePurpose] = None) -> FileList:
+    """
+    List the stored files, the latest first.
+    """
+    return FileList(data=FilesService().list(purpose))
+
+
+@router.get("/files/{file_id}")
+@router.get("/v1/files/{file_id}")
+async def retrieve_file(file_id: str) -> FileObject:
+    """
+    Get information about a file.
+    """
+    try:
+        return FilesService().get(file_id)
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+
+
+@router.get("/files/{file_id}/content")
+@router.get("/v1/files/{file_id}/content")
+async def retrieve_file_content(file_id: str) -> FileResponse:
+    """
+    Download the content of a file.
+    """
+    service = FilesService()
+    try:
+        file = service.get(file_id)
+        path = service.content_path(file_id)
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    return FileResponse(
+        path, media_type="application/octet-stream", filename=file.filename
+    )
+
+
+@router.delete("/files/{file_id}")
+@router.delete("/v1/files/{file_id}")
+async def delete_file(file_id: str) -> FileDeletion:
+    """
+    Delete a file.
+    """
+    try:
+        return FilesService().delete(file_id)
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
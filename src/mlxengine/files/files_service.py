@@ -0,0 +1,184 @@
+"""
+Files Store Module
+
+This module keeps the files of the Files API on local disk, the inputs uploaded
+for batches and the outputs batches produce. Each file is stored under the
+``files_dir`` of the server config as its content, named by its ID, and a JSON
+description next to it:
+
+    {
+        "files_dir": "~/.cache/mlxengine/files"
+    }
+
+Content and description are written to a temporary file and renamed, so a
+reader never sees a partial file, and a file only shows up once its description
+is written.
+"""
+
+import os
+import re
+import secrets
+import shutil
+import time
+from pathlib import Path
+from typing import BinaryIO, List, Optional
+
+from ..config import load_config
+from ..utils.logger import logger
+from .schema import FileDeletion, FileObject, FilePurpose
+
+DEFAULT_FILES_DIR = "~/.cache/mlxengine/files"
+
+_ID_PATTERN = re.compile(r"^file-[A-Za-z0-9_-]{1,64}$")
+# Uploads are copied in chunks, a batch input can be larger than memory allows
+_CHUNK_SIZE = 1 << 20
+
+
+def files_dir() -> Path:
+    """Directory holding the files, from the ``files_dir`` server config"""
+    return Path(load_config().get("files_dir", DEFAULT_FILES_DIR)).expanduser()
+
+
+def new_file_id() -> str:
+    return f"file-{secrets.token_hex(12)}"
+
+
+class FilesService:
+    """Files stored in a directory"""
+
+    def __init__(self, root: Optional[Path] = None):
+        self.root = root if root is not None else files_dir()
+
+    def _path(self, file_id: str) -> Path:
+        if not _ID_PATTERN.match(file_id):
+            raise FileNotFoundError(f"No such file: {file_id}")
+        return self.root / file_id
+
+    def _info_path(self, file_id: str) -> Path:
+        return self._path(file_id).with_suffix(".json")
+
+    def _describe(
+        self, file_id: str, filename: str, purpose: FilePurpose
+    ) -> FileObject:
+        file = FileObject(
+            id=file_id,
+            bytes=self._path(file_id).stat().st_size,
+            created_at=int(time.time()),
+            filename=filename,
+            purpose=purpose,
+        )
+        info_path = self._info_path(file_id)
+        tmp_path = info_path.with_name(f".{file_id}.tmp.json")
+        tmp_path.write_text(file.model_dump_json(), encoding="utf-8")
+        os.replace(tmp_path, info_path)
+        return file
+
+    def create(
+        self, source: BinaryIO, filename: str, purpose: FilePurpose
+    ) -> FileObject:
+        """
+        Store an uploaded file
+
+        Args:
+            source: The file's content
+            filename: Name the client gave the file
+            purpose: What the file is for
+
+        Returns:
+            FileObject: Description of the stored file
+        """
+        self.root.mkdir(parents=True, exist_ok=True)
+        file_id = new_file_id()
+        path = self._path(file_id)
+        tmp_path = path.with_name(f".{file_id}.tmp")
+        try:
+            with open(tmp_path, "wb") as f:
+                shutil.copyfileobj(source, f, _CHUNK_SIZE)
+            os.replace(tmp_path, path)
+        finally:
+            tmp_path.unlink(missing_ok=True)
+        file = self._describe(file_id, filename, purpose)
+        logger.info(f"Stored file {file_id} '{filename}' of {file.bytes} bytes")
+        return file
+
+    def add(
+        self, source: Path, file_id: str, filename: str, purpose: FilePurpose
+    ) -> FileObject:
+        """
+        Move a file written elsewhere into the store
+
+        Adding a file ID that was already added returns the stored file, so an
+        interrupted add can be repeated.
+
+        Args:
+            source: Path of the file
+            file_id: ID to store it as, from :func:`new_file_id`
+            filename: Name of the file
+            purpose: What the file is for
+
+        Returns:
+            FileObject: Description of the stored file
+        """
+        if self._info_path(file_id).exists():
+            return self.get(file_id)
+        self.root.mkdir(parents=True, exist_ok=True)
+        if source.exists():
+            shutil.move(source, self._path(file_id))
+        return self._describe(file_id, filename, purpose)
+
+    def get(self, file_id: str) -> FileObject:
+        """
+        Describe a file
+
+        Raises:
+            FileNotFoundError: If there is no such file
+        """
+        try:
+            text = self._info_path(file_id).read_text(encoding="utf-8")
+        except FileNotFoundError:
+            raise FileNotFoundError(f"No such file: {file_id}")
+        return FileObject.model_validate_json(text)
+
+    def content_path(self, file_id: str) -> Path:
+        """
+        Path of a file's content
+
+        Raises:
+            FileNotFoundError: If there is no such file
+        """
+        self.get(file_id)
+        return self._path(file_id)
+
+    def list(self, purpose: Optional[FilePurpose] = None) -> List[FileObject]:
+        """
+        Describe the stored files, the latest first
+
+        Args:
+            purpose: Only list the files for this purpose
+        """
+        files = []
+        for info_path in self.root.glob("file-*.json"):
+            try:
+                file = FileObject.model_validate_json(
+                    info_path.read_text(encoding="utf-8")
+                )
+            except (OSError, ValueError) as e:
+                logger.warning(f"Skipping unreadable file {info_path}: {str(e)}")
+                continue
+            if purpose is None or file.purpose == purpose:
+                files.append(file)
+        return sorted(files, key=lambda file: (file.created_at, file.id), reverse=True)
+
+    def delete(self, file_id: str) -> FileDeletion:
+        """
+        Delete a file
+
+        Raises:
+            FileNotFoundError: If there is no such file
+        """
+        self.get(file_id)
+        # Without its description the file is gone, even if removing it fails
+        self._info_path(file_id).unlink()
+        self._path(file_id).unlink(missing_ok=True)
+        logger.info(f"Deleted file {file_id}")
+        return FileDeletion(id=file_id, deleted=True)
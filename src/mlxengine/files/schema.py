@@ -0,0 +1,41 @@
+from enum import Enum
+from typing import List, Optional
+
+from pydantic import BaseModel, Field
+
+
+class FilePurpose(str, Enum):
+    BATCH = "batch"
+    BATCH_OUTPUT = "batch_output"
+
+
+class FileObject(BaseModel):
+    """File information as per OpenAI API specification"""
+
+    id: str = Field(..., description="The file identifier")
+    object: str = Field(default="file", description="The object type (always 'file')")
+    bytes: int = Field(..., description="Size of the file in bytes")
+    created_at: int = Field(
+        ..., description="Unix timestamp of when the file was created"
+    )
+    filename: str = Field(..., description="Name of the file")
+    purpose: FilePurpose = Field(..., description="Intended purpose of the file")
+    status: str = Field(default="processed", description="Status of the file")
+    expires_at: Optional[int] = Field(
+        default=None, description="Unix timestamp of when the file expires"
+    )
+
+
+class FileList(BaseModel):
+    """Response format for list of files"""
+
+    object: str = Field(default="list", description="The object type (always 'list')")
+    data: List[FileObject] = Field(..., description="List of file objects")
+
+
+class FileDeletion(BaseModel):
+    """Response format for file deletion"""
+
+    id: str = Field(..., description="The ID of the deleted file")
+    object: str = Field(default="file", description="The object type (always 'file')")
+    deleted: bool = Field(..., description="Whether the file was deleted")
@@ -2,11 +2,16 @@ import time
 
 from fastapi import APIRouter, HTTPException
 
+from ..utils.admission import AdmissionRejected, get_admission_controller
+from ..utils.async_bridge import run_in_thread
 from .images_service import ImagesService
 from .schema import ImageGenerationRequest, ImageGenerationResponse
 
 router = APIRouter(tags=["images"])
 
+# A diffusion model generates one request at a time
+MAX_ACTIVE_REQUESTS = 1
+
 
 @router.post("/images/generations")
 @router.post("/v1/images/generations")
@@ -14,11 +19,17 @@ async def create_image(request: ImageGenerationRequest) -> ImageGenerationRespon
     """
     Creates an image given a prompt.
     """
+    admission = get_admission_controller("images", request.model, MAX_ACTIVE_REQUESTS)
+    try:
+        slot = await admission.acquire()
+    except AdmissionRejected as e:
+        raise HTTPException(status_code=429, detail=str(e), headers=e.headers)
+
     try:
         service = ImagesService()
 
         # Generate images
-        images = service.generate_images(request)
+        images = await run_in_thread(service.generate_images, request)
 
         # Create response
         return ImageGenerationResponse(created=int(time.time()), data=images)
@@ -27,3 +38,5 @@ async def create_image(request: ImageGenerationRequest) -> ImageGenerationRespon
         raise HTTPException(status_code=400, detail=str(ve))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        slot.release()
@@ -5,6 +5,9 @@ import uvicorn
 from starlette.middleware import Middleware
 from turboapi import TurboAPI
 
+from .batches.batches_service import resume_batches
+from .chat.warmup import warm_up
+from .config import CONFIG_ENV_VAR
 from .middleware.logging import RequestResponseLoggingMiddleware
 from .routers import api_router
 
@@ -14,7 +17,13 @@ middlewares = [
     # Add other middleware instances here if needed
 ]
 
-app = TurboAPI(title="MLX Omni Server", middleware=middlewares)
+# Each worker process warms its own models before it starts serving, then picks
+# up the batches a restart interrupted
+app = TurboAPI(
+    title="MLX Omni Server",
+    middleware=middlewares,
+    on_startup=[warm_up, resume_batches],
+)
 
 app.include_router(api_router)
 
@@ -47,6 +56,12 @@ def build_parser():
         choices=["debug", "info", "warning", "error", "critical"],
         help="Set the logging level, defaults to info",
     )
+    parser.add_argument(
+        "--config",
+        type=str,
+        default=None,
+        help="Path to a JSON server config file with per-model settings",
+    )
     return parser
 
 
@@ -58,6 +73,10 @@ def start():
     # Set log level through environment variable
     os.environ["MLX_OMNI_LOG_LEVEL"] = args.log_level
 
+    # Worker processes import the app on their own, so pass the config path along
+    if args.config:
+        os.environ[CONFIG_ENV_VAR] = os.path.abspath(args.config)
+
     # Start server with uvicorn
     uvicorn.run(
         "mlxengine.main:app",
@@ -0,0 +1,14 @@
+from turboapi import APIRouter, JSONResponse
+
+from ..utils.metrics import metrics
+
+router = APIRouter(tags=["metrics"])
+
+
+@router.get("/metrics")
+@router.get("/v1/metrics")
+async def get_metrics():
+    """
+    Returns the server's counters and gauges, such as KV cache memory per model.
+    """
+    return JSONResponse(content=metrics.snapshot())
@@ -1,8 +1,12 @@
 from turboapi import APIRouter
 
+from .batches import batches
 from .chat import router as chat_router
+from .chat import snapshots
 from .chat.models import models
+from .files import files
 from .images import images
+from .metrics import metrics
 from .stt import stt as stt_router
 from .tts import tts as tts_router
 
@@ -12,3 +16,7 @@ api_router.include_router(tts_router.router)
 api_router.include_router(models.router)
 api_router.include_router(images.router)
 api_router.include_router(chat_router.router)
+api_router.include_router(snapshots.router)
+api_router.include_router(files.router)
+api_router.include_router(batches.router)
+api_router.include_router(metrics.router)
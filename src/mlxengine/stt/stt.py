@@ -2,11 +2,15 @@ from fastapi import APIRouter, Depends, HTTPException
 from fastapi.responses import JSONResponse, Response
 from starlette.responses import PlainTextResponse
 
+from ..utils.admission import AdmissionRejected, get_admission_controller
 from .schema import ResponseFormat, STTRequestForm, TranscriptionResponse
 from .whisper_model import STTService
 
 router = APIRouter(tags=["speech-to-text"])
 
+# Whisper transcribes one request at a time
+MAX_ACTIVE_REQUESTS = 1
+
 
 @router.post("/audio/transcriptions", response_model=TranscriptionResponse)
 @router.post("/v1/audio/transcriptions", response_model=TranscriptionResponse)
@@ -14,6 +18,12 @@ async def create_transcription(request: STTRequestForm = Depends()):
     """
     Transcribe audio file to text.
     """
+    admission = get_admission_controller("stt", request.model, MAX_ACTIVE_REQUESTS)
+    try:
+        slot = await admission.acquire()
+    except AdmissionRejected as e:
+        raise HTTPException(status_code=429, detail=str(e), headers=e.headers)
+
     stt_service = STTService()
     try:
         result = await stt_service.transcribe(request)
@@ -34,3 +44,5 @@ async def create_transcription(request: STTRequestForm = Depends()):
 
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        slot.release()
@@ -6,6 +6,7 @@ from typing import Union
 from mlx_whisper import transcribe
 from mlx_whisper.writers import WriteSRT, WriteVTT
 
+from ..utils.async_bridge import run_in_thread
 from .schema import (
     ResponseFormat,
     STTRequestForm,
@@ -126,7 +127,9 @@ class STTService:
     ) -> Union[dict, str, TranscriptionResponse]:
         try:
             audio_path = await self.model._save_upload_file(request.file)
-            result = self.model.generate(audio_path=audio_path, request=request)
+            result = await run_in_thread(
+                self.model.generate, audio_path=audio_path, request=request
+            )
             response = self.model._format_response(result, request)
             Path(audio_path).unlink(missing_ok=True)
             return response
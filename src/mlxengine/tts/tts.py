@@ -3,11 +3,15 @@ import io
 from fastapi import APIRouter, HTTPException
 from fastapi.responses import StreamingResponse
 
+from ..utils.admission import AdmissionRejected, get_admission_controller
 from .schema import AudioFormat, TTSRequest
 from .tts_service import TTSService
 
 router = APIRouter(tags=["text-to-speech"])
 
+# F5-TTS generates one request at a time
+MAX_ACTIVE_REQUESTS = 1
+
 
 @router.post("/audio/speech")
 @router.post("/v1/audio/speech")
@@ -18,6 +22,12 @@ async def create_speech(request: TTSRequest):
     Returns:
         StreamingResponse: Audio file content in the requested format
     """
+    admission = get_admission_controller("tts", request.model, MAX_ACTIVE_REQUESTS)
+    try:
+        slot = await admission.acquire()
+    except AdmissionRejected as e:
+        raise HTTPException(status_code=429, detail=str(e), headers=e.headers)
+
     tts_service = TTSService()
 
     try:
@@ -46,3 +56,5 @@ async def create_speech(request: TTSRequest):
 
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        slot.release()
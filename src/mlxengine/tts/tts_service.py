@@ -1,7 +1,9 @@
+import tempfile
 from pathlib import Path
 
 from f5_tts_mlx.generate import generate
 
+from ..utils.async_bridge import run_in_thread
 from .schema import TTSRequest
 
 
@@ -25,19 +27,23 @@ class TTSService:
 
     def __init__(self):
         self.model = F5Model()
-        self.sample_audio_path = Path("sample.wav")
 
     async def generate_speech(
         self,
         request: TTSRequest,
     ) -> bytes:
+        # Each request writes a file of its own, so concurrent ones don't clash
+        with tempfile.NamedTemporaryFile(suffix=".wav", delete=False) as f:
+            audio_path = Path(f.name)
         try:
-            self.model.generate_audio(
-                request=request, output_path=self.sample_audio_path
+            await run_in_thread(
+                self.model.generate_audio,
+                request=request,
+                output_path=audio_path,
             )
-            with open(self.sample_audio_path, "rb") as audio_file:
-                audio_content = audio_file.read()
-            self.sample_audio_path.unlink(missing_ok=True)
-            return audio_content
+            with open(audio_path, "rb") as audio_file:
+                return audio_file.read()
         except Exception as e:
             raise Exception(f"Error reading audio file: {str(e)}")
+        finally:
+            audio_path.unlink(missing_ok=True)
@@ -0,0 +1,346 @@
+"""
+Admission Control Module
+
+This module limits how many requests each model serves at once. Requests past
+the limit wait in a bounded queue, first come first served, and are turned away
+with ``429 Too Many Requests`` and a ``Retry-After`` estimate when the queue is
+full or when they waited longer than the queue timeout. Queue depth, active
+requests and queueing delay are published as metrics, so a load balancer can
+shed load before the server degrades.
+
+Requests are either ``interactive`` or ``batch`` priority, and each priority
+waits in its own queue. Interactive requests are admitted up to the limit
+whatever batch requests are running, while batch requests only take the slots
+left over, so that background jobs never delay interactive traffic. One batch
+request is always let through, so batch work keeps making progress.
+
+A request with a deadline only waits until its deadline, and is turned away
+once it passed without being admitted.
+
+Limits are read from the server config, for one model under ``models`` or for
+all models at the top level, falling back to the defaults of each route:
+
+    {
+        "max_active_requests": 16,
+        "max_queued_requests": 64,
+        "queue_timeout": 30,
+        "models": {
+            "argmaxinc/mlx-FLUX.1-schnell": {"max_active_requests": 1}
+        }
+    }
+"""
+
+import asyncio
+import math
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Deque, Dict, Optional, Tuple
+
+from ..config import get_setting
+from .logger import logger
+from .metrics import metrics
+
+INTERACTIVE = "interactive"
+BATCH = "batch"
+# Priorities in the order their work is served
+PRIORITIES = (INTERACTIVE, BATCH)
+
+DEFAULT_MAX_QUEUED_REQUESTS = 64
+DEFAULT_QUEUE_TIMEOUT = 30.0
+
+# Weight of the latest request in the average time a slot is held
+_HOLD_TIME_SMOOTHING = 0.2
+
+
+class AdmissionRejected(Exception):
+    """
+    A request was turned away without running
+
+    Attributes:
+        retry_after: Seconds after which a retry is likely to be admitted
+        reason: ``queue_full``, ``timeout`` or ``deadline``
+    """
+
+    def __init__(self, message: str, retry_after: int, reason: str):
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.reason = reason
+
+    @property
+    def headers(self) -> Dict[str, str]:
+        """Headers of the ``429`` response"""
+        return {"Retry-After": str(self.retry_after)}
+
+
+def check_priority(priority: str) -> str:
+    """
+    Check a request priority
+
+    Raises:
+        ValueError: If it isn't one of :data:`PRIORITIES`
+    """
+    if priority not in PRIORITIES:
+        raise ValueError(
+            f"Invalid priority {priority!r}, must be one of: {', '.join(PRIORITIES)}"
+        )
+    return priority
+
+
+def make_deadline(timeout: Optional[float]) -> Optional[float]:
+    """
+    Deadline of a request given the seconds it may take
+
+    Args:
+        timeout: Seconds from now, None for no deadline
+
+    Returns:
+        Optional[float]: The deadline on the ``time.monotonic`` clock
+
+    Raises:
+        ValueError: If the timeout isn't a positive number
+    """
+    if timeout is None:
+        return None
+    if isinstance(timeout, bool) or not isinstance(timeout, (int, float)):
+        raise ValueError(f"Invalid timeout {timeout!r}, must be a number of seconds")
+    if timeout <= 0:
+        raise ValueError(f"Invalid timeout {timeout!r}, must be positive")
+    return time.monotonic() + timeout
+
+
+class _Waiter:
+    def __init__(self, future: asyncio.Future, priority: str):
+        self.future = future
+        self.priority = priority
+        self.queued_at = time.monotonic()
+
+
+class AdmissionSlot:
+    """Permission to run one request, released once the request is done"""
+
+    def __init__(self, controller: "AdmissionController", priority: str):
+        self._controller = controller
+        self.priority = priority
+        self._started = time.monotonic()
+        self._released = False
+
+    def release(self) -> None:
+        """Give the slot to the next queued request, only the first call counts"""
+        if not self._released:
+            self._released = True
+            self._controller._release(self.priority, time.monotonic() - self._started)
+
+
+def _grant(future: asyncio.Future) -> None:
+    if not future.done():
+        future.set_result(None)
+
+
+class AdmissionController:
+    """
+    Concurrency limit and wait queue of one model
+
+    Slots may be released from any thread, queued requests are woken up on the
+    event loop they wait on.
+
+    Attributes:
+        name: Model the controller admits requests for
+        service: Endpoint family the requests are for, such as ``chat`` or
+            ``tts``, None to leave it out of the metrics
+        max_active: Requests that run at once, interactive requests may run
+            this many on top of the batch requests admitted before them
+        max_queued: Requests of one priority that wait at once, more are
+            rejected
+        queue_timeout: Seconds a request waits before it is rejected
+    """
+
+    def __init__(
+        self,
+        name: str,
+        max_active: int,
+        max_queued: int = DEFAULT_MAX_QUEUED_REQUESTS,
+        queue_timeout: float = DEFAULT_QUEUE_TIMEOUT,
+        service: Optional[str] = None,
+    ):
+        self.name = name
+        self.service = service
+        self._labels = {"model": name}
+        if service is not None:
+            self._labels["service"] = service
+        self.max_active = max(max_active, 1)
+        self.max_queued = max(max_queued, 0)
+        self.queue_timeout = queue_timeout
+        self._lock = threading.Lock()
+        self._active = {priority: 0 for priority in PRIORITIES}
+        self._waiters: Dict[str, Deque[_Waiter]] = {
+            priority: deque() for priority in PRIORITIES
+        }
+        self._hold_time: Optional[float] = None
+
+    @property
+    def active(self) -> int:
+        return sum(self._active.values())
+
+    @property
+    def queued(self) -> int:
+        return sum(len(waiters) for waiters in self._waiters.values())
+
+    def retry_after(self, priority: str = INTERACTIVE) -> int:
+        """Seconds until a new request would likely be admitted"""
+        if self._hold_time is None:
+            return 1
+        wait = self._hold_time * (len(self._waiters[priority]) + 1) / self.max_active
+        return max(1, math.ceil(wait))
+
+    def _can_run(self, priority: str) -> bool:
+        if priority == INTERACTIVE:
+            return self._active[INTERACTIVE] < self.max_active
+        return self.active < self.max_active or not self._active[BATCH]
+
+    async def acquire(
+        self, timeout: Optional[float] = None, priority: str = INTERACTIVE
+    ) -> AdmissionSlot:
+        """
+        Wait for a slot to run a request
+
+        Args:
+            timeout: Seconds to wait at most, until the request's deadline,
+                capped by the queue timeout
+            priority: ``interactive`` or ``batch``
+
+        Returns:
+            AdmissionSlot: The slot, to release once the request is done
+
+        Raises:
+            AdmissionRejected: If the queue is full or the wait timed out
+        """
+        check_priority(priority)
+        with self._lock:
+            waiters = self._waiters[priority]
+            if not waiters and self._can_run(priority):
+                self._active[priority] += 1
+                self._admitted(0.0)
+                return AdmissionSlot(self, priority)
+            if len(waiters) >= self.max_queued:
+                raise self._reject("queue_full", "Too many requests queued", priority)
+            waiter = _Waiter(asyncio.get_running_loop().create_future(), priority)
+            waiters.append(waiter)
+            self._publish()
+
+        reason, message = "timeout", "Timed out waiting for the model"
+        if timeout is None or timeout > self.queue_timeout:
+            timeout = self.queue_timeout
+        else:
+            reason, message = "deadline", "Deadline passed waiting for the model"
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), max(timeout, 0))
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            with self._lock:
+                waiting = waiter in waiters
+                if waiting:
+                    waiters.remove(waiter)
+                    self._publish()
+            if waiting and isinstance(e, asyncio.TimeoutError):
+                with self._lock:
+                    raise self._reject(reason, message, priority)
+            if isinstance(e, asyncio.CancelledError):
+                if not waiting:
+                    # The slot was granted as the request went away
+                    self._release(priority, None)
+                raise
+            # Granted just as the wait timed out
+        with self._lock:
+            self._admitted(time.monotonic() - waiter.queued_at)
+        return AdmissionSlot(self, priority)
+
+    @asynccontextmanager
+    async def admit(
+        self, timeout: Optional[float] = None, priority: str = INTERACTIVE
+    ) -> AsyncIterator[AdmissionSlot]:
+        """Hold a slot for the duration of the block, see :meth:`acquire`"""
+        slot = await self.acquire(timeout, priority)
+        try:
+            yield slot
+        finally:
+            slot.release()
+
+    def _release(self, priority: str, hold_time: Optional[float]) -> None:
+        with self._lock:
+            self._active[priority] -= 1
+            if hold_time is not None:
+                self._hold_time = (
+                    hold_time
+                    if self._hold_time is None
+                    else (1 - _HOLD_TIME_SMOOTHING) * self._hold_time
+                    + _HOLD_TIME_SMOOTHING * hold_time
+                )
+            for priority in PRIORITIES:
+                waiters = self._waiters[priority]
+                while waiters and self._can_run(priority):
+                    waiter = waiters.popleft()
+                    self._active[priority] += 1
+                    try:
+                        loop = waiter.future.get_loop()
+                        loop.call_soon_threadsafe(_grant, waiter.future)
+                    except RuntimeError:
+                        # Its event loop is gone, so is the request
+                        self._active[priority] -= 1
+            self._publish()
+
+    def _admitted(self, wait: float) -> None:
+        metrics.increment("admission_admitted_requests", **self._labels)
+        metrics.increment("admission_wait_seconds_total", wait, **self._labels)
+        metrics.set("admission_queue_wait_seconds", wait, **self._labels)
+        self._publish()
+
+    def _reject(self, reason: str, message: str, priority: str) -> AdmissionRejected:
+        metrics.increment("admission_rejected_requests", reason=reason, **self._labels)
+        logger.warning(
+            f"Rejected a request for {self.name} ({priority}): {message}, "
+            f"{self.active} active and {self.queued} queued"
+        )
+        return AdmissionRejected(message, self.retry_after(priority), reason)
+
+    def _publish(self) -> None:
+        metrics.set("admission_active_requests", self.active, **self._labels)
+        metrics.set("admission_queue_depth", self.queued, **self._labels)
+
+
+_controllers: Dict[Tuple[str, str], AdmissionController] = {}
+_controllers_lock = threading.Lock()
+
+
+def get_admission_controller(
+    service: str, model_id: str, max_active: int
+) -> AdmissionController:
+    """
+    Get the admission controller of a model, created on first use
+
+    Each service has controllers of its own, so the limit of one doesn't apply
+    to a model of the same name served by another.
+
+    Args:
+        service: Endpoint family of the request, such as ``chat`` or ``tts``
+        model_id: Model identifier as used in requests
+        max_active: Requests that run at once unless the server config says
+
+    Returns:
+        AdmissionController: The model's controller
+    """
+    key = (service, model_id)
+    with _controllers_lock:
+        if key not in _controllers:
+            _controllers[key] = AdmissionController(
+                model_id,
+                max_active=get_setting(model_id, "max_active_requests", max_active),
+                max_queued=get_setting(
+                    model_id, "max_queued_requests", DEFAULT_MAX_QUEUED_REQUESTS
+                ),
+                queue_timeout=get_setting(
+                    model_id, "queue_timeout", DEFAULT_QUEUE_TIMEOUT
+                ),
+                service=service,
+            )
+        return _controllers[key]
@@ -0,0 +1,152 @@
+"""
+Async Bridge Module
+
+This module runs blocking model work off the event loop. Generation runs on the
+model's worker thread, but waiting for its tokens, detokenizing them and
+building the response chunks is synchronous code too, and so is loading a
+model. Running any of it inside an async handler stalls every other request
+the server is handling. Here the synchronous code runs on a thread of its own
+per call and hands its results to the event loop through an ``asyncio.Queue``.
+
+Calls get a new thread rather than one from the loop's default executor, whose
+few workers would cap the number of requests that can be batched together.
+Work a client no longer waits for is aborted through an event that the threads
+check, set as soon as the client disconnects.
+"""
+
+import asyncio
+import threading
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Callable, Iterator, Optional, TypeVar
+
+from starlette.requests import Request
+
+T = TypeVar("T")
+
+# Marks the end of the items a thread produces
+_DONE = object()
+
+
+def _send(loop: asyncio.AbstractEventLoop, callback: Callable, *args) -> None:
+    """Schedule ``callback`` on ``loop`` from another thread, unless it's closed"""
+    try:
+        loop.call_soon_threadsafe(callback, *args)
+    except RuntimeError:
+        # The server shut down while the thread was running
+        pass
+
+
+async def run_in_thread(fn: Callable[..., T], *args, **kwargs) -> T:
+    """
+    Run a blocking call on a new thread and wait for it without blocking
+
+    Args:
+        fn: The function to call
+        *args: Its positional arguments
+        **kwargs: Its keyword arguments
+
+    Returns:
+        T: What ``fn`` returned, its exception is raised instead
+    """
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def resolve(result, error: Optional[BaseException]) -> None:
+        if future.done():
+            return
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def run() -> None:
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as e:
+            _send(loop, resolve, None, e)
+        else:
+            _send(loop, resolve, result, None)
+
+    threading.Thread(target=run, daemon=True).start()
+    return await future
+
+
+async def iterate_in_thread(
+    make_iterator: Callable[[], Iterator[T]]
+) -> AsyncIterator[T]:
+    """
+    Iterate a blocking iterator on a new thread and yield its items as they come
+
+    The iterator is created and closed on that thread. When the consumer stops
+    early, the thread closes the iterator after the item it is waiting for,
+    which cancels the generation behind it.
+
+    Args:
+        make_iterator: Creates the iterator, called on the thread
+
+    Yields:
+        T: The iterator's items, its exception is raised after the last one
+    """
+    loop = asyncio.get_running_loop()
+    items: asyncio.Queue = asyncio.Queue()
+    stop = threading.Event()
+
+    def produce() -> None:
+        try:
+            iterator = make_iterator()
+            try:
+                for item in iterator:
+                    if stop.is_set():
+                        break
+                    _send(loop, items.put_nowait, item)
+            finally:
+                close = getattr(iterator, "close", None)
+                if close is not None:
+                    close()
+        except BaseException as e:
+            _send(loop, items.put_nowait, e)
+        _send(loop, items.put_nowait, _DONE)
+
+    threading.Thread(target=produce, daemon=True).start()
+    try:
+        while True:
+            item = await items.get()
+            if item is _DONE:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        stop.set()
+
+
+@asynccontextmanager
+async def abort_on_disconnect(request: Request) -> AsyncIterator[threading.Event]:
+    """
+    Event to abort the work of a request once its client disconnects
+
+    The event is also set when the block exits with an exception, as when the
+    response is cancelled, so threads stop working for a response nobody reads.
+
+    Args:
+        request: The HTTP request, whose body has been read
+
+    Yields:
+        threading.Event: Set once the client is gone
+    """
+    abort = threading.Event()
+
+    async def watch() -> None:
+        # Nothing but the disconnect is left to receive once the body is read
+        while (await request.receive())["type"] != "http.disconnect":
+            pass
+        abort.set()
+
+    watcher = asyncio.ensure_future(watch())
+    try:
+        yield abort
+    except BaseException:
+        abort.set()
+        raise
+    finally:
+        watcher.cancel()
@@ -0,0 +1,57 @@
+"""
+Metrics Module
+
+This module keeps process-wide counters and gauges, labelled by model or other
+dimensions, and renders them for the ``/v1/metrics`` endpoint.
+"""
+
+import threading
+from typing import Any, Dict, List, Tuple
+
+_Key = Tuple[str, Tuple[Tuple[str, str], ...]]
+
+
+class Metrics:
+    """Thread-safe registry of named, labelled numeric values"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values: Dict[_Key, float] = {}
+
+    @staticmethod
+    def _key(name: str, labels: Dict[str, Any]) -> _Key:
+        return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def increment(self, name: str, value: float = 1, **labels: Any) -> None:
+        """Add ``value`` to a counter"""
+        key = self._key(name, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels: Any) -> None:
+        """Set a gauge to ``value``"""
+        with self._lock:
+            self._values[self._key(name, labels)] = value
+
+    def get(self, name: str, **labels: Any) -> float:
+        with self._lock:
+            return self._values.get(self._key(name, labels), 0)
+
+    def snapshot(self) -> Dict[str, List[Dict[str, Any]]]:
+        """
+        Current values grouped by metric name
+
+        Returns:
+            Dict[str, List[Dict[str, Any]]]: For every metric, one entry per label
+            set with its ``labels`` and ``value``
+        """
+        with self._lock:
+            items = sorted(self._values.items())
+        result: Dict[str, List[Dict[str, Any]]] = {}
+        for (name, labels), value in items:
+            result.setdefault(name, []).append({"labels": dict(labels), "value": value})
+        return result
+
+
+# Default registry
+metrics = Metrics()
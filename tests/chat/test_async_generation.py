@@ -0,0 +1,59 @@
+import logging
+import threading
+import time
+
+import pytest
+from fastapi.testclient import TestClient
+
+from mlxengine.main import app
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+MODEL = "mlx-community/Llama-3.2-1B-Instruct-4bit"
+
+
+@pytest.fixture(scope="module")
+def client():
+    """Test client whose requests share one event loop"""
+    with TestClient(app) as client:
+        yield client
+
+
+def make_body(max_tokens: int, stream: bool = False):
+    return {
+        "model": MODEL,
+        "messages": [{"role": "user", "content": "Write a long story about the sea."}],
+        "max_tokens": max_tokens,
+        "temperature": 0.0,
+        "stream": stream,
+    }
+
+
+class TestAsyncGeneration:
+
+    @pytest.mark.parametrize("stream", [False, True])
+    def test_event_loop_responsive_while_generating(self, client, stream):
+        # Load the model first, so only generation overlaps the pings
+        client.post("/v1/chat/completions", json=make_body(1))
+
+        done = threading.Event()
+
+        def generate():
+            response = client.post("/v1/chat/completions", json=make_body(300, stream))
+            assert response.status_code == 200
+            done.set()
+
+        thread = threading.Thread(target=generate)
+        thread.start()
+        latencies = []
+        while not done.is_set():
+            start = time.perf_counter()
+            assert client.get("/v1/metrics").status_code == 200
+            latencies.append(time.perf_counter() - start)
+            time.sleep(0.01)
+        thread.join()
+
+        logger.info(f"{len(latencies)} metrics requests, slowest {max(latencies):.3f}s")
+        assert len(latencies) > 1, "Metrics requests waited for the generation"
+        assert max(latencies) < 0.5
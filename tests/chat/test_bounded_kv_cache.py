@@ -0,0 +1,63 @@
+import logging
+
+import pytest
+
+from mlxengine.chat.mlx.mlx_model import MLXModel
+from mlxengine.chat.mlx.models import load_model
+from mlxengine.chat.schema import ChatCompletionRequest, ChatMessage, Role
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+MODEL = "mlx-community/Llama-3.2-1B-Instruct-4bit"
+MAX_KV_SIZE = 128
+
+
+@pytest.fixture(scope="module")
+def bounded_model():
+    text_model = load_model(MODEL)
+    return MLXModel(
+        model_id=MODEL,
+        model=text_model._model,
+        tokenizer=text_model._chat_tokenizer,
+        max_kv_size=MAX_KV_SIZE,
+        attention_sink_tokens=4,
+    )
+
+
+class TestBoundedKVCache:
+
+    def test_long_chat_stays_within_window(self, bounded_model):
+        messages = []
+        for turn in range(6):
+            messages.append(
+                ChatMessage(role=Role.USER, content=f"Tell me a fact about {turn}.")
+            )
+            response = bounded_model.generate(
+                ChatCompletionRequest(
+                    model=MODEL, messages=list(messages), max_tokens=40, temperature=0.0
+                )
+            )
+            reply = response.choices[0].message.content
+            assert reply
+            messages.append(ChatMessage(role=Role.ASSISTANT, content=reply))
+
+            if turn > 0:
+                # Earlier turns are reused even after they left the window
+                details = response.usage.prompt_tokens_details
+                assert details is not None and details.cached_tokens > 0
+
+        cache = bounded_model._prompt_cache.cache
+        logger.info(f"Cache offset {cache[0].offset}, size {cache[0].keys.shape[2]}")
+        assert cache[0].offset > MAX_KV_SIZE
+        assert cache[0].keys.shape[2] <= MAX_KV_SIZE
+
+    def test_several_choices_are_rejected(self, bounded_model):
+        request = ChatCompletionRequest(
+            model=MODEL,
+            messages=[ChatMessage(role=Role.USER, content="Hello")],
+            max_tokens=8,
+            n=2,
+        )
+        with pytest.raises(ValueError):
+            bounded_model.check_request(request)
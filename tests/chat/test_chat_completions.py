@@ -203,3 +203,52 @@ class TestChatCompletions:
         except Exception as e:
             logger.error(f"Test error: {str(e)}")
             raise
+
+    def test_chat_completions_n(self, openai_client):
+        """Test that n > 1 returns one choice per sample"""
+        try:
+            model = "mlx-community/Llama-3.2-1B-Instruct-4bit"
+            response = openai_client.chat.completions.create(
+                model=model,
+                messages=[{"role": "user", "content": "Name a color."}],
+                n=3,
+                max_tokens=20,
+            )
+            logger.info(f"Chat Completion Response:\n{response}\n")
+
+            assert len(response.choices) == 3, "Incorrect number of choices"
+            assert [choice.index for choice in response.choices] == [0, 1, 2]
+            for choice in response.choices:
+                assert choice.message.content, "Choice content is empty"
+
+            stream = openai_client.chat.completions.create(
+                model=model,
+                messages=[{"role": "user", "content": "Name a color."}],
+                n=2,
+                max_tokens=20,
+                stream=True,
+            )
+            contents = {0: "", 1: ""}
+            for chunk in stream:
+                choice = chunk.choices[0]
+                if choice.delta.content is not None:
+                    contents[choice.index] += choice.delta.content
+            assert all(contents.values()), "A streamed choice is empty"
+        except Exception as e:
+            logger.error(f"Test error: {str(e)}")
+            raise
+
+    @pytest.mark.parametrize("stream", [False, True])
+    def test_invalid_logit_bias_is_rejected(self, client, stream):
+        """Test that a bad logit_bias is a client error, streaming or not"""
+        response = client.post(
+            "/v1/chat/completions",
+            json={
+                "model": "mlx-community/Llama-3.2-1B-Instruct-4bit",
+                "messages": [{"role": "user", "content": "Hello"}],
+                "logit_bias": {"1": 500},
+                "stream": stream,
+            },
+        )
+        assert response.status_code == 400
+        assert "logit_bias" in response.json()["error"]
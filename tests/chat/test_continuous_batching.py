@@ -0,0 +1,234 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from mlxengine.chat.mlx.models import load_model
+from mlxengine.chat.schema import ChatCompletionRequest, ChatMessage, Role
+from mlxengine.utils.metrics import metrics
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+MODEL = "mlx-community/Llama-3.2-1B-Instruct-4bit"
+PROMPTS = [
+    "hello",
+    "What is the capital of France?",
+    "Count from one to ten.",
+    "Write a haiku about the sea.",
+]
+
+
+@pytest.fixture(scope="module")
+def text_model():
+    return load_model(MODEL)
+
+
+def make_request(prompt: str, max_tokens: int) -> ChatCompletionRequest:
+    return ChatCompletionRequest(
+        model=MODEL,
+        messages=[ChatMessage(role=Role.USER, content=prompt)],
+        max_tokens=max_tokens,
+        temperature=0.0,
+    )
+
+
+class TestContinuousBatching:
+
+    def test_concurrent_requests_match_sequential(self, text_model):
+        sequential = [
+            text_model.generate(make_request(prompt, 10)).choices[0].message.content
+            for prompt in PROMPTS
+        ]
+
+        # Different lengths make sequences leave the batch at different steps
+        with ThreadPoolExecutor(max_workers=len(PROMPTS)) as pool:
+            responses = list(
+                pool.map(
+                    lambda i: text_model.generate(make_request(PROMPTS[i], 10 + i)),
+                    range(len(PROMPTS)),
+                )
+            )
+
+        for expected, response in zip(sequential, responses):
+            content = response.choices[0].message.content
+            logger.info(f"Batched completion: {content}")
+            assert content.startswith(expected), "Batched output differs"
+
+    def test_long_prompt_prefilled_between_decode_steps(self, text_model):
+        # Long enough to be prefilled in several chunks
+        long_prompt = "Summarize the following text.\n" + PROMPTS[1] * 200
+        expected = (
+            text_model.generate(make_request(long_prompt, 10))
+            .choices[0]
+            .message.content
+        )
+        # Replace the cached prefix so the long prompt is prefilled again
+        text_model.generate(make_request(PROMPTS[0], 1))
+
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            stream = pool.submit(
+                lambda: text_model.generate(make_request(PROMPTS[2], 100))
+            )
+            long = pool.submit(
+                lambda: text_model.generate(make_request(long_prompt, 10))
+            )
+            content = long.result().choices[0].message.content
+            stream.result()
+
+        logger.info(f"Long prompt completion: {content}")
+        assert content == expected, "Chunked prefill output differs"
+
+    def test_short_prompt_not_stuck_behind_long_prefill(self, text_model):
+        long_prompt = "Translate the following text.\n" + PROMPTS[3] * 400
+        expected = (
+            text_model.generate(make_request(PROMPTS[1], 10)).choices[0].message.content
+        )
+
+        def first_token_time(prompt: str) -> float:
+            for _ in text_model.stream_generate(make_request(prompt, 10)):
+                return time.perf_counter()
+
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            long = pool.submit(first_token_time, long_prompt)
+            time.sleep(0.05)
+            short = pool.submit(first_token_time, PROMPTS[1])
+            assert short.result() < long.result()
+
+        content = text_model.generate(make_request(PROMPTS[1], 10))
+        assert content.choices[0].message.content == expected
+
+    def test_seeded_sampling_is_identical_alone_and_batched(self, text_model):
+        def sample(prompt: str, seed: int):
+            request = ChatCompletionRequest(
+                model=MODEL,
+                messages=[ChatMessage(role=Role.USER, content=prompt)],
+                max_tokens=20,
+                temperature=1.0,
+                seed=seed,
+                logprobs=True,
+            )
+            response = text_model.generate(request)
+            tokens = [
+                entry["bytes"] for entry in response.choices[0].logprobs["content"]
+            ]
+            return response.choices[0].message.content, tokens, response.seed
+
+        alone = sample(PROMPTS[3], 1234)
+        assert alone[2] == 1234
+
+        # Other sampled requests decode in the same steps as the seeded one
+        with ThreadPoolExecutor(max_workers=len(PROMPTS) + 1) as pool:
+            others = [
+                pool.submit(sample, prompt, i) for i, prompt in enumerate(PROMPTS)
+            ]
+            seeded = pool.submit(sample, PROMPTS[3], 1234)
+            assert seeded.result() == alone, "Batched output differs"
+            for other in others:
+                other.result()
+
+    def test_random_seed_is_returned(self, text_model):
+        def sample(seed=None):
+            return text_model.generate(
+                ChatCompletionRequest(
+                    model=MODEL,
+                    messages=[ChatMessage(role=Role.USER, content=PROMPTS[0])],
+                    max_tokens=10,
+                    temperature=1.0,
+                    seed=seed,
+                )
+            )
+
+        response = sample()
+        assert response.seed is not None
+        again = sample(response.seed)
+        assert again.choices[0].message.content == response.choices[0].message.content
+
+    def test_abort_stops_generation(self, text_model):
+        before = metrics.get("cancelled_sequences", model=MODEL, stage="decode")
+        abort = threading.Event()
+        chunks = 0
+        for chunk in text_model.stream_generate(make_request(PROMPTS[3], 2000), abort):
+            chunks += 1
+            if chunks == 5:
+                abort.set()
+
+        assert chunks < 10, "Generation went on after the abort"
+        after = metrics.get("cancelled_sequences", model=MODEL, stage="decode")
+        assert after == before + 1
+
+        # The prompt cache is still usable afterwards
+        expected = text_model.generate(make_request(PROMPTS[1], 10))
+        again = text_model.generate(make_request(PROMPTS[1], 10))
+        assert again.choices[0].message.content == expected.choices[0].message.content
+
+    def test_interactive_request_preempts_batch(self, text_model, monkeypatch):
+        def complete(prompt: str, max_tokens: int, priority: str) -> str:
+            request = make_request(prompt, max_tokens)
+            request.priority = priority
+            return text_model.generate(request).choices[0].message.content
+
+        expected = [complete(prompt, 200, "batch") for prompt in PROMPTS[2:]]
+        before = metrics.get("preempted_sequences", model=MODEL, stage="decode")
+
+        # Two batch sequences fill the batch
+        monkeypatch.setattr(text_model._scheduler, "_max_batch_size", 2)
+        with ThreadPoolExecutor(max_workers=3) as pool:
+            batch = [
+                pool.submit(complete, prompt, 200, "batch") for prompt in PROMPTS[2:]
+            ]
+            time.sleep(0.5)
+            interactive = pool.submit(complete, PROMPTS[1], 10, "interactive")
+            interactive.result()
+            assert not all(future.done() for future in batch)
+
+            # Preempted sequences resume where they left off
+            assert [future.result() for future in batch] == expected
+        after = metrics.get("preempted_sequences", model=MODEL, stage="decode")
+        assert after > before
+
+    def test_deadline_truncates_generation(self, text_model):
+        prompt = "Count from one to one thousand, one number per line."
+        request = make_request(prompt, 2000)
+        request.timeout = 0.5
+        start = time.perf_counter()
+        response = text_model.generate(request)
+        assert time.perf_counter() - start < 1.5
+
+        choice = response.choices[0]
+        assert choice.finish_reason == "length"
+        assert 0 < response.usage.completion_tokens < 2000
+        complete = text_model.generate(make_request(prompt, 2000))
+        assert complete.choices[0].message.content.startswith(choice.message.content)
+
+    def test_next_turn_reuses_reply_cut_at_stop(self, text_model):
+        messages = [
+            ChatMessage(
+                role=Role.USER,
+                content="Count from one to twenty in digits, separated by commas.",
+            )
+        ]
+        request = make_request(messages[0].content, 80)
+        request.stop = "12"
+        first = text_model.generate(request)
+        choice = first.choices[0]
+        assert choice.finish_reason == "stop"
+
+        # Sent right away, while the worker may still be ending the first turn
+        messages += [
+            ChatMessage(role=Role.ASSISTANT, content=choice.message.content),
+            ChatMessage(role=Role.USER, content="Now count backwards."),
+        ]
+        second = text_model.generate(
+            ChatCompletionRequest(
+                model=MODEL, messages=messages, max_tokens=10, temperature=0.0
+            )
+        )
+        tokenizer = text_model._chat_tokenizer.tokenizer
+        kept = len(tokenizer.encode(choice.message.content, add_special_tokens=False))
+        cached = second.usage.prompt_tokens_details.cached_tokens
+        logger.info(f"Cached {cached} tokens, {kept} of them the first reply")
+        # The template may re-tokenize the end of the reply differently
+        assert cached >= first.usage.prompt_tokens + kept - 2
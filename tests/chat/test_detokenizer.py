@@ -0,0 +1,64 @@
+from mlxengine.chat.mlx.detokenizer import IncrementalDetokenizer
+
+
+class ByteTokenizer:
+    """Byte-level tokenizer, every token is one raw byte"""
+
+    def encode(self, text):
+        return list(text.encode("utf-8"))
+
+    def decode(self, tokens):
+        return bytes(tokens).decode("utf-8", errors="replace")
+
+
+class SentencePieceTokenizer:
+    """SentencePiece-like tokenizer that drops the leading space of a decode"""
+
+    pieces = ["▁Hello", "▁world", ",", "▁how", "▁are", "▁you", "?", "▁café"]
+
+    def decode(self, tokens):
+        return "".join(self.pieces[t] for t in tokens).replace("▁", " ").lstrip(" ")
+
+
+def detokenize(tokenizer, tokens):
+    detokenizer = IncrementalDetokenizer(tokenizer)
+    deltas = [detokenizer.add_token(token) for token in tokens]
+    deltas.append(detokenizer.flush())
+    return deltas, detokenizer
+
+
+class TestIncrementalDetokenizer:
+
+    def test_multibyte_characters_are_held_until_complete(self):
+        tokenizer = ByteTokenizer()
+        text = "naïve 東京 😀!"
+        deltas, detokenizer = detokenize(tokenizer, tokenizer.encode(text))
+
+        assert "".join(deltas) == text
+        assert detokenizer.text == text
+        assert all("�" not in delta for delta in deltas)
+        # The four bytes of the emoji produce a single delta
+        assert "😀" in deltas
+
+    def test_incomplete_tail_is_flushed_like_a_full_decode(self):
+        tokenizer = ByteTokenizer()
+        tokens = tokenizer.encode("ok 😀")[:-2]
+        deltas, _ = detokenize(tokenizer, tokens)
+
+        assert deltas[-1] != ""
+        assert "".join(deltas) == tokenizer.decode(tokens)
+
+    def test_sentencepiece_spaces_are_kept_between_tokens(self):
+        tokenizer = SentencePieceTokenizer()
+        tokens = [0, 1, 2, 3, 4, 5, 6, 7]
+        deltas, _ = detokenize(tokenizer, tokens)
+
+        assert deltas[:3] == ["Hello", " world", ","]
+        assert "".join(deltas) == tokenizer.decode(tokens)
+
+    def test_flush_without_pending_text(self):
+        detokenizer = IncrementalDetokenizer(ByteTokenizer())
+
+        assert detokenizer.flush() == ""
+        assert detokenizer.add_token(ord("a")) == "a"
+        assert detokenizer.flush() == ""
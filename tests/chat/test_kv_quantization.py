@@ -0,0 +1,78 @@
+import logging
+
+import pytest
+
+from mlxengine.chat.mlx.mlx_model import MLXModel
+from mlxengine.chat.mlx.models import load_model
+from mlxengine.chat.schema import ChatCompletionRequest, ChatMessage, Role
+from mlxengine.utils.metrics import metrics
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+MODEL = "mlx-community/Llama-3.2-1B-Instruct-4bit"
+
+
+@pytest.fixture(scope="module")
+def text_model():
+    return load_model(MODEL)
+
+
+@pytest.fixture(scope="module")
+def quantized_model(text_model):
+    return MLXModel(
+        model_id=MODEL,
+        model=text_model._model,
+        tokenizer=text_model._chat_tokenizer,
+        kv_bits=8,
+        kv_group_size=64,
+    )
+
+
+def make_request(*turns: str, **kwargs) -> ChatCompletionRequest:
+    messages = []
+    for i, content in enumerate(turns):
+        role = Role.USER if i % 2 == 0 else Role.ASSISTANT
+        messages.append(ChatMessage(role=role, content=content))
+    return ChatCompletionRequest(
+        model=MODEL, messages=messages, max_tokens=20, temperature=0.0, **kwargs
+    )
+
+
+class TestKVQuantization:
+
+    def test_quantized_cache_saves_memory(self, quantized_model):
+        response = quantized_model.generate(make_request("Count from one to ten."))
+        logger.info(f"Quantized response: {response.choices[0].message.content}")
+        assert response.choices[0].message.content
+
+        labels = {"model": f"{MODEL}#kv8g64s0", "cache": "prompt"}
+        saved = metrics.get("kv_cache_saved_bytes", **labels)
+        assert 0 < saved < metrics.get("kv_cache_bytes", **labels)
+
+    def test_quantized_cache_prefix_reuse(self, quantized_model):
+        first = make_request("Count from one to ten.")
+        quantized_model.generate(first)
+
+        second = make_request(
+            "Count from one to ten.", "1, 2, 3", "Now count backwards."
+        )
+        response = quantized_model.generate(second)
+        details = response.usage.prompt_tokens_details
+        assert details is not None and details.cached_tokens > 0
+
+    def test_per_request_quantization(self, text_model):
+        request = make_request("Count from one to ten.", kv_bits=8)
+        first = text_model.generate(request)
+        assert first.choices[0].message.content
+
+        # The next turn reuses the quantized cache
+        second = make_request(
+            "Count from one to ten.",
+            first.choices[0].message.content,
+            "Now count backwards.",
+            kv_bits=8,
+        )
+        response = text_model.generate(second)
+        details = response.usage.prompt_tokens_details
+        assert details is not None and details.cached_tokens > 0
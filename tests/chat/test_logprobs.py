@@ -0,0 +1,61 @@
+import math
+
+import mlx.core as mx
+
+from mlxengine.chat.mlx.logprobs import LogprobsBuffer, TokenTable
+
+
+class WordTokenizer:
+    """Tokenizer with a small word vocabulary"""
+
+    words = ["a", " b", "é", "<eos>"]
+
+    def get_vocab(self):
+        return {word: i for i, word in enumerate(self.words)}
+
+    def decode(self, tokens):
+        return "".join(self.words[t] if t < len(self.words) else "" for t in tokens)
+
+    def batch_decode(self, sequences):
+        return [self.decode(tokens) for tokens in sequences]
+
+
+def make_logprobs(probs):
+    return mx.log(mx.array(probs))
+
+
+class TestLogprobsBuffer:
+
+    def test_matches_decoding_each_token(self):
+        buffer = LogprobsBuffer(TokenTable(WordTokenizer()), top_k=2)
+        buffer.add(2, make_logprobs([0.1, 0.2, 0.3, 0.4]))
+        buffer.add(0, make_logprobs([0.7, 0.1, 0.1, 0.1]))
+        assert len(buffer) == 2
+
+        first, second = buffer.flush()
+        assert first["token"] == "é"
+        assert first["bytes"] == list("é".encode("utf-8"))
+        assert math.isclose(first["logprob"], math.log(0.3), rel_tol=1e-5)
+        # Top logprobs come sorted, most likely first
+        assert [t["token"] for t in first["top_logprobs"]] == ["<eos>", "é"]
+        assert second["token"] == "a"
+        assert [t["token"] for t in second["top_logprobs"]][0] == "a"
+
+        assert len(buffer) == 0
+        assert buffer.flush() == []
+
+    def test_without_top_logprobs(self):
+        buffer = LogprobsBuffer(TokenTable(WordTokenizer()))
+        buffer.add(1, make_logprobs([0.25, 0.25, 0.25, 0.25]))
+
+        (entry,) = buffer.flush()
+        assert entry["token"] == " b"
+        assert entry["top_logprobs"] == []
+
+    def test_token_past_the_vocabulary(self):
+        buffer = LogprobsBuffer(TokenTable(WordTokenizer()), top_k=1)
+        buffer.add(4, make_logprobs([0.1, 0.1, 0.1, 0.1, 0.6]))
+
+        (entry,) = buffer.flush()
+        assert entry["token"] == ""
+        assert entry["top_logprobs"][0]["token"] == ""
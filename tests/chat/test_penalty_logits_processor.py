@@ -0,0 +1,65 @@
+import mlx.core as mx
+import pytest
+
+from mlxengine.chat.mlx.penalty_logits_processor import PenaltyLogitsProcessor
+
+PROMPT = [3, 3, 1]
+
+
+def run(processor, generated, vocab_size=6):
+    """Logits after the processor, with zero logits at every step"""
+    logits = mx.zeros((1, vocab_size))
+    out = processor(mx.array(PROMPT), logits)
+    for i in range(len(generated)):
+        out = processor(mx.array(PROMPT + generated[: i + 1]), logits)
+    return out[0].tolist()
+
+
+class TestPenaltyLogitsProcessor:
+
+    def test_logit_bias(self):
+        processor = PenaltyLogitsProcessor(logit_bias={"2": 5.0, "4": -100})
+        assert run(processor, []) == [0.0, 0.0, 5.0, 0.0, -100.0, 0.0]
+
+    def test_presence_penalty_applies_once(self):
+        processor = PenaltyLogitsProcessor(presence_penalty=0.5)
+        assert run(processor, [2, 2, 5]) == [0.0, 0.0, -0.5, 0.0, 0.0, -0.5]
+
+    def test_frequency_penalty_scales_with_count(self):
+        processor = PenaltyLogitsProcessor(frequency_penalty=0.25)
+        assert run(processor, [2, 2, 5]) == [0.0, 0.0, -0.5, 0.0, 0.0, -0.25]
+
+    def test_negative_penalties_encourage_repetition(self):
+        processor = PenaltyLogitsProcessor(presence_penalty=-1.0, frequency_penalty=-1)
+        assert run(processor, [0, 0]) == [3.0, 0.0, 0.0, 0.0, 0.0, 0.0]
+
+    def test_prompt_tokens_are_not_penalized(self):
+        processor = PenaltyLogitsProcessor(presence_penalty=1.0, frequency_penalty=1)
+        out = run(processor, [])
+        assert out[3] == 0.0 and out[1] == 0.0
+
+    def test_rewound_history_is_counted_again(self):
+        processor = PenaltyLogitsProcessor(frequency_penalty=1.0)
+        run(processor, [2, 4, 4])
+
+        # Speculative decoding rejected the last two tokens and sampled a 5
+        logits = mx.zeros((1, 6))
+        out = processor(mx.array(PROMPT + [2, 5]), logits)[0].tolist()
+        assert out == [0.0, 0.0, -1.0, 0.0, 0.0, -1.0]
+
+    def test_keeps_the_logits_dtype(self):
+        processor = PenaltyLogitsProcessor(logit_bias={"0": 1.5})
+        logits = mx.zeros((1, 4), dtype=mx.bfloat16)
+        assert processor(mx.array(PROMPT), logits).dtype == mx.bfloat16
+
+    def test_bias_past_the_vocabulary_is_ignored(self):
+        processor = PenaltyLogitsProcessor(logit_bias={"1000": 10})
+        assert run(processor, []) == [0.0] * 6
+
+    @pytest.mark.parametrize(
+        "logit_bias",
+        [{"word": 1.0}, {"-1": 1.0}, {"1": 101.0}, {"1": -100.5}, {"1": "high"}],
+    )
+    def test_invalid_logit_bias(self, logit_bias):
+        with pytest.raises(ValueError):
+            PenaltyLogitsProcessor(logit_bias=logit_bias)
@@ -83,3 +83,56 @@ class TestPromptCache:
         except Exception as e:
             logger.error(f"Error testing prompt cache: {str(e)}")
             raise
+
+    def test_interleaved_conversations_keep_their_cache(self, openai_client):
+        model = "mlx-community/Llama-3.2-1B-Instruct-4bit"
+        system = {"role": "system", "content": "You are a helpful AI assistant."}
+        conversations = [
+            [system, {"role": "user", "content": "Tell me about the sea."}],
+            [system, {"role": "user", "content": "Tell me about mountains."}],
+        ]
+
+        first_prompt_tokens = []
+        for messages in conversations:
+            response = openai_client.chat.completions.create(
+                model=model, messages=messages, max_tokens=20
+            )
+            first_prompt_tokens.append(response.usage.prompt_tokens)
+            messages.append(
+                {"role": "assistant", "content": response.choices[0].message.content}
+            )
+            messages.append({"role": "user", "content": "continue"})
+
+        # The first conversation is still cached after the second one ran
+        for messages, prompt_tokens in zip(conversations, first_prompt_tokens):
+            response = openai_client.chat.completions.create(
+                model=model, messages=messages, max_tokens=20
+            )
+            details = response.usage.prompt_tokens_details
+            logger.info(f"Cached tokens: {details.cached_tokens}")
+            assert details.cached_tokens >= prompt_tokens - 1
+
+    def test_second_turn_reuses_reply(self, openai_client):
+        model = "mlx-community/Llama-3.2-1B-Instruct-4bit"
+        messages = [
+            {"role": "system", "content": "You are a helpful AI assistant."},
+            {"role": "user", "content": "Name three colors."},
+        ]
+        first = openai_client.chat.completions.create(
+            model=model, messages=messages, max_tokens=20, temperature=0.0
+        )
+        messages.append(
+            {"role": "assistant", "content": first.choices[0].message.content}
+        )
+        messages.append({"role": "user", "content": "Name three more."})
+
+        response = openai_client.chat.completions.create(
+            model=model, messages=messages, max_tokens=20, temperature=0.0
+        )
+        details = response.usage.prompt_tokens_details
+        logger.info(f"Cached tokens: {details.cached_tokens}")
+        # Only the last generated token was never fed through the model
+        assert (
+            details.cached_tokens
+            >= first.usage.prompt_tokens + first.usage.completion_tokens - 1
+        )
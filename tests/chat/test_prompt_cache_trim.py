@@ -0,0 +1,76 @@
+import mlx.core as mx
+
+from mlxengine.chat.mlx.prompt_cache import PromptCache, process_prompt_cache
+
+
+class TinyModel:
+    """Just enough of a model for the prompt cache to create per-layer caches"""
+
+    layers = [None, None]
+
+
+def feed(prompt_cache: PromptCache, tokens):
+    """Add KV for ``tokens`` to every layer, as prefilling them would"""
+    x = mx.zeros((1, 1, len(tokens), 8))
+    for c in prompt_cache.cache:
+        c.update_and_fetch(x, x)
+
+
+def process(prompt_cache: PromptCache, prompt, **kwargs):
+    remaining, cached_tokens = process_prompt_cache(
+        prompt, prompt_cache, "model", TinyModel(), **kwargs
+    )
+    feed(prompt_cache, remaining)
+    return remaining, cached_tokens
+
+
+class TestPromptCacheTrim:
+
+    def test_trimmable_cache_keeps_common_prefix(self):
+        prompt_cache = PromptCache()
+        process(prompt_cache, list(range(20)))
+
+        # Edit the end of the prompt
+        prompt = list(range(15)) + [100, 101, 102]
+        remaining, cached_tokens = process(prompt_cache, prompt)
+        assert cached_tokens == 15
+        assert remaining == [100, 101, 102]
+        assert prompt_cache.tokens == prompt
+        assert all(c.offset == len(prompt) for c in prompt_cache.cache)
+
+    def test_repeated_prompt_reprocesses_last_token(self):
+        prompt_cache = PromptCache()
+        prompt = list(range(20))
+        process(prompt_cache, prompt)
+
+        remaining, cached_tokens = process(prompt_cache, prompt)
+        assert cached_tokens == 19
+        assert remaining == [19]
+        assert all(c.offset == 20 for c in prompt_cache.cache)
+
+    def test_generated_tokens_are_trimmed(self):
+        prompt_cache = PromptCache()
+        process(prompt_cache, list(range(10)))
+        feed(prompt_cache, [50, 51, 52])
+
+        remaining, cached_tokens = process(prompt_cache, list(range(12)))
+        assert cached_tokens == 10
+        assert all(c.offset == 12 for c in prompt_cache.cache)
+
+    def test_non_trimmable_cache_is_reset(self):
+        prompt_cache = PromptCache()
+        # A bounded cache can't be trimmed once it has wrapped around
+        process(prompt_cache, list(range(20)), max_kv_size=8)
+        assert not prompt_cache.cache[0].is_trimmable()
+
+        prompt = list(range(15)) + [100]
+        remaining, cached_tokens = process(prompt_cache, prompt, max_kv_size=8)
+        assert cached_tokens == 0
+        assert remaining == prompt
+
+        # Extending the prompt still continues from the bounded cache
+        remaining, cached_tokens = process(
+            prompt_cache, prompt + [101, 102], max_kv_size=8
+        )
+        assert cached_tokens == len(prompt)
+        assert remaining == [101, 102]
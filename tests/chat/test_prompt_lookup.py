@@ -0,0 +1,100 @@
+import logging
+import time
+
+import pytest
+
+from mlxengine.chat.mlx.models import load_model
+from mlxengine.chat.mlx.prompt_lookup import NgramIndex
+from mlxengine.chat.schema import ChatCompletionRequest, ChatMessage, Role
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+MODEL = "mlx-community/Llama-3.2-1B-Instruct-4bit"
+CODE = """def fibonacci(n):
+    if n < 2:
+        return n
+    return fibonacci(n - 1) + fibonacci(n - 2)
+"""
+
+
+class TestNgramIndex:
+
+    def test_lookup_prefers_longest_and_latest_match(self):
+        index = NgramIndex(max_ngram_size=3)
+        index.extend([1, 2, 3, 4, 5, 2, 3, 6, 7, 1, 2, 3])
+
+        # (1, 2, 3) only occurred once, followed by 4
+        assert index.lookup(3) == [4, 5, 2]
+
+        index.extend([9, 2, 3])
+        # No longer suffix matches, the latest (2, 3) was followed by 9
+        assert index.lookup(2) == [9, 2]
+
+    def test_lookup_without_match(self):
+        index = NgramIndex(max_ngram_size=2)
+        index.extend([1, 2, 3])
+
+        assert index.lookup(4) == []
+        assert NgramIndex(max_ngram_size=2).lookup(4) == []
+
+
+@pytest.fixture(scope="module")
+def text_model():
+    return load_model(MODEL)
+
+
+class TestPromptLookupDecoding:
+
+    def test_prompt_lookup_matches_regular_decoding(self, text_model):
+        def make_request(**kwargs) -> ChatCompletionRequest:
+            return ChatCompletionRequest(
+                model=MODEL,
+                messages=[
+                    ChatMessage(
+                        role=Role.USER,
+                        content=f"Repeat this code exactly:\n{CODE}",
+                    )
+                ],
+                max_tokens=60,
+                temperature=0.0,
+                **kwargs,
+            )
+
+        regular = text_model.generate(make_request())
+        lookup = text_model.generate(make_request(prompt_lookup_num_tokens=10))
+        logger.info(f"Prompt lookup usage: {lookup.usage}")
+
+        assert (
+            lookup.choices[0].message.content == regular.choices[0].message.content
+        ), "Prompt lookup output differs"
+
+        details = lookup.usage.completion_tokens_details
+        assert details.accepted_prediction_tokens > 0
+
+    def test_stop_sequence_is_not_cached_for_slow_consumer(self, text_model):
+        request = ChatCompletionRequest(
+            model=MODEL,
+            messages=[
+                ChatMessage(
+                    role=Role.USER, content=f"Repeat this code exactly:\n{CODE}"
+                )
+            ],
+            max_tokens=60,
+            temperature=0.0,
+            stop="fibonacci(n - 1)",
+            prompt_lookup_num_tokens=10,
+        )
+        content = ""
+        for chunk in text_model.stream_generate(request):
+            # The job is done long before the stop sequence is matched here
+            time.sleep(0.05)
+            content += chunk.choices[0].delta.content or ""
+        assert "fibonacci(n - 1)" not in content
+
+        # The worker settles the working sequence before its next job
+        text_model._scheduler.call_exclusive(lambda: None)
+        tokenizer = text_model._chat_tokenizer.tokenizer
+        cached = tokenizer.decode(text_model._prompt_cache.tokens)
+        # Only the prompt holds the stop sequence
+        assert cached.count("fibonacci(n - 1)") == 1
@@ -0,0 +1,98 @@
+import logging
+
+import mlx.core as mx
+import pytest
+from mlx_lm.models.cache import KVCache
+
+from mlxengine.chat.mlx import snapshots
+from mlxengine.chat.mlx.mlx_model import MLXModel
+from mlxengine.chat.mlx.models import load_model
+from mlxengine.chat.mlx.snapshots import SnapshotKey, load_snapshot, save_snapshot
+from mlxengine.chat.schema import ChatCompletionRequest, ChatMessage, Role
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+MODEL = "mlx-community/Llama-3.2-1B-Instruct-4bit"
+SYSTEM = "You are a support agent for a bicycle shop. " * 40
+KEY = SnapshotKey(model_id="model", revision="abc", adapter="", cache_key="model")
+
+
+@pytest.fixture(autouse=True)
+def snapshot_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(snapshots, "snapshot_dir", lambda: tmp_path)
+    return tmp_path
+
+
+def make_cache(tokens):
+    cache = []
+    for _ in range(2):
+        c = KVCache()
+        x = mx.array(tokens, dtype=mx.float32).reshape(1, 1, -1, 1)
+        c.update_and_fetch(x, x)
+        cache.append(c)
+    return cache
+
+
+class TestSnapshotFiles:
+
+    def test_round_trip(self):
+        info = save_snapshot(KEY, "agent", [1, 2, 3], make_cache([1, 2, 3]))
+        assert info["tokens"] == 3
+        assert snapshots.list_snapshots() == [info]
+
+        tokens, cache = load_snapshot(KEY, "agent")
+        assert tokens == [1, 2, 3]
+        assert cache[0].offset == 3
+        assert cache[1].state[0].reshape(-1).tolist() == [1, 2, 3]
+
+    def test_other_revision_is_not_loaded(self):
+        save_snapshot(KEY, "agent", [1, 2, 3], make_cache([1, 2, 3]))
+
+        stale = SnapshotKey(
+            model_id="model", revision="def", adapter="", cache_key="model"
+        )
+        with pytest.raises(FileNotFoundError):
+            load_snapshot(stale, "agent")
+
+    def test_invalid_name(self):
+        with pytest.raises(ValueError):
+            save_snapshot(KEY, "../agent", [1], make_cache([1]))
+
+
+@pytest.fixture(scope="module")
+def text_model():
+    return load_model(MODEL)
+
+
+class TestPromptSnapshots:
+
+    def test_snapshot_survives_restart(self, text_model):
+        messages = [{"role": "system", "content": SYSTEM}]
+        info = text_model.save_snapshot("support", messages)
+        logger.info(f"Saved snapshot: {info}")
+
+        # A fresh model stands in for a restarted server
+        restarted = MLXModel(
+            model_id=MODEL,
+            model=text_model._model,
+            tokenizer=text_model._chat_tokenizer,
+            revision=text_model._revision,
+        )
+        restarted.load_snapshot("support")
+
+        response = restarted.generate(
+            ChatCompletionRequest(
+                model=MODEL,
+                messages=[
+                    ChatMessage(role=Role.SYSTEM, content=SYSTEM),
+                    ChatMessage(role=Role.USER, content="Do you sell helmets?"),
+                ],
+                max_tokens=10,
+                temperature=0.0,
+            )
+        )
+        details = response.usage.prompt_tokens_details
+        assert details is not None
+        # The snapshot ends with the prompt of an assistant reply
+        assert details.cached_tokens >= info["tokens"] - 5
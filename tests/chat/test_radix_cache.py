@@ -0,0 +1,111 @@
+import mlx.core as mx
+from mlx_lm.models.cache import KVCache
+
+from mlxengine.chat.mlx.radix_cache import RadixTree
+
+NUM_LAYERS = 2
+
+
+def make_cache(tokens):
+    """A cache whose keys and values hold the token IDs as their features"""
+    cache = []
+    for _ in range(NUM_LAYERS):
+        c = KVCache()
+        x = mx.array(tokens, dtype=mx.float32).reshape(1, 1, -1, 1)
+        c.update_and_fetch(x, x)
+        cache.append(c)
+    return cache
+
+
+def cached_tokens(cache):
+    return cache[0].state[0].reshape(-1).astype(mx.int32).tolist()
+
+
+class TestRadixTree:
+
+    def test_fetch_longest_prefix(self):
+        tree = RadixTree(max_bytes=1 << 20)
+        tree.insert("model", [1, 2, 3, 4], make_cache([1, 2, 3, 4]))
+        tree.insert("model", [1, 2, 5, 6], make_cache([1, 2, 5, 6]))
+
+        depth, cache, lease = tree.fetch("model", [1, 2, 5, 6, 7])
+        assert depth == 4
+        assert cached_tokens(cache) == [1, 2, 5, 6]
+        assert cache[0].offset == 4
+        tree.release(lease)
+
+        # A match can end in the middle of a node
+        depth, cache, lease = tree.fetch("model", [1, 2, 3, 9])
+        assert depth == 3
+        assert cached_tokens(cache) == [1, 2, 3]
+        tree.release(lease)
+
+        assert tree.fetch("model", [7]) == (0, None, None)
+        assert tree.fetch("other", [1, 2]) == (0, None, None)
+
+    def test_fetched_cache_writes_stay_private(self):
+        tree = RadixTree(max_bytes=1 << 20)
+        tree.insert("model", [1, 2, 3, 4], make_cache([1, 2, 3, 4]))
+
+        _, cache, lease = tree.fetch("model", [1, 2, 3, 4])
+        x = mx.array([9], dtype=mx.float32).reshape(1, 1, 1, 1)
+        for c in cache:
+            c.trim(2)
+            c.update_and_fetch(x, x)
+        assert cached_tokens(cache) == [1, 2, 9]
+        tree.release(lease)
+
+        _, cache, lease = tree.fetch("model", [1, 2, 3, 4])
+        assert cached_tokens(cache) == [1, 2, 3, 4]
+        tree.release(lease)
+
+    def test_shared_prefix_is_stored_once(self):
+        tree = RadixTree(max_bytes=1 << 20)
+        tree.insert("model", [1, 2, 3, 4], make_cache([1, 2, 3, 4]))
+        nbytes = tree.nbytes
+        tree.insert("model", [1, 2, 3, 4, 5, 6], make_cache([1, 2, 3, 4, 5, 6]))
+        tree.insert("model", [1, 2], make_cache([1, 2]))
+
+        assert tree.nbytes == nbytes * 6 // 4
+        assert tree.match_length("model", [1, 2, 3, 4, 5, 6, 7]) == 6
+
+    def test_evicts_least_recently_used_unleased_branch(self):
+        tree = RadixTree(max_bytes=1 << 20)
+        tree.insert("model", [1, 2, 3], make_cache([1, 2, 3]))
+        tree.insert("model", [1, 5, 6], make_cache([1, 5, 6]))
+        tree.insert("model", [7, 8, 9], make_cache([7, 8, 9]))
+        _, _, lease = tree.fetch("model", [1, 2, 3])
+
+        # Room for two branches of three tokens
+        tree.max_bytes = tree.nbytes * 2 // 3
+        tree.insert("model", [1, 5, 6, 4], make_cache([1, 5, 6, 4]))
+
+        # [1, 5, 6] was just used and [1, 2, 3] is leased
+        assert tree.match_length("model", [7, 8, 9]) == 0
+        assert tree.match_length("model", [1, 2, 3]) == 3
+
+        tree.release(lease)
+        tree.max_bytes = 0
+        tree.insert("model", [2], make_cache([2]))
+        assert tree.nbytes == 0
+
+    def test_pinned_branch_is_never_evicted(self):
+        tree = RadixTree(max_bytes=0)
+        tree.insert("model", [1, 2, 3], make_cache([1, 2, 3]), pin=True)
+        tree.insert("model", [4, 5], make_cache([4, 5]))
+
+        assert tree.match_length("model", [1, 2, 3]) == 3
+        assert tree.match_length("model", [4, 5]) == 0
+
+    def test_evicts_a_deep_branch_from_the_leaves_up(self):
+        tree = RadixTree(max_bytes=1 << 30)
+        tokens = list(range(1100))
+        for end in range(1, len(tokens) + 1):
+            tree.insert("model", tokens[:end], make_cache(tokens[:end]))
+        nbytes = tree.nbytes
+
+        # Every node is a single token and only the deepest is a leaf
+        tree.max_bytes = nbytes // 2
+        tree.insert("model", [9999], make_cache([9999]))
+        assert tree.match_length("model", tokens) == 549
+        assert tree.match_length("model", [9999]) == 1
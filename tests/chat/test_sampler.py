@@ -0,0 +1,51 @@
+import mlx.core as mx
+
+from mlxengine.chat.mlx.sampler import make_seeded_samplers
+
+LOGPROBS = mx.log(mx.array([[0.1, 0.2, 0.3, 0.15, 0.25]]))
+
+
+def draw(sampler, steps=32):
+    return [sampler(LOGPROBS).item() for _ in range(steps)]
+
+
+class TestSeededSampler:
+
+    def test_same_seed_same_tokens(self):
+        (first,) = make_seeded_samplers(42, temp=1.0)
+        (second,) = make_seeded_samplers(42, temp=1.0)
+        assert draw(first) == draw(second)
+
+    def test_unaffected_by_global_random_state(self):
+        (first,) = make_seeded_samplers(42, temp=1.0)
+        expected = draw(first)
+
+        (second,) = make_seeded_samplers(42, temp=1.0)
+        tokens = []
+        for _ in range(32):
+            mx.random.seed(len(tokens))
+            mx.random.uniform(shape=(8,))
+            tokens.append(second(LOGPROBS).item())
+        assert tokens == expected
+
+    def test_interleaved_samplers_keep_their_streams(self):
+        (alone,) = make_seeded_samplers(42, temp=0.8, top_p=0.9)
+        expected = draw(alone)
+
+        # Rows of a batch are sampled one after another in every step
+        (seeded,) = make_seeded_samplers(42, temp=0.8, top_p=0.9)
+        others = make_seeded_samplers(7, n=3, temp=1.0)
+        tokens = []
+        for _ in range(32):
+            for other in others:
+                other(LOGPROBS)
+            tokens.append(seeded(LOGPROBS).item())
+        assert tokens == expected
+
+    def test_choices_sample_from_different_streams(self):
+        first, second = make_seeded_samplers(42, n=2, temp=1.0)
+        assert draw(first) != draw(second)
+
+    def test_greedy_and_negative_seed(self):
+        (sampler,) = make_seeded_samplers(-1, temp=0.0)
+        assert draw(sampler, 3) == [2, 2, 2]
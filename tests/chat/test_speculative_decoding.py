@@ -0,0 +1,48 @@
+import logging
+
+import pytest
+
+from mlxengine.chat.mlx.models import load_model
+from mlxengine.chat.schema import ChatCompletionRequest, ChatMessage, Role
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+MODEL = "mlx-community/Llama-3.2-1B-Instruct-4bit"
+
+
+@pytest.fixture(scope="module")
+def text_model():
+    # The model drafts for itself, so every draft token is accepted
+    return load_model(MODEL, draft_model_id=MODEL)
+
+
+def make_request(**kwargs) -> ChatCompletionRequest:
+    return ChatCompletionRequest(
+        model=MODEL,
+        messages=[ChatMessage(role=Role.USER, content="Count from one to ten.")],
+        max_tokens=20,
+        temperature=0.0,
+        **kwargs,
+    )
+
+
+class TestSpeculativeDecoding:
+
+    def test_speculative_matches_regular_decoding(self, text_model):
+        regular = text_model.generate(make_request(draft_model=""))
+        speculative = text_model.generate(make_request(num_draft_tokens=4))
+        logger.info(f"Speculative usage: {speculative.usage}")
+
+        assert (
+            speculative.choices[0].message.content == regular.choices[0].message.content
+        ), "Speculative output differs"
+        assert regular.usage.completion_tokens_details is None
+
+        details = speculative.usage.completion_tokens_details
+        assert details.accepted_prediction_tokens > 0
+        assert details.rejected_prediction_tokens == 0
+
+    def test_unlisted_draft_model_is_rejected(self, text_model):
+        with pytest.raises(ValueError):
+            text_model.check_request(make_request(draft_model="someone/any-model"))
@@ -0,0 +1,74 @@
+import mlx.core as mx
+from mlx_lm.models.cache import KVCache
+
+from mlxengine.chat.mlx.radix_cache import RadixTree
+from mlxengine.chat.mlx.spill_cache import SpillStore
+from mlxengine.utils.metrics import metrics
+
+NUM_LAYERS = 2
+
+
+def make_cache(tokens, dims=1):
+    """A cache whose keys and values hold the token IDs as their features"""
+    cache = []
+    for _ in range(NUM_LAYERS):
+        c = KVCache()
+        x = mx.array(tokens, dtype=mx.float32).reshape(1, 1, -1, 1)
+        x = mx.repeat(x, dims, axis=-1)
+        c.update_and_fetch(x, x)
+        cache.append(c)
+    return cache
+
+
+def cached_tokens(cache):
+    return cache[0].state[0][..., 0].reshape(-1).astype(mx.int32).tolist()
+
+
+class TestSpillCache:
+
+    def test_evicted_branch_is_restored_from_disk(self, tmp_path):
+        spill = SpillStore(max_bytes=1 << 20, directory=str(tmp_path))
+        tree = RadixTree(max_bytes=1 << 20, spill=spill)
+        tree.insert("model", [1, 2, 3, 4], make_cache([1, 2, 3, 4]))
+        tree.insert("model", [1, 2, 5, 6], make_cache([1, 2, 5, 6]))
+
+        # Only the shared prefix and the latest branch fit
+        tree.max_bytes = tree.nbytes * 3 // 4
+        tree.insert("model", [1, 2, 5, 6], make_cache([1, 2, 5, 6]))
+        tree.insert("model", [1, 2, 5, 6, 7], make_cache([1, 2, 5, 6, 7]))
+        assert tree.match_length("model", [1, 2, 3, 4]) == 2
+        assert spill.nbytes > 0
+
+        tree.max_bytes = 1 << 20
+        assert tree.restore("model", [1, 2, 3, 4, 9]) == 4
+        depth, cache, lease = tree.fetch("model", [1, 2, 3, 4, 9])
+        assert depth == 4
+        assert cached_tokens(cache) == [1, 2, 3, 4]
+        tree.release(lease)
+        assert spill.find("model", [1, 2, 3, 4], 2) is None
+
+    def test_quantized_spill(self, tmp_path):
+        spill = SpillStore(max_bytes=1 << 20, directory=str(tmp_path), bits=8)
+        tree = RadixTree(max_bytes=0, spill=spill)
+        tree.insert("model", [1, 2, 3], make_cache([1, 2, 3], dims=64))
+        assert tree.nbytes == 0
+
+        tree.max_bytes = 1 << 20
+        assert tree.restore("model", [1, 2, 3]) == 3
+        _, cache, lease = tree.fetch("model", [1, 2, 3])
+        expected = make_cache([1, 2, 3], dims=64)[0].keys[..., :3, :]
+        assert mx.allclose(cache[0].keys, expected, atol=0.05)
+        tree.release(lease)
+
+    def test_spill_directory_is_capped(self, tmp_path):
+        spill = SpillStore(max_bytes=1 << 20, directory=str(tmp_path))
+        tree = RadixTree(max_bytes=0, spill=spill)
+        tree.insert("model", [1, 2, 3], make_cache([1, 2, 3]))
+        spill.max_bytes = spill.nbytes
+        tree.insert("model", [4, 5, 6], make_cache([4, 5, 6]))
+
+        # The older segment made room for the newer one
+        assert spill.nbytes <= spill.max_bytes
+        assert spill.find("model", [1, 2, 3], 0) is None
+        assert spill.find("model", [4, 5, 6], 0) is not None
+        assert metrics.get("prompt_cache_spill_bytes", model="model") == spill.nbytes
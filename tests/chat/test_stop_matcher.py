@@ -0,0 +1,60 @@
+from mlxengine.chat.mlx.stop_matcher import StopMatcher
+
+
+def feed_all(matcher, chunks):
+    released = []
+    for chunk in chunks:
+        text, stopped = matcher.feed(chunk)
+        released.append(text)
+        if stopped:
+            return "".join(released), True
+    released.append(matcher.flush())
+    return "".join(released), False
+
+
+class TestStopMatcher:
+
+    def test_cuts_at_the_stop_string(self):
+        matcher = StopMatcher(["END"])
+        text, stopped = feed_all(matcher, ["Hello E", "N", "D and more"])
+
+        assert stopped
+        assert text == "Hello "
+        assert matcher.released == len("Hello ")
+
+    def test_stop_spanning_chunks_is_held_back(self):
+        matcher = StopMatcher(["\n\nUser:"])
+
+        assert matcher.feed("Sure.\n") == ("Sure.", False)
+        assert matcher.feed("\nUs") == ("", False)
+        # The held text is released once it can't start a stop anymore
+        assert matcher.feed("ually") == ("\n\nUsually", False)
+
+    def test_held_text_is_released_at_the_end(self):
+        matcher = StopMatcher(["</answer>"])
+        text, stopped = feed_all(matcher, ["42 </ans"])
+
+        assert not stopped
+        assert text == "42 </ans"
+
+    def test_many_stops_with_shared_prefixes(self):
+        stops = [f"<stop{i}>" for i in range(16)] + ["abcd", "bc"]
+        matcher = StopMatcher(stops)
+        text, stopped = feed_all(matcher, ["x <stop", "1", "2> y"])
+        assert (text, stopped) == ("x ", True)
+
+        # "bc" completes before "abcd" can
+        matcher = StopMatcher(stops)
+        text, stopped = feed_all(matcher, ["a", "b", "c", "d"])
+        assert (text, stopped) == ("a", True)
+
+    def test_match_after_a_failed_partial_match(self):
+        matcher = StopMatcher(["aab"])
+        text, stopped = feed_all(matcher, ["aa", "aab"])
+
+        assert stopped
+        assert text == "aa"
+
+    def test_empty_stops_never_match(self):
+        matcher = StopMatcher(["", ""])
+        assert feed_all(matcher, ["anything"]) == ("anything", False)
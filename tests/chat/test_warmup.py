@@ -0,0 +1,71 @@
+import logging
+
+import pytest
+
+from mlxengine.chat import warmup
+from mlxengine.chat.mlx.models import load_model
+from mlxengine.chat.schema import ChatCompletionRequest, ChatMessage, Role
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+MODEL = "mlx-community/Llama-3.2-1B-Instruct-4bit"
+SYSTEM = "You are a support agent for a bicycle shop. " * 40
+TOOLS = [
+    {
+        "type": "function",
+        "function": {
+            "name": "get_stock",
+            "description": "Get the stock of a product",
+            "parameters": {
+                "type": "object",
+                "properties": {"product": {"type": "string"}},
+                "required": ["product"],
+            },
+        },
+    }
+]
+
+
+@pytest.fixture(scope="module")
+def text_model():
+    return load_model(MODEL)
+
+
+class TestWarmUp:
+
+    def test_warmed_prompt_is_cached(self, text_model, monkeypatch):
+        monkeypatch.setattr(
+            warmup,
+            "load_config",
+            lambda: {
+                "warmup": [
+                    {
+                        "model": MODEL,
+                        "messages": [{"role": "system", "content": SYSTEM}],
+                        "tools": TOOLS,
+                    }
+                ]
+            },
+        )
+        monkeypatch.setattr(warmup, "_create_text_model", lambda *_: text_model)
+        warmup.warm_up()
+
+        response = text_model.generate(
+            ChatCompletionRequest(
+                model=MODEL,
+                messages=[
+                    ChatMessage(role=Role.SYSTEM, content=SYSTEM),
+                    ChatMessage(role=Role.USER, content="Do you have helmets?"),
+                ],
+                tools=TOOLS,
+                max_tokens=10,
+                temperature=0.0,
+            )
+        )
+        details = response.usage.prompt_tokens_details
+        logger.info(f"Prompt tokens details: {details}")
+        assert details is not None
+        # The warmed prompt ends with the prompt of an assistant reply
+        tokens, _ = text_model.warm_up([{"role": "system", "content": SYSTEM}], TOOLS)
+        assert details.cached_tokens >= tokens - 5
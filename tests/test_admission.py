@@ -0,0 +1,199 @@
+import asyncio
+import threading
+
+import pytest
+
+from mlxengine.utils.admission import (
+    AdmissionController,
+    AdmissionRejected,
+    get_admission_controller,
+    make_deadline,
+)
+from mlxengine.utils.metrics import metrics
+
+
+class TestAdmissionController:
+
+    def test_admits_up_to_max_active(self):
+        async def main():
+            controller = AdmissionController("test-fast", max_active=2)
+            first = await controller.acquire()
+            second = await controller.acquire()
+            assert controller.active == 2 and controller.queued == 0
+            first.release()
+            first.release()
+            second.release()
+            return controller.active
+
+        assert asyncio.run(main()) == 0
+
+    def test_queued_request_runs_after_release(self):
+        async def main():
+            controller = AdmissionController("test-queue", max_active=1)
+            slot = await controller.acquire()
+            waiting = asyncio.ensure_future(controller.acquire())
+            await asyncio.sleep(0.01)
+            assert not waiting.done() and controller.queued == 1
+
+            # Generation finishes on a worker thread
+            threading.Thread(target=slot.release).start()
+            queued = await asyncio.wait_for(waiting, 1)
+            assert controller.active == 1 and controller.queued == 0
+            queued.release()
+
+        asyncio.run(main())
+
+    def test_requests_are_admitted_in_order(self):
+        async def main():
+            controller = AdmissionController("test-order", max_active=1)
+            slot = await controller.acquire()
+            admitted = []
+
+            async def request(i):
+                async with controller.admit():
+                    admitted.append(i)
+                    await asyncio.sleep(0)
+
+            tasks = [asyncio.ensure_future(request(i)) for i in range(4)]
+            await asyncio.sleep(0.01)
+            slot.release()
+            await asyncio.gather(*tasks)
+            return admitted
+
+        assert asyncio.run(main()) == [0, 1, 2, 3]
+
+    def test_full_queue_is_rejected(self):
+        async def main():
+            controller = AdmissionController("test-full", max_active=1, max_queued=1)
+            slot = await controller.acquire()
+            waiting = asyncio.ensure_future(controller.acquire())
+            await asyncio.sleep(0.01)
+            with pytest.raises(AdmissionRejected) as rejected:
+                await controller.acquire()
+            slot.release()
+            (await waiting).release()
+            return rejected.value
+
+        rejected = asyncio.run(main())
+        assert rejected.reason == "queue_full"
+        assert int(rejected.headers["Retry-After"]) >= 1
+        assert metrics.get(
+            "admission_rejected_requests", model="test-full", reason="queue_full"
+        )
+
+    def test_wait_times_out(self):
+        async def main():
+            controller = AdmissionController(
+                "test-timeout", max_active=1, queue_timeout=0.05
+            )
+            slot = await controller.acquire()
+            with pytest.raises(AdmissionRejected) as rejected:
+                await controller.acquire()
+            assert controller.queued == 0 and controller.active == 1
+            slot.release()
+            return rejected.value
+
+        assert asyncio.run(main()).reason == "timeout"
+
+    def test_cancelled_request_leaves_the_queue(self):
+        async def main():
+            controller = AdmissionController("test-cancel", max_active=1)
+            slot = await controller.acquire()
+            waiting = asyncio.ensure_future(controller.acquire())
+            await asyncio.sleep(0.01)
+            waiting.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await waiting
+            assert controller.queued == 0
+            slot.release()
+            return controller.active
+
+        assert asyncio.run(main()) == 0
+
+    def test_publishes_queue_depth(self):
+        async def main():
+            controller = AdmissionController("test-gauges", max_active=1)
+            slot = await controller.acquire()
+            waiting = asyncio.ensure_future(controller.acquire())
+            await asyncio.sleep(0.01)
+            assert metrics.get("admission_queue_depth", model="test-gauges") == 1
+            assert metrics.get("admission_active_requests", model="test-gauges") == 1
+            slot.release()
+            (await waiting).release()
+
+        asyncio.run(main())
+        assert metrics.get("admission_queue_depth", model="test-gauges") == 0
+        assert metrics.get("admission_active_requests", model="test-gauges") == 0
+        assert metrics.get("admission_admitted_requests", model="test-gauges") == 2
+
+    def test_interactive_requests_run_beside_batch_requests(self):
+        async def main():
+            controller = AdmissionController("test-priority", max_active=2)
+            batch = [await controller.acquire(priority="batch") for _ in range(2)]
+            interactive = [await controller.acquire() for _ in range(2)]
+            assert controller.active == 4
+
+            # Batch requests only take slots interactive requests left over
+            waiting = asyncio.ensure_future(controller.acquire(priority="batch"))
+            await asyncio.sleep(0.01)
+            batch[0].release()
+            interactive[0].release()
+            await asyncio.sleep(0.01)
+            assert not waiting.done()
+            interactive[1].release()
+            (await asyncio.wait_for(waiting, 1)).release()
+            batch[1].release()
+            return controller.active
+
+        assert asyncio.run(main()) == 0
+
+    def test_one_batch_request_always_runs(self):
+        async def main():
+            controller = AdmissionController("test-batch-share", max_active=1)
+            interactive = await controller.acquire()
+            batch = await asyncio.wait_for(controller.acquire(priority="batch"), 1)
+            batch.release()
+            interactive.release()
+
+        asyncio.run(main())
+
+    def test_invalid_priority(self):
+        controller = AdmissionController("test-invalid", max_active=1)
+        with pytest.raises(ValueError):
+            asyncio.run(controller.acquire(priority="urgent"))
+
+    def test_request_waits_until_its_deadline(self):
+        async def main():
+            controller = AdmissionController("test-deadline", max_active=1)
+            slot = await controller.acquire()
+            with pytest.raises(AdmissionRejected) as rejected:
+                await controller.acquire(timeout=0.05)
+            assert controller.queued == 0
+            slot.release()
+            return rejected.value
+
+        assert asyncio.run(main()).reason == "deadline"
+
+    @pytest.mark.parametrize("timeout", [0, -1, "soon", True])
+    def test_invalid_timeout(self, timeout):
+        with pytest.raises(ValueError):
+            make_deadline(timeout)
+
+    def test_services_have_their_own_controllers(self):
+        tts = get_admission_controller("tts", "test-shared-name", 1)
+        chat = get_admission_controller("chat", "test-shared-name", 16)
+        assert tts is not chat
+        assert (tts.max_active, chat.max_active) == (1, 16)
+        assert get_admission_controller("tts", "test-shared-name", 16) is tts
+
+        async def main():
+            slot = await tts.acquire()
+            slot.release()
+
+        asyncio.run(main())
+        assert (
+            metrics.get(
+                "admission_admitted_requests", model="test-shared-name", service="tts"
+            )
+            == 1
+        )
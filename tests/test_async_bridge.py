@@ -0,0 +1,140 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from mlxengine.utils.async_bridge import (
+    abort_on_disconnect,
+    iterate_in_thread,
+    run_in_thread,
+)
+
+
+class TestAsyncBridge:
+
+    def test_run_in_thread(self):
+        async def main():
+            return await run_in_thread(
+                lambda x, y=0: (threading.get_ident(), x + y), 1, y=2
+            )
+
+        ident, result = asyncio.run(main())
+        assert result == 3
+        assert ident != threading.get_ident()
+
+    def test_run_in_thread_raises(self):
+        def fail():
+            raise ValueError("bad")
+
+        with pytest.raises(ValueError):
+            asyncio.run(run_in_thread(fail))
+
+    def test_loop_runs_while_iterating(self):
+        def slow():
+            for i in range(3):
+                time.sleep(0.05)
+                yield i
+
+        async def main():
+            ticks = 0
+
+            async def tick():
+                nonlocal ticks
+                while True:
+                    await asyncio.sleep(0.005)
+                    ticks += 1
+
+            ticker = asyncio.create_task(tick())
+            items = [item async for item in iterate_in_thread(slow)]
+            ticker.cancel()
+            return items, ticks
+
+        items, ticks = asyncio.run(main())
+        assert items == [0, 1, 2]
+        assert ticks > 10
+
+    def test_stopping_early_closes_the_iterator(self):
+        closed = threading.Event()
+
+        def endless():
+            try:
+                while True:
+                    time.sleep(0.01)
+                    yield 1
+            finally:
+                closed.set()
+
+        async def main():
+            async for _ in iterate_in_thread(endless):
+                break
+
+        asyncio.run(main())
+        assert closed.wait(1)
+
+    def test_iterator_error_is_raised(self):
+        def broken():
+            yield 1
+            raise RuntimeError("broken")
+
+        async def main():
+            items = []
+            with pytest.raises(RuntimeError):
+                async for item in iterate_in_thread(broken):
+                    items.append(item)
+            return items
+
+        assert asyncio.run(main()) == [1]
+
+
+class FakeRequest:
+    """Request whose client disconnects once ``disconnect`` is set"""
+
+    def __init__(self):
+        self.disconnect = asyncio.Event()
+
+    async def receive(self):
+        await self.disconnect.wait()
+        return {"type": "http.disconnect"}
+
+
+class TestAbortOnDisconnect:
+
+    def test_set_when_the_client_disconnects(self):
+        async def main():
+            request = FakeRequest()
+            async with abort_on_disconnect(request) as abort:
+                await asyncio.sleep(0.01)
+                assert not abort.is_set()
+                request.disconnect.set()
+                await asyncio.sleep(0.01)
+                return abort.is_set()
+
+        assert asyncio.run(main())
+
+    def test_set_when_cancelled(self):
+        async def main():
+            abort = None
+
+            async def handle():
+                nonlocal abort
+                async with abort_on_disconnect(FakeRequest()) as abort:
+                    await asyncio.sleep(10)
+
+            task = asyncio.create_task(handle())
+            await asyncio.sleep(0.01)
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+            return abort.is_set()
+
+        assert asyncio.run(main())
+
+    def test_not_set_after_completing(self):
+        async def main():
+            async with abort_on_disconnect(FakeRequest()) as abort:
+                pass
+            await asyncio.sleep(0.01)
+            return abort.is_set()
+
+        assert not asyncio.run(main())
@@ -0,0 +1,265 @@
+import asyncio
+import io
+import json
+import os
+import threading
+import time
+
+import pytest
+
+from mlxengine.batches import batches_service
+from mlxengine.batches.batches_service import (
+    BatchesService,
+    BatchRequestError,
+    BatchRunner,
+    _acquire_batch_slot,
+)
+from mlxengine.batches.schema import BatchCreateRequest, BatchStatus
+from mlxengine.files.files_service import FilesService
+from mlxengine.files.schema import FilePurpose
+from mlxengine.utils.admission import BATCH, get_admission_controller
+
+
+def request_line(custom_id, system="You are helpful.", content="Hi"):
+    return {
+        "custom_id": custom_id,
+        "method": "POST",
+        "url": "/v1/chat/completions",
+        "body": {
+            "model": "test",
+            "messages": [
+                {"role": "system", "content": system},
+                {"role": "user", "content": content},
+            ],
+        },
+    }
+
+
+class FakeCompleter:
+    """Answers with the user message, failing the ones that say ``fail``"""
+
+    def __init__(self):
+        self.calls = []
+
+    async def __call__(self, body, abort):
+        content = body["messages"][-1]["content"]
+        self.calls.append(content)
+        await asyncio.sleep(0)
+        if content == "fail":
+            raise BatchRequestError("Invalid request", 400)
+        return {"id": f"chatcmpl-{content}", "choices": [{"message": content}]}
+
+
+@pytest.fixture
+def service(tmp_path):
+    return BatchesService(tmp_path / "batches", FilesService(tmp_path / "files"))
+
+
+def create_batch(service, lines):
+    text = "".join(
+        (line if isinstance(line, str) else json.dumps(line)) + "\n" for line in lines
+    )
+    file = service.files.create(
+        io.BytesIO(text.encode()), "input.jsonl", FilePurpose.BATCH
+    )
+    return service.create(
+        BatchCreateRequest(input_file_id=file.id, endpoint="/v1/chat/completions")
+    )
+
+
+def run_batch(service, batch_id, completer=None, concurrency=4):
+    completer = completer or FakeCompleter()
+    runner = BatchRunner(service, batch_id, completer, concurrency=concurrency)
+    asyncio.run(runner.run())
+    return service.get(batch_id), completer
+
+
+def read_lines(service, file_id):
+    with open(service.files.content_path(file_id), encoding="utf-8") as f:
+        return [json.loads(line) for line in f]
+
+
+class TestFilesService:
+
+    def test_create_list_delete(self, tmp_path):
+        files = FilesService(tmp_path)
+        file = files.create(io.BytesIO(b"{}\n"), "input.jsonl", FilePurpose.BATCH)
+        assert file.id.startswith("file-") and file.bytes == 3
+        assert files.get(file.id) == file
+        assert files.content_path(file.id).read_bytes() == b"{}\n"
+        assert [f.id for f in files.list(FilePurpose.BATCH)] == [file.id]
+        assert files.list(FilePurpose.BATCH_OUTPUT) == []
+
+        assert files.delete(file.id).deleted
+        with pytest.raises(FileNotFoundError):
+            files.get(file.id)
+
+    def test_rejects_ids_outside_the_store(self, tmp_path):
+        with pytest.raises(FileNotFoundError):
+            FilesService(tmp_path).get("file-../../etc/passwd")
+
+
+class TestBatches:
+
+    def test_runs_requests_and_splits_errors(self, service):
+        batch = create_batch(
+            service,
+            [request_line("a", content="one"), request_line("b", content="fail")],
+        )
+        batch, _ = run_batch(service, batch.id)
+
+        assert batch.status == BatchStatus.COMPLETED
+        assert batch.request_counts.model_dump() == {
+            "total": 2,
+            "completed": 1,
+            "failed": 1,
+        }
+        (output,) = read_lines(service, batch.output_file_id)
+        assert output["custom_id"] == "a"
+        assert output["response"]["status_code"] == 200
+        assert output["response"]["body"]["choices"] == [{"message": "one"}]
+        (error,) = read_lines(service, batch.error_file_id)
+        assert error["custom_id"] == "b"
+        assert error["response"]["status_code"] == 400
+        assert service.files.get(batch.output_file_id).purpose == "batch_output"
+
+    def test_requests_sharing_a_prefix_run_together(self, service):
+        lines = [
+            request_line("1", system="B", content="x"),
+            request_line("2", system="A", content="y"),
+            request_line("3", system="B", content="w"),
+            request_line("4", system="A", content="z"),
+        ]
+        batch = create_batch(service, lines)
+        _, completer = run_batch(service, batch.id, concurrency=1)
+        assert completer.calls == ["y", "z", "w", "x"]
+
+    def test_invalid_input_fails_the_batch(self, service):
+        duplicate = request_line("a")
+        batch = create_batch(service, [duplicate, "not json", duplicate])
+        batch, completer = run_batch(service, batch.id)
+
+        assert batch.status == BatchStatus.FAILED
+        assert [(e.line, e.code) for e in batch.errors.data] == [
+            (2, "invalid_json_line"),
+            (3, "duplicate_custom_id"),
+        ]
+        assert completer.calls == []
+
+    def test_resumes_from_checkpoint(self, service):
+        lines = [request_line(str(i), content=str(i)) for i in range(4)]
+        batch = create_batch(service, lines)
+        answered = {
+            "id": "batch_req_1",
+            "custom_id": "0",
+            "response": {"status_code": 200, "request_id": None, "body": {}},
+            "error": None,
+        }
+        # Interrupted after one response and in the middle of another
+        with open(service.output_path(batch.id), "w") as f:
+            f.write(json.dumps(answered) + "\n" + '{"custom_id": "1", "resp')
+
+        batch, completer = run_batch(service, batch.id)
+        assert sorted(completer.calls) == ["1", "2", "3"]
+        assert batch.request_counts.completed == 4
+        custom_ids = [
+            line["custom_id"] for line in read_lines(service, batch.output_file_id)
+        ]
+        assert sorted(custom_ids) == ["0", "1", "2", "3"]
+
+    def test_cancel(self, service):
+        batch = create_batch(service, [request_line("a")])
+        assert service.cancel(batch.id).status == BatchStatus.CANCELLING
+
+        batch, completer = run_batch(service, batch.id)
+        assert batch.status == BatchStatus.CANCELLED and batch.cancelled_at
+        assert completer.calls == []
+        with pytest.raises(ValueError):
+            service.cancel(batch.id)
+
+    def test_expired_requests_are_reported(self, service):
+        batch = create_batch(service, [request_line("a")])
+        batch.expires_at = int(time.time()) - 1
+        service.save(batch)
+
+        batch, completer = run_batch(service, batch.id)
+        assert batch.status == BatchStatus.EXPIRED
+        assert batch.request_counts.failed == 1
+        (error,) = read_lines(service, batch.error_file_id)
+        assert error["error"]["code"] == "batch_expired"
+
+    def test_resumed_finalizing_batch_keeps_its_status(self, service, monkeypatch):
+        class Crash(BaseException):
+            pass
+
+        def crash(*args):
+            raise Crash()
+
+        batch = create_batch(service, [request_line("a")])
+        # Interrupted while handing over its files
+        with monkeypatch.context() as m:
+            m.setattr(service.files, "add", crash)
+            with pytest.raises(Crash):
+                run_batch(service, batch.id)
+        batch = service.get(batch.id)
+        assert batch.status == BatchStatus.FINALIZING
+        assert "final_status" not in batch.model_dump()
+
+        # The completion window passed while the server was down
+        batch.expires_at = int(time.time()) - 1
+        service.save(batch)
+        batch, completer = run_batch(service, batch.id)
+        assert batch.status == BatchStatus.COMPLETED and batch.completed_at
+        assert batch.request_counts.completed == 1
+        assert completer.calls == []
+
+    def test_checkpoints_run_off_the_event_loop(self, service, monkeypatch):
+        batch = create_batch(service, [request_line(str(i)) for i in range(3)])
+        threads = set()
+        fsync = os.fsync
+
+        def record(fd):
+            threads.add(threading.current_thread())
+            fsync(fd)
+
+        monkeypatch.setattr(batches_service.os, "fsync", record)
+        batch, _ = run_batch(service, batch.id)
+        assert batch.request_counts.completed == 3
+        assert threads and threading.main_thread() not in threads
+        assert len(read_lines(service, batch.output_file_id)) == 3
+
+    @pytest.mark.parametrize(
+        "endpoint, window",
+        [("/v1/embeddings", "24h"), ("/v1/chat/completions", "1h")],
+    )
+    def test_create_validates_request(self, service, endpoint, window):
+        file = service.files.create(io.BytesIO(b""), "input.jsonl", FilePurpose.BATCH)
+        with pytest.raises(ValueError):
+            service.create(
+                BatchCreateRequest(
+                    input_file_id=file.id, endpoint=endpoint, completion_window=window
+                )
+            )
+
+    def test_queued_request_gives_up_when_aborted(self):
+        async def main():
+            admission = get_admission_controller("chat", "test-batch-abort", 1)
+            # The one batch request always let through holds the only slot
+            slot = await admission.acquire(priority=BATCH)
+            abort = threading.Event()
+            waiting = asyncio.ensure_future(
+                _acquire_batch_slot("test-batch-abort", abort)
+            )
+            await asyncio.sleep(0.05)
+            assert admission.queued == 1
+
+            abort.set()
+            start = time.monotonic()
+            with pytest.raises(BatchRequestError):
+                await waiting
+            assert time.monotonic() - start < 1
+            assert admission.queued == 0
+            slot.release()
+            assert admission.active == 0
+
+        asyncio.run(main())